@@ -2,20 +2,25 @@
 import time
 
 import datetime
+import json
 import logging.config
 import os
 import webbrowser
+import zoneinfo
 
 import threading
+from collections import OrderedDict
 
 from youtube import API
 from modules.gui import MODULE_KEY
-from modules.helper.message import TextMessage, SystemMessage
+from modules.helper.message import TextMessage, SystemMessage, build_segments
 from modules.helper.module import ChatModule, Channel, CHANNEL_ONLINE, CHANNEL_OFFLINE, CHANNEL_PENDING, \
     CHANNEL_DISABLED
 
-from modules.helper.system import translate_key, get_wx_parent, get_secret
-from modules.interface.types import LCStaticBox, LCPanel, LCText, LCBool, LCButton, LCLabel
+from modules.helper.supervisor import supervisor
+from modules.helper.system import translate_key, get_wx_parent, get_secret, NO_VIEWERS
+from modules.helper.viewers import viewers_scheduler
+from modules.interface.types import LCStaticBox, LCPanel, LCText, LCBool, LCButton, LCLabel, LCSpin
 
 logging.getLogger('irc').setLevel(logging.ERROR)
 logging.getLogger('requests').setLevel(logging.ERROR)
@@ -26,13 +31,34 @@ CLIENT_SECRET = get_secret('youtube.clientsecret')
 
 FILE_ICON = os.path.join('img', 'youtube.png')
 
+SOURCE = 'yt'
 ICON = 'https://www.youtube.com/favicon.ico'
+SYSTEM_USER = 'YouTube'
 YT_SCOPE = 'https://www.googleapis.com/auth/youtube.readonly'
 
 LOCAL_API_URL = 'http://localhost:{}/rest/cyoutube/oauth'
 LOCAL_API_URL_RESP = 'http://localhost:{}/rest/cyoutube/oauth_response'
 
 MAX_RESULTS = 50
+AUTHOR_CACHE_SIZE = 5000
+AUTHOR_CACHE_TTL = 3600
+VIEWERS_MIN_INTERVAL = 30
+
+# API units spent by a single request of the endpoint
+QUOTA_COSTS = {'liveChat/messages': 5, 'videos': 1, 'channels': 1}
+DEFAULT_QUOTA_COST = 1
+QUOTA_ERRORS = ('quotaExceeded', 'dailyLimitExceeded', 'rateLimitExceeded')
+QUOTA_BACKOFF = 60
+QUOTA_WARNING_RATIO = 0.9
+# Daily quota is reset at midnight Pacific time
+try:
+    QUOTA_TIMEZONE = zoneinfo.ZoneInfo('America/Los_Angeles')
+except zoneinfo.ZoneInfoNotFoundError:
+    # No tz database (Windows without tzdata), daylight saving is not taken into account
+    QUOTA_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+# Polling of quiet chat slows down up to this interval
+IDLE_INTERVAL = 20
+IDLE_STRETCH = 1.5
 
 
 def register_oauth(event):
@@ -49,6 +75,9 @@ CONF_DICT = LCPanel(icon=FILE_ICON)
 CONF_DICT['config'] = LCStaticBox()
 CONF_DICT['config']['register_oauth'] = LCButton(register_oauth)
 CONF_DICT['config']['warning'] = LCLabel(translate_key('cyoutube.warning'))
+CONF_DICT['quota'] = LCStaticBox()
+CONF_DICT['quota']['daily_units'] = LCSpin(10000, min_v=100, max_v=1000000)
+CONF_DICT['quota']['stream_hours'] = LCSpin(4, min_v=1, max_v=24)
 CONF_DICT['api'] = LCStaticBox(hidden=True)
 CONF_DICT['api']['access_token'] = LCText('')
 CONF_DICT['api']['refresh_token'] = LCText('')
@@ -61,7 +90,7 @@ CONF_GUI = {
         'hidden': ['host', 'port'],
     },
     'hidden': ['api'],
-    'non_dynamic': [],
+    'non_dynamic': ['quota.*'],
     'ignored_sections': ['config.register_oauth']
 }
 
@@ -70,6 +99,9 @@ CONNECTION_DIED = translate_key(MODULE_KEY.join(['youtube', 'connection_died']))
 CONNECTION_CLOSED = translate_key(MODULE_KEY.join(['youtube', 'connection_closed']))
 CONNECTION_JOINING = translate_key(MODULE_KEY.join(['youtube', 'joining']))
 CHANNEL_JOIN_SUCCESS = translate_key(MODULE_KEY.join(['youtube', 'join_success']))
+QUOTA_WARNING = translate_key('cyoutube.quota_warning')
+QUOTA_EXCEEDED = translate_key('cyoutube.quota_exceeded')
+QUOTA_STATUS = translate_key('cyoutube.quota_status')
 CHANNEL_JOINING = translate_key(MODULE_KEY.join(['youtube', 'joining']))
 
 
@@ -77,56 +109,304 @@ class NotLiveError(Exception):
     pass
 
 
+class QuotaExceededError(Exception):
+    pass
+
+
+def is_quota_error(exc):
+    return any(reason in str(exc) for reason in QUOTA_ERRORS)
+
+
+class QuotaScheduler(object):
+    def __init__(self, get_api, daily_units, stream_hours, notify=None):
+        """
+            Counts API units spent by all YouTube channels and spreads
+              remaining daily quota over the expected stream duration
+        :param get_api: function returning current API object
+        :param daily_units: daily quota of the API project
+        :param stream_hours: how long quota should last after the first request
+        :param notify: function receiving text of quota warnings
+        """
+        self.get_api = get_api
+        self.daily_units = daily_units
+        self.stream_seconds = stream_hours * 3600
+        self.notify = notify
+
+        self.spent = {}
+        self.readers = {}
+        self.day = None
+        self.session_start = None
+        self.blocked_until = 0
+        self.backoff = QUOTA_BACKOFF
+        self.warned = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def seconds_to_reset():
+        now = datetime.datetime.now(QUOTA_TIMEZONE)
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(),
+                                             tzinfo=QUOTA_TIMEZONE)
+        # Timestamps, wall clock difference is off on days daylight saving changes
+        return midnight.timestamp() - now.timestamp()
+
+    def _check_day(self):
+        day = datetime.datetime.now(QUOTA_TIMEZONE).date()
+        if day != self.day:
+            self.day = day
+            self.spent = {}
+            self.session_start = time.time()
+            self.backoff = QUOTA_BACKOFF
+            self.warned = False
+
+    @property
+    def total_spent(self):
+        return sum(self.spent.values())
+
+    def wait_time(self):
+        """
+        :return: seconds until API can be requested again, 0 if quota is available
+        """
+        with self._lock:
+            self._check_day()
+        if time.time() < self.blocked_until:
+            return max(0.0, self.blocked_until - time.time())
+        if self.total_spent >= self.daily_units:
+            return self.seconds_to_reset()
+        return 0.0
+
+    @property
+    def exhausted(self):
+        return self.wait_time() > 0
+
+    def get(self, endpoint, **kwargs):
+        wait_time = self.wait_time()
+        if wait_time:
+            raise QuotaExceededError(f'Quota is exhausted for {wait_time:.0f}s')
+
+        with self._lock:
+            self._check_day()
+            # Failed requests are charged as well
+            self.spent[endpoint] = self.spent.get(endpoint, 0) + QUOTA_COSTS.get(endpoint, DEFAULT_QUOTA_COST)
+        try:
+            result = self.get_api().get(endpoint, **kwargs)
+        except Exception as exc:
+            if not is_quota_error(exc):
+                raise
+            with self._lock:
+                delay = min(self.backoff, self.seconds_to_reset())
+                self.blocked_until = time.time() + delay
+                self.backoff *= 2
+            if self.notify:
+                self.notify(QUOTA_EXCEEDED.format(int(delay / 60) + 1))
+            raise QuotaExceededError(str(exc))
+
+        self.backoff = QUOTA_BACKOFF
+        self._check_projection()
+        return result
+
+    def add_reader(self, reader):
+        self.readers[reader] = 0
+
+    def remove_reader(self, reader):
+        self.readers.pop(reader, None)
+
+    def _window(self):
+        """
+        :return: seconds remaining quota has to last
+        """
+        now = time.time()
+        window_end = (self.session_start or now) + self.stream_seconds
+        to_reset = self.seconds_to_reset()
+        if window_end <= now:
+            return to_reset
+        return min(window_end - now, to_reset)
+
+    def interval(self, reader, server_interval, messages):
+        """
+        :param server_interval: interval requested by API
+        :param messages: messages received by the last poll
+        :return: seconds reader should wait before next poll
+        """
+        if self.exhausted:
+            # Reader waits for the quota itself before the next request
+            return server_interval
+
+        idle = 0 if messages else min(max(self.readers.get(reader, 0), server_interval) * IDLE_STRETCH,
+                                      IDLE_INTERVAL)
+        self.readers[reader] = idle
+
+        remaining = max(self.daily_units - self.total_spent, QUOTA_COSTS['liveChat/messages'])
+        units_per_reader = remaining / self._window() / max(len(self.readers), 1)
+        budget = QUOTA_COSTS['liveChat/messages'] / units_per_reader
+        return max(server_interval, budget, idle)
+
+    def projected(self):
+        """
+        :return: units expected to be spent until the end of the window with current usage
+        """
+        spent = self.total_spent
+        elapsed = time.time() - self.session_start if self.session_start else 0
+        if elapsed < 60:
+            return spent
+        return int(spent + spent / elapsed * self._window())
+
+    @property
+    def warning(self):
+        """
+            Quota is exhausted or is going to run out before the end of the stream
+        """
+        return self.exhausted or self.projected() > self.daily_units * QUOTA_WARNING_RATIO
+
+    def status(self):
+        """
+        :return: status frame note, see Channel.status_note
+        """
+        return QUOTA_STATUS.format(self.total_spent, self.daily_units, self.projected()), self.warning
+
+    def _check_projection(self):
+        if self.warned or not self.notify:
+            return
+        projected = self.projected()
+        if projected > self.daily_units * QUOTA_WARNING_RATIO:
+            self.warned = True
+            self.notify(QUOTA_WARNING.format(projected, self.daily_units))
+
+    def json(self):
+        return {
+            'daily_units': self.daily_units,
+            'spent': self.total_spent,
+            'spent_by_call': dict(self.spent),
+            'projected': self.projected(),
+            'readers': len(self.readers),
+            'exhausted': self.exhausted,
+            'reset_in': int(self.seconds_to_reset())
+        }
+
+
 class YTMessage(TextMessage):
     def __init__(self, message, **kwargs):
         text = message['snippet']['displayMessage']
 
-        super().__init__(text=text, platform_id='yt', icon=ICON, **kwargs)
+        super().__init__(text=text, platform_id=SOURCE, icon=ICON, **kwargs)
+        self.segments = build_segments(text)
 
 
 class YTSystemMessage(SystemMessage):
     def __init__(self, text, category='system', **kwargs):
-        super().__init__(text, category, platform_id='yt', icon=ICON, user='YouTube', **kwargs)
+        super().__init__(text, category, platform_id=SOURCE, icon=ICON, user=SYSTEM_USER, **kwargs)
+
+
+class AuthorCache(object):
+    def __init__(self, size=AUTHOR_CACHE_SIZE, ttl=AUTHOR_CACHE_TTL):
+        """
+            LRU of author channel id to display name, names expire after ttl seconds
+        """
+        self.size = size
+        self.ttl = ttl
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, channel_id):
+        with self._lock:
+            item = self._names.get(channel_id)
+            if item is None:
+                return None
+            if time.monotonic() - item[1] > self.ttl:
+                del self._names[channel_id]
+                return None
+            self._names.move_to_end(channel_id)
+            return item[0]
+
+    def set(self, channel_id, name):
+        with self._lock:
+            self._names[channel_id] = (name, time.monotonic())
+            self._names.move_to_end(channel_id)
+            while len(self._names) > self.size:
+                self._names.popitem(last=False)
 
 
 class YTReader(threading.Thread):
-    def __init__(self, api, live_id, channel, queue, channel_module):
+    def __init__(self, api, live_id, channel, queue, channel_module, authors):
+        """
+        :type api: QuotaScheduler
+        """
         self.api = api
         self.live_id = live_id
         self.token = None
         self.channel = channel
         self.queue = queue
         self.c_module = channel_module
+        self.authors = authors
+        self.stopped = threading.Event()
 
         super().__init__(daemon=True)
 
-    def run(self):
-        while True:
-            snippet = self.api.get('liveChat/messages', liveChatId=self.live_id, part='snippet', pageToken=self.token)
-            self.process_message(snippet['items'])
-            self.token = snippet['nextPageToken']
-
-            v_req = self.api.get('videos', id=self.channel, part='liveStreamingDetails')
-            self.c_module.viewers = v_req['items'][0]['liveStreamingDetails']['concurrentViewers']
+    def stop(self):
+        self.stopped.set()
 
-            sleep_time = snippet['pollingIntervalMillis']/1000.00
-            log.debug(f'sleeping for {sleep_time}s')
-            time.sleep(sleep_time)
+    def run(self):
+        self.api.add_reader(self)
+        try:
+            while self.c_module.status != CHANNEL_DISABLED:
+                wait_time = self.api.wait_time()
+                if wait_time:
+                    log.info(f'YouTube quota is exhausted, waiting {wait_time:.0f}s')
+                    # Waiting reader doesn't take share of the budget from polling ones
+                    self.api.remove_reader(self)
+                    if self.stopped.wait(wait_time):
+                        break
+                    self.api.add_reader(self)
+                    continue
+
+                try:
+                    snippet = self.api.get('liveChat/messages', liveChatId=self.live_id,
+                                           part='snippet,authorDetails', pageToken=self.token)
+                except QuotaExceededError as exc:
+                    log.warning(f'YouTube quota exceeded: {exc}')
+                    continue
+
+                self.token = snippet['nextPageToken']
+                self.process_message(snippet['items'], time.perf_counter())
+
+                sleep_time = self.api.interval(self, snippet['pollingIntervalMillis']/1000.00, snippet['items'])
+                log.debug(f'sleeping for {sleep_time}s')
+                if self.stopped.wait(sleep_time):
+                    break
+        finally:
+            self.api.remove_reader(self)
 
-    def process_message(self, messages):
-        users_to_get = [message['snippet']['authorChannelId'] for message in messages]
+    def process_message(self, messages, received=None):
         users = {}
+        for message in messages:
+            author_id = message['snippet']['authorChannelId']
+            name = message.get('authorDetails', {}).get('displayName')
+            if name:
+                self.authors.set(author_id, name)
+            else:
+                name = self.authors.get(author_id)
+            if name:
+                users[author_id] = name
 
+        # Only authors missing in both message and cache are requested
+        users_to_get = list({message['snippet']['authorChannelId'] for message in messages} - users.keys())
         for val in range(0, len(users_to_get), MAX_RESULTS):
-            users_req = self.api.get('channels', id=','.join(users_to_get[val:val+MAX_RESULTS]), maxResults=MAX_RESULTS)
-            users.update({user['id']: user['snippet']['title'] for user in users_req['items']})
+            try:
+                users_req = self.api.get('channels', id=','.join(users_to_get[val:val+MAX_RESULTS]),
+                                         part='snippet', maxResults=MAX_RESULTS)
+            except QuotaExceededError as exc:
+                # Messages are still sent, with authors that are already known
+                log.warning(f'Unable to get authors, YouTube quota exceeded: {exc}')
+                break
+            for user in users_req['items']:
+                users[user['id']] = user['snippet']['title']
+                self.authors.set(user['id'], user['snippet']['title'])
 
         for message in messages:
             user = users.get(message['snippet']['authorChannelId'])
             if not user:
-                log.info('asd')
-            chat_msg = YTMessage(message, user=user, mid=message['id'])
-            self.queue.put(chat_msg)
+                log.info('Unable to find author of message %s', message['id'])
+            chat_msg = YTMessage(message, user=user, mid=message['id'], received=received)
+            self.c_module.put_message(chat_msg)
 
 
 class YTChannel(threading.Thread, Channel):
@@ -136,7 +416,7 @@ class YTChannel(threading.Thread, Channel):
         self.live_id = None
 
         threading.Thread.__init__(self, daemon=True)
-        Channel.__init__(self, chat, cqueue)
+        Channel.__init__(self, chat, cqueue, icon=ICON, platform_id=SOURCE, system_user=SYSTEM_USER)
 
     def run(self):
         try_count = 0
@@ -150,9 +430,13 @@ class YTChannel(threading.Thread, Channel):
                 log.info("Connecting, try %s", try_count)
                 self._status = CHANNEL_PENDING
                 if self.load_config():
-                    self.reader = YTReader(self.chat_module.api, self.live_id, self.channel, self.queue, self)
+                    self.reader = YTReader(self.chat_module.quota, self.live_id, self.channel, self.queue, self,
+                                           self.chat_module.authors)
 
                     self._status = CHANNEL_ONLINE
+                    supervisor.connected(self)
+                    viewers_scheduler.register(self, self.get_viewers, platform=SOURCE,
+                                               min_interval=VIEWERS_MIN_INTERVAL)
                     self.reader.run()
                     log.info("Connection closed")
                 self._status = CHANNEL_OFFLINE
@@ -163,11 +447,12 @@ class YTChannel(threading.Thread, Channel):
                 break
             except Exception as exc:
                 log.exception(exc)
-            time.sleep(5)
+            if not supervisor.wait(self):
+                break
 
     def load_config(self):
         try:
-            video = self.chat_module.api.get('videos', id=self.channel, part='liveStreamingDetails')
+            video = self.chat_module.quota.get('videos', id=self.channel, part='liveStreamingDetails')
             details = video['items'][0]['liveStreamingDetails']
             if 'activeLiveChatId' in details:
                 self.live_id = details['activeLiveChatId']
@@ -180,10 +465,23 @@ class YTChannel(threading.Thread, Channel):
 
         return True
 
+    def get_viewers(self):
+        if self.chat_module.quota.exhausted:
+            return None
+        video = self.chat_module.quota.get('videos', id=self.channel, part='liveStreamingDetails')
+        return video['items'][0]['liveStreamingDetails'].get('concurrentViewers', NO_VIEWERS)
+
+    @property
+    def status_note(self):
+        return self.chat_module.quota.status()
+
     def stop(self):
         try:
             self._status = CHANNEL_DISABLED
-            del self.reader
+            supervisor.unregister(self)
+            viewers_scheduler.unregister(self)
+            if self.reader:
+                self.reader.stop()
         except Exception as exc:
             pass
 
@@ -196,8 +494,14 @@ class CYoutube(ChatModule):
 
         self.api = None
         self.api_functioning = False
+        # Author names are shared by all channels, regulars are rarely requested again
+        self.authors = AuthorCache()
+        self.quota = QuotaScheduler(lambda: self.api, self.get_config('quota', 'daily_units').simple(),
+                                    self.get_config('quota', 'stream_hours').simple(),
+                                    notify=self.quota_message)
 
         self.rest_add('GET', 'oauth', self.parse_oauth_request)
+        self.rest_add('GET', 'quota', self.rest_get_quota)
 
     def load_module(self, *args, **kwargs):
         self.api = API(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, api_key='')
@@ -253,5 +557,13 @@ class CYoutube(ChatModule):
         self.update_tokens(ret_data)
         return 'Token Requested successfully'
 
+    def quota_message(self, text):
+        log.warning(text)
+        for channel in list(self.channels.values()):
+            channel.put_system_message(text)
+
+    def rest_get_quota(self, *args, **kwargs):
+        return json.dumps(self.quota.json())
+
     def api_call(self, key):
         pass
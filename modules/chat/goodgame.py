@@ -1,6 +1,8 @@
 # This Python file uses the following encoding: utf-8
 # -*- coding: utf-8 -*-
 # Copyright (C) 2016   CzT/Vladislav Ivanov
+import bisect
+import functools
 import queue
 import json
 import logging
@@ -11,15 +13,18 @@ import string
 import threading
 import time
 
-import requests
 from ws4py.client.threadedclient import WebSocketClient
 
 from modules.gui import MODULE_KEY
-from modules.helper.message import TextMessage, SystemMessage, RemoveMessageByIDs
+from modules.helper.catalog import Catalog, CatalogView
+from modules.helper.http_client import client
+from modules.helper.message import TextMessage, SystemMessage, RemoveMessageByIDs, build_segments, emote_segment
 from modules.helper.module import ChatModule, Channel, CHANNEL_ONLINE, CHANNEL_PENDING, CHANNEL_OFFLINE, \
     CHANNEL_DISABLED
-from modules.helper.system import translate_key, EMOTE_FORMAT, NO_VIEWERS
-from modules.interface.types import LCStaticBox, LCPanel, LCBool, LCText
+from modules.helper.supervisor import supervisor
+from modules.helper.system import translate_key, NO_VIEWERS
+from modules.helper.viewers import viewers_scheduler
+from modules.interface.types import LCStaticBox, LCPanel, LCBool, LCText, LCSpin
 
 logging.getLogger('requests').setLevel(logging.ERROR)
 logging.getLogger('urllib3').setLevel(logging.ERROR)
@@ -39,14 +44,23 @@ CONF_DICT['config']['socket'] = LCText('wss://chat.goodgame.ru/chat/websocket')
 CONF_DICT['config']['show_channel_names'] = LCBool(False)
 CONF_DICT['config']['use_channel_id'] = LCBool(False)
 CONF_DICT['config']['check_viewers'] = LCBool(True)
-SMILE_REGEXP = r':(\w+|\d+):'
-SMILE_FORMAT = ':{}:'
+CONF_DICT['config']['channels_per_connection'] = LCSpin(1, min_v=1, max_v=100)
+SMILE_PATTERN = re.compile(r':(\w+|\d+):')
+GLOBAL_SMILE_CHANNELS = (0, 10603)
+RIGHTS_GLOBAL_SMILES = 20
+RIGHTS_ALL_SMILES = 40
+ENTITLEMENT_CACHE_SIZE = 256
+SMILES_KEY = 'smiles'
+HEARTBEAT_FREQ = 30
+
+# Smiles are the same for every channel
+CATALOG = Catalog('goodgame')
 
 CONF_GUI = {
     'config': {
         'hidden': ['socket'],
     },
-    'non_dynamic': ['config.socket']
+    'non_dynamic': ['config.socket', 'config.channels_per_connection']
 }
 
 CONNECTION_SUCCESS = translate_key(MODULE_KEY.join(['goodgame', 'connection_success']))
@@ -61,47 +75,113 @@ MESSAGE_BAN_PERM = translate_key(MODULE_KEY.join(['goodgame', 'ban_permanent']))
 MESSAGE_UNBAN = translate_key(MODULE_KEY.join(['goodgame', 'unban']))
 
 
+class SmileIndex(object):
+    def __init__(self, smiles):
+        """
+            GoodGame smiles split by channel and donation tier,
+              set of smiles available to a user depends only on entitlement key
+              and is cached for recent keys
+        :param smiles: smiles list from smiles API
+        """
+        self.source = smiles
+        self.smiles = {smile['key']: smile for smile in smiles}
+        self.by_channel = {}
+        for smile in self.smiles.values():
+            self.by_channel.setdefault(smile['channel_id'], []).append(smile)
+        self.global_smiles = [smile for channel_id in GLOBAL_SMILE_CHANNELS
+                              for smile in self.by_channel.get(channel_id, [])]
+        self.donat_tiers = sorted({smile['donat'] for smile in self.global_smiles})
+        self.allowed = functools.lru_cache(maxsize=ENTITLEMENT_CACHE_SIZE)(self._allowed)
+
+    def __contains__(self, item):
+        return item in self.smiles
+
+    def __len__(self):
+        return len(self.smiles)
+
+    def entitlement(self, rights, premium, prems, payments):
+        if rights >= RIGHTS_ALL_SMILES:
+            rights_bucket = RIGHTS_ALL_SMILES
+        elif rights >= RIGHTS_GLOBAL_SMILES:
+            rights_bucket = RIGHTS_GLOBAL_SMILES
+        else:
+            rights_bucket = 0
+        # Users with different payments see the same smiles until they reach next donation tier
+        tier_index = bisect.bisect_right(self.donat_tiers, int(payments))
+        payments_tier = self.donat_tiers[tier_index - 1] if tier_index else 0
+        return rights_bucket, bool(premium), payments_tier, frozenset(prems)
+
+    def _allowed(self, entitlement):
+        """
+        :return: url of every smile available with entitlement
+        """
+        rights, premium, payments, prems = entitlement
+        if rights >= RIGHTS_ALL_SMILES:
+            allowed = list(self.smiles.values())
+        elif rights >= RIGHTS_GLOBAL_SMILES:
+            allowed = list(self.global_smiles)
+        else:
+            allowed = [smile for smile in self.global_smiles
+                       if (premium if smile['premium'] else smile['donat'] <= payments)]
+        allowed.extend(smile for channel_id in prems for smile in self.by_channel.get(channel_id, [])
+                       if smile['premium'])
+
+        urls = {}
+        for smile in allowed:
+            gif = smile['premium'] and smile['channel_id'] in prems and smile['images']['gif']
+            urls[smile['key']] = gif or smile['images']['big']
+        return urls
+
+
+def load_smiles():
+    request = client.get_cached(SMILE_API)
+    if not request.ok:
+        raise IndexError(f'URL Error {request.reason}')
+    return request.json()
+
+
+def smile_index(smiles):
+    """
+        Index of the currently loaded smiles set, shared by all channels
+          and rebuilt only when catalog replaces the set
+    :type smiles: CatalogView
+    """
+    global _smile_index
+    if _smile_index.source is not smiles.data:
+        _smile_index = SmileIndex(smiles.data)
+    return _smile_index
+
+
+_smile_index = SmileIndex([])
+
+
 class GoodgameTextMessage(TextMessage):
-    def __init__(self, text, user, mid=None):
+    def __init__(self, text, user, mid=None, received=None):
         TextMessage.__init__(self, platform_id=SOURCE, icon=SOURCE_ICON,
-                             user=user, text=text, mid=mid)
+                             user=user, text=text, mid=mid, received=received)
 
     def process_smiles(self, smiles, rights, premium, prems, payments):
-        smiles_array = set([item[1:-1] for item in self._text.split() if re.match(SMILE_REGEXP, item)])
-        for smile in smiles_array:
-            if smile not in smiles:
-                continue
-
-            smile_info = smiles.get(smile)
-            allow = False
-            gif = False
-            if rights >= 40:
-                allow = True
-            elif rights >= 20 \
-                    and (smile_info['channel_id'] == 0 or smile_info['channel_id'] == 10603):
-                allow = True
-            elif smile_info['channel_id'] == 0 or smile_info['channel_id'] == 10603:
-                if not smile_info['premium']:
-                    if smile_info['donat'] == 0:
-                        allow = True
-                    elif smile_info['donat'] <= int(payments):
-                        allow = True
-                else:
-                    if premium:
-                        allow = True
-
-            for premium_item in prems:
-                if smile_info['channel_id'] == premium_item:
-                    if smile_info['premium']:
-                        allow = True
-                        gif = True
-
-            if allow:
-                self._text = self._text.replace(SMILE_FORMAT.format(smile), EMOTE_FORMAT.format(smile))
-                url = smile_info['images']['big']
-                if gif and smile_info['images']['gif']:
-                    url = smile_info['images']['gif']
+        """
+        :type smiles: SmileIndex
+        """
+        allowed = smiles.allowed(smiles.entitlement(rights, premium, prems, payments)) if smiles else {}
+        added = set()
+
+        def match_word(word):
+            smile_match = SMILE_PATTERN.fullmatch(word)
+            if not smile_match:
+                return None
+
+            smile = smile_match.group(1)
+            url = allowed.get(smile)
+            if not url:
+                return None
+            if smile not in added:
                 self.add_emote(smile, url)
+                added.add(smile)
+            return emote_segment(smile)
+
+        self.segments = build_segments(self._text, match_word)
 
 
 class GoodgameMessageHandler(threading.Thread):
@@ -119,12 +199,21 @@ class GoodgameMessageHandler(threading.Thread):
 
     def run(self):
         while True:
-            self.process_message(self.gg_queue.get())
+            item = self.gg_queue.get()
+            if item is None:
+                break
+            self.process_message(*item)
+
+    def stop(self):
+        """
+            Handler exits after already queued messages are processed
+        """
+        self.gg_queue.put(None)
 
-    def process_message(self, msg):
+    def process_message(self, msg, received=None):
         message_type = msg['type']
         if message_type == "message":
-            self._process_message(msg)
+            self._process_message(msg, received)
         elif message_type == 'success_join':
             self._process_join()
         elif message_type == 'error':
@@ -138,16 +227,17 @@ class GoodgameMessageHandler(threading.Thread):
         elif message_type == 'channel_counters':
             self._process_channel_counters()
 
-    def _process_message(self, msg):
+    def _process_message(self, msg, received=None):
         # Getting all needed data from received message
         # and sending it to queue for further message handling
         message = GoodgameTextMessage(
             msg['data']['text'],
             msg['data']['user_name'],
-            mid=ID_PREFIX.format(msg['data']['message_id'])
+            mid=ID_PREFIX.format(msg['data']['message_id']),
+            received=received
         )
         message.process_smiles(
-            self.smiles,
+            smile_index(self.smiles),
             msg['data'].get('user_rights', 0),
             msg['data'].get('premium', 1),
             msg['data'].get('premiums', []),
@@ -165,7 +255,10 @@ class GoodgameMessageHandler(threading.Thread):
     def _process_error(self, msg):
         log.info("Received error message: %s", msg)
         if msg['data']['errorMsg'] == 'Invalid channel id':
-            self.ws_class.close(reason='INV_CH_ID')
+            if self.ws_class:
+                self.ws_class.close(reason='INV_CH_ID')
+            else:
+                self.channel_class.stop()
             log.error("Failed to find channel on GoodGame, please check channel name")
 
     def _process_user_warn(self, msg):
@@ -193,10 +286,7 @@ class GoodgameMessageHandler(threading.Thread):
                     msg['data']['user_name']))
 
     def _process_channel_counters(self):
-        try:
-            self.channel_class.viewers = self.channel_class.get_viewers()
-        except Exception as exc:
-            log.exception(exc)
+        viewers_scheduler.refresh(self.channel_class)
 
     def _post_process_multiple_channels(self, message):
         if self.chat_module.get_config('config', 'show_channel_names'):
@@ -228,10 +318,8 @@ class GGChat(WebSocketClient):
         success_msg = "Connection Successful"
         log.info(success_msg)
         self.channel_class.status = CHANNEL_ONLINE
-        try:
-            self.channel_class.viewers = self.channel_class.get_viewers()
-        except Exception as exc:
-            log.exception(exc)
+        supervisor.connected(self.channel_class)
+        viewers_scheduler.register(self.channel_class, self.channel_class.get_viewers, platform=SOURCE)
         self.channel_class.put_system_message(CONNECTION_SUCCESS.format(self.channel_class.nick))
         # Sending join channel command to goodgame websocket
         join = json.dumps({'type': "join", 'data': {'channel_id': self.ch_id, 'hidden': "true"}}, sort_keys=False)
@@ -250,21 +338,156 @@ class GGChat(WebSocketClient):
         """
         log.info("Connection Closed Down")
         self.channel_class.status = CHANNEL_OFFLINE
+        # Reconnect creates a new socket with its own handler
+        self.message_handler.stop()
         if code in [4000, 4001]:
             self.crit_error = True
             self.channel_class.put_system_message(CONNECTION_CLOSED.format(self.channel_class.nick))
         else:
             self.channel_class.put_system_message(CONNECTION_DIED.format(self.channel_class.nick))
-            timer = threading.Timer(5.0, self.channel_class.connect)
-            timer.start()
+            supervisor.disconnected(self.channel_class, f'Code {code}: {reason}')
+            supervisor.schedule(self.channel_class, self.channel_class.connect)
 
     def received_message(self, mes):
+        received = time.perf_counter()
         # Deserialize message to json for easier parsing
-        self.gg_queue.put(json.loads(str(mes)))
+        self.gg_queue.put((json.loads(str(mes)), received))
+
+
+class PooledGGSocket(WebSocketClient):
+    def __init__(self, address, connection):
+        super(self.__class__, self).__init__(address, heartbeat_freq=HEARTBEAT_FREQ, protocols=['websocket'])
+        self.connection = connection
+
+    def opened(self):
+        self.connection.on_opened()
+
+    def closed(self, code, reason=None):
+        self.connection.on_closed(code, reason)
+
+    def received_message(self, mes):
+        self.connection.route(json.loads(str(mes)), time.perf_counter())
+
+
+class PooledGGConnection(threading.Thread):
+    def __init__(self, address):
+        """
+            One GoodGame websocket joined to several channels,
+              frames are routed to channel message handlers by channel_id
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.address = address
+        self.channels = {}
+        self.ws = None
+        self.connected = False
+        self.closing = False
+        self._lock = threading.Lock()
+
+    def add_channel(self, channel_class):
+        with self._lock:
+            self.channels[str(channel_class.ch_id)] = channel_class
+            if self.connected:
+                self._join(channel_class)
+        if not self.is_alive():
+            self.start()
+
+    def remove_channel(self, channel_class):
+        with self._lock:
+            removed = self.channels.pop(str(channel_class.ch_id), None)
+            # Channel is no longer routed, so on_closed won't report it
+            if removed and self.connected:
+                channel_class.status = CHANNEL_OFFLINE
+                channel_class.put_system_message(CONNECTION_CLOSED.format(channel_class.nick))
+            if not self.channels:
+                self.closing = True
+                supervisor.unregister(self)
+                if self.connected:
+                    self.ws.close(4000)
+            elif self.connected:
+                self.send('unjoin', {'channel_id': channel_class.ch_id})
+
+    def send(self, message_type, data):
+        self.ws.send(json.dumps({'type': message_type, 'data': data}))
+
+    def run(self):
+        while not self.closing:
+            self.ws = PooledGGSocket(self.address, self)
+            try:
+                with supervisor.attempt(self):
+                    self.ws.connect()
+                self.ws.run_forever()
+            except Exception as exc:
+                log.exception(exc)
+            if self.closing or not supervisor.wait(self):
+                break
+        supervisor.unregister(self)
+
+    def _join(self, channel_class):
+        channel_class.status = CHANNEL_ONLINE
+        supervisor.connected(channel_class)
+        viewers_scheduler.register(channel_class, channel_class.get_viewers, platform=SOURCE)
+        channel_class.put_system_message(CONNECTION_SUCCESS.format(channel_class.nick))
+        self.send('join', {'channel_id': channel_class.ch_id, 'hidden': 'true'})
+
+    def on_opened(self):
+        log.info("Pooled connection successful, joining %s channels", len(self.channels))
+        supervisor.connected(self)
+        with self._lock:
+            self.connected = True
+            for channel_class in list(self.channels.values()):
+                self._join(channel_class)
+
+    def on_closed(self, code, reason=None):
+        log.info("Pooled connection closed down")
+        with self._lock:
+            self.connected = False
+            for channel_class in list(self.channels.values()):
+                channel_class.status = CHANNEL_OFFLINE
+                if self.closing:
+                    channel_class.put_system_message(CONNECTION_CLOSED.format(channel_class.nick))
+                else:
+                    channel_class.put_system_message(CONNECTION_DIED.format(channel_class.nick))
+                    supervisor.disconnected(channel_class, f'Code {code}: {reason}')
+
+    def route(self, message, received):
+        data = message.get('data')
+        channel_id = data.get('channel_id') if isinstance(data, dict) else None
+        channel_class = self.channels.get(str(channel_id))
+        if channel_class and channel_class.message_handler:
+            channel_class.message_handler.gg_queue.put((message, received))
+        elif message['type'] == 'error':
+            log.info("Received error message: %s", message)
+
+
+class GGConnectionPool(object):
+    def __init__(self, address, channels_per_connection):
+        """
+            Spreads goodgame channels over as few websockets as possible
+        """
+        self.address = address
+        self.channels_per_connection = channels_per_connection
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def add(self, channel_class):
+        with self._lock:
+            self.connections = [item for item in self.connections if not item.closing]
+            connection = next((item for item in self.connections
+                               if len(item.channels) < self.channels_per_connection), None)
+            if connection is None:
+                connection = PooledGGConnection(self.address)
+                self.connections.append(connection)
+            connection.add_channel(channel_class)
+
+    def remove(self, channel_class):
+        with self._lock:
+            for connection in self.connections:
+                if str(channel_class.ch_id) in connection.channels:
+                    connection.remove_channel(channel_class)
 
 
 class GGChannel(threading.Thread, Channel):
-    def __init__(self, queue, address, nick, use_chid, chat_module=None, **kwargs):
+    def __init__(self, queue, address, nick, use_chid, chat_module=None, pool=None, **kwargs):
         threading.Thread.__init__(self)
         Channel.__init__(self, nick, queue, icon=SOURCE_ICON, platform_id=SOURCE, system_user=SYSTEM_USER)
 
@@ -282,35 +505,28 @@ class GGChannel(threading.Thread, Channel):
             self.ch_id = None
         self.kwargs = kwargs
         self.ws = None
+        self.pool = pool
+        self.message_handler = None
 
-        self.smiles = {}
+        self.smiles = CatalogView(CATALOG, SMILES_KEY)
 
     def load_config(self):
         try:
             if self.ch_id:
-                request = requests.get(API.format(f'streams/{self.ch_id}'))
+                request = client.get(API.format(f'streams/{self.ch_id}'))
                 if request.status_code == 200:
                     channel_name = request.json()['channel']['key']
                     if self.nick != channel_name:
                         self.nick = channel_name
             else:
-                request = requests.get(API.format(f'streams/{self.nick}'))
+                request = client.get(API.format(f'streams/{self.nick}'))
                 if request.status_code == 200:
                     self.ch_id = request.json()['channel']['id']
         except Exception as exc:
             log.warning("Unable to get channel name, error %s\nArgs: %s", exc, exc.args)
 
-        try:
-            smile_request = requests.get(SMILE_API)
-            if not smile_request.ok:
-                raise IndexError(f'URL Error {smile_request.reason}')
-
-            req_json = smile_request.json()
-            for smile in req_json:
-                self.smiles[smile['key']] = smile
-        except Exception as exc:
-            log.error("Unable to download smiles, error %s\nArgs: %s", exc, exc.args)
-
+        # Smiles are downloaded once for all channels and refreshed by catalog
+        CATALOG.register(SMILES_KEY, load_smiles, owner=self)
         return True
 
     def get_viewers(self):
@@ -318,7 +534,7 @@ class GGChannel(threading.Thread, Channel):
             return NO_VIEWERS
         streams_url = API.format(f'streams/{self.nick}')
         try:
-            request = requests.get(streams_url)
+            request = client.get(streams_url)
             if request.ok:
                 json_data = request.json()
                 if json_data['status'] == 'Live':
@@ -344,23 +560,47 @@ class GGChannel(threading.Thread, Channel):
             log.info("Connecting, try %s", try_count)
             self._status = CHANNEL_PENDING
             if self.load_config():
-                # Connecting to goodgame websocket
-                self.ws = GGChat(self.address, protocols=['websocket'], queue=self.queue,
-                                 ch_id=self.ch_id, nick=self.nick, smiles=self.smiles,
-                                 heartbeat_freq=30, channel_class=self, chat_module=self.chat_module,
-                                 **self.kwargs)
-                try:
-                    self.ws.connect()
-                    self.ws.run_forever()
-                    log.debug("Connection closed")
-                    break
-                except Exception as exc:
-                    log.exception(exc)
-            time.sleep(5)
+                if self.pool:
+                    # Pooled connection needs channel id to route messages
+                    if self.ch_id:
+                        self.join_pool()
+                        break
+                else:
+                    # Connecting to goodgame websocket
+                    self.ws = GGChat(self.address, protocols=['websocket'], queue=self.queue,
+                                     ch_id=self.ch_id, nick=self.nick, smiles=self.smiles,
+                                     heartbeat_freq=HEARTBEAT_FREQ, channel_class=self,
+                                     chat_module=self.chat_module, **self.kwargs)
+                    try:
+                        with supervisor.attempt(self):
+                            self.ws.connect()
+                        self.ws.run_forever()
+                        log.debug("Connection closed")
+                        break
+                    except Exception as exc:
+                        log.exception(exc)
+            if not supervisor.wait(self):
+                break
+
+    def join_pool(self):
+        # Pooled connection owns the socket, channel only keeps its own message handler
+        self.message_handler = GoodgameMessageHandler(None, gg_queue=queue.Queue(), nick=self.nick,
+                                                      smiles=self.smiles, channel_class=self,
+                                                      chat_module=self.chat_module, **self.kwargs)
+        self.message_handler.start()
+        self.pool.add(self)
 
     def stop(self):
         self._status = CHANNEL_DISABLED
-        self.ws.close(4000)
+        supervisor.unregister(self)
+        viewers_scheduler.unregister(self)
+        CATALOG.unregister(SMILES_KEY, owner=self)
+        if self.pool:
+            self.pool.remove(self)
+            if self.message_handler:
+                self.message_handler.stop()
+        else:
+            self.ws.close(4000)
 
 
 def gg_message(nickname, text):
@@ -385,12 +625,17 @@ class GoodGame(ChatModule):
 
         self.host = CONF_DICT['config']['socket']
 
+        self.pool = None
+        channels_per_connection = self.get_config('config', 'channels_per_connection').simple()
+        if channels_per_connection > 1:
+            self.pool = GGConnectionPool(str(self.host), channels_per_connection)
+
     def load_module(self, *args, **kwargs):
         ChatModule.load_module(self, *args, **kwargs)
 
     def _add_channel(self, chat):
         gg = GGChannel(self.queue, self.host, chat,
                        self.get_config('config', 'use_channel_id'),
-                       settings=self._conf_params['settings'], chat_module=self)
+                       settings=self._conf_params['settings'], chat_module=self, pool=self.pool)
         self.channels[chat] = gg
         gg.start()
@@ -7,15 +7,21 @@ import re
 import string
 import threading
 import time
+from collections import deque, OrderedDict
 
 import requests
 from ws4py.client.threadedclient import WebSocketClient
 
 from modules.gui import MODULE_KEY
-from modules.helper.message import TextMessage, SystemMessage, Emote
+from modules.helper.http_client import client
+from modules.helper.message import TextMessage, SystemMessage, Emote, build_segments, emote_segment, mention_segment
 from modules.helper.module import ChatModule, Channel, CHANNEL_ONLINE, CHANNEL_NO_VIEWERS, CHANNEL_OFFLINE, \
     CHANNEL_DISABLED
-from modules.helper.system import translate_key, EMOTE_FORMAT
+from modules.helper.socketio import decode_frame, encode_packet, SocketIOError, ENGINE_OPEN, ENGINE_MESSAGE, \
+    SOCKET_EVENT, SOCKET_ACK
+from modules.helper.supervisor import supervisor
+from modules.helper.system import translate_key
+from modules.helper.viewers import viewers_scheduler
 from modules.interface.types import LCStaticBox, LCPanel, LCBool, LCText
 
 logging.getLogger('requests').setLevel(logging.ERROR)
@@ -25,11 +31,12 @@ SOURCE = 'fs'
 SOURCE_ICON = 'https://sc2tv.ru/favicon-32x32.png'
 FILE_ICON = os.path.join('img', 'fs.png')
 SYSTEM_USER = 'Peka2.tv'
-SMILE_REGEXP = r':(\w+|\d+):'
-SMILE_FORMAT = ':{}:'
+SMILE_PATTERN = re.compile(r':(\w+|\d+):')
 API_URL = 'https://sc2tv.ru/api{}'
 
 PING_DELAY = 25
+DUPLICATES_BUFFER = 20
+PENDING_ACKS = 20
 
 CONF_DICT = LCPanel(icon=FILE_ICON)
 CONF_DICT['config'] = LCStaticBox()
@@ -55,38 +62,68 @@ class Peka2TVAPIError(Exception):
     pass
 
 
-def allow_smile(smile, subscriptions, allow=False):
-    if smile['user']:
-        channel_id = smile['user']['id']
-        for sub in subscriptions:
-            if sub == channel_id:
-                allow = True
-    else:
-        allow = True
-    return allow
+def allow_smile(smile, subscriptions):
+    """
+    :param subscriptions: set of channel ids user is subscribed to
+    """
+    return not smile['user'] or smile['user']['id'] in subscriptions
+
+
+class RecentIds(object):
+    def __init__(self, size):
+        """
+            Remembers last size ids for duplicate checks
+        """
+        self._order = deque(maxlen=size)
+        self._ids = set()
+
+    def add(self, item):
+        """
+        :return: False if id was already seen
+        """
+        if item in self._ids:
+            return False
+        if len(self._order) == self._order.maxlen:
+            self._ids.discard(self._order[0])
+        self._order.append(item)
+        self._ids.add(item)
+        return True
 
 
 class FsChatMessage(TextMessage):
-    def __init__(self, user, text, subscr):
+    def __init__(self, user, text, subscr, received=None):
         self._user = user
         self._text = text
-        self._subscriptions = subscr
+        self._subscriptions = set(subscr)
 
         TextMessage.__init__(self, platform_id=SOURCE, icon=SOURCE_ICON,
-                             user=self.user, text=self.text)
+                             user=self.user, text=self.text, received=received)
 
     def process_smiles(self, smiles):
-        smiles_array = re.findall(SMILE_REGEXP, self._text)
-        for smile in smiles_array:
-            for smile_find in smiles:
-                if smile_find['code'] == smile.lower():
-                    if allow_smile(smile_find, self._subscriptions):
-                        self._text = self._text.replace(SMILE_FORMAT.format(smile),
-                                                        EMOTE_FORMAT.format(smile))
-                        self._emotes.append(Emote(smile, smile_find['url']))
+        """
+        :param smiles: smiles by code
+        """
+        segments = []
+        added = set()
+        position = 0
+        for smile_match in SMILE_PATTERN.finditer(self._text):
+            smile = smile_match.group(1)
+            smile_find = smiles.get(smile.lower())
+            if not smile_find or not allow_smile(smile_find, self._subscriptions):
+                continue
+
+            segments += build_segments(self._text[position:smile_match.start()])
+            segments.append(emote_segment(smile))
+            if smile not in added:
+                self._emotes.append(Emote(smile, smile_find['url']))
+                added.add(smile)
+            position = smile_match.end()
+        segments += build_segments(self._text[position:])
+        self.segments = segments
 
     def process_pm(self, to_name, channel_name, show_pm):
-        self._text = f'@{to_name},{self.text}'
+        segments = self.segments if self.segments is not None else build_segments(self._text)
+        self.segments = [mention_segment(to_name, f'@{to_name},')] + segments
         if to_name == channel_name:
             if show_pm:
                 self._pm = True
@@ -109,13 +146,16 @@ class FsChat(WebSocketClient):
         self.smiles = kwargs.get('smiles')
 
         self.iter = 0
-        self.duplicates = []
+        self.duplicates = RecentIds(DUPLICATES_BUFFER)
         self.users = []
-        self.request_array = []
-        self.bufferForDup = 20
+        # Paths of sent requests by socket.io id, waiting for ack
+        self.pending_acks = OrderedDict()
 
     def opened(self):
         log.info("Websocket Connection Succesfull")
+        supervisor.connected(self.channel_module)
+        viewers_scheduler.register(self.channel_module, self.channel_module.get_viewers, platform=SOURCE,
+                                   min_interval=PING_DELAY)
         self.fs_system_message(CONNECTION_SUCCESS)
 
     def closed(self, code, reason=None):
@@ -137,34 +177,36 @@ class FsChat(WebSocketClient):
             self.fs_system_message(
                 CONNECTION_DIED.format(self.channel_name),
                 category='connection')
-            timer = threading.Timer(5.0, self.channel_module.connect)
-            timer.start()
+            supervisor.disconnected(self.channel_module, f'Code {code}: {reason}')
+            supervisor.schedule(self.channel_module, self.channel_module.connect)
 
     def fs_system_message(self, message, **kwargs):
         self.channel_module.put_system_message(message, **kwargs)
 
     def received_message(self, mes):
-        mes.data = mes.data.decode('utf-8')
-        if mes.data == '40':
-            return
-        if mes.data in ['2', '3']:
+        received = time.perf_counter()
+        try:
+            packet = decode_frame(mes.data)
+        except (SocketIOError, ValueError) as exc:
+            log.warning('Unable to decode frame: %s', exc)
             return
-        log.debug('received message %s', mes)
-        regex = re.match(r'(\d+)(.*)', mes.data)
-        sio_iter, json_message = regex.groups()
-        if sio_iter == '0':
+        log.debug('received packet %s', packet)
+
+        if packet.engine_type == ENGINE_OPEN:
             self._process_welcome()
-        elif sio_iter[:2] in '42':
-            self._process_websocket_event(json.loads(json_message))
-        elif sio_iter[:2] in '43':
-            self._process_websocket_ack(sio_iter[2:], json.loads(json_message))
+        elif packet.engine_type != ENGINE_MESSAGE:
+            return
+        elif packet.type == SOCKET_EVENT:
+            self._process_websocket_event(packet.data, received)
+        elif packet.type == SOCKET_ACK:
+            self._process_websocket_ack(packet.ack_id, packet.data)
 
     def fs_get_id(self):
         # We get ID from POST request to funstream API, and it hopefuly
         #  answers us the correct ID of the channel we need to connect to
         payload = {'name': self.channel_name}
         try:
-            request = requests.post(API_URL.format("/user"), data=payload, timeout=5)
+            request = client.post(API_URL.format("/user"), data=payload)
             if request.ok:
                 channel_id = json.loads(re.findall('{.*}', request.text)[0])['id']
                 return channel_id
@@ -193,36 +235,28 @@ class FsChat(WebSocketClient):
             log.debug(msg_joining.format(self.channel_id))
 
     def fs_send(self, payload):
-        iter_sio = "42"+str(self.iter)
-
-        self.send(f'{iter_sio}{json.dumps(payload)}')
-        history_item = {
-            'iter': str(self.iter),
-            'payload': payload
-        }
+        self.send(encode_packet(SOCKET_EVENT, payload, ack_id=self.iter))
+        self.pending_acks[self.iter] = payload[0]
         self.iter += 1
-        if len(self.request_array) > 20:
-            del self.request_array[0]
-        self.request_array.append(history_item)
+        if len(self.pending_acks) > PENDING_ACKS:
+            self.pending_acks.popitem(last=False)
 
     def fs_ping(self):
         ping_thread = FsPingThread(self)
         ping_thread.start()
 
-    def _process_websocket_event(self, message):
+    def _process_websocket_event(self, message, received=None):
         event_from, event_dict = message
         if event_from == '/chat/message':
-            self._process_message(event_dict)
+            self._process_message(event_dict, received)
 
     def _process_websocket_ack(self, sio_id, message):
         if isinstance(message, list):
             if len(message) == 1:
                 message = message[0]
-        for item in self.request_array:  # type: dict
-            if item['iter'] == sio_id:
-                item_path = item['payload'][0]
-                self._process_answer(item_path, message)
-                break
+        item_path = self.pending_acks.pop(sio_id, None)
+        if item_path:
+            self._process_answer(item_path, message)
 
     def _process_welcome(self):
         self.fs_join()
@@ -234,20 +268,16 @@ class FsChat(WebSocketClient):
         elif path == '/chat/channel/list':
             self._process_channel_list(message)
 
-    def _process_message(self, message):
-        try:
-            self.duplicates.index(message['id'])
-        except ValueError:
-            msg = FsChatMessage(message['from']['name'], message['text'], message['store']['subscriptions'])
-            msg.process_smiles(self.smiles)
-            if message['to']:
-                msg.process_pm(message['to'].get('name'), self.channel_name,
-                               self.chat_module.get_config('config', 'show_pm'))
-
-            self.duplicates.append(message['id'])
-            if len(self.duplicates) > self.bufferForDup:
-                self.duplicates.pop(0)
-            self._send_message(msg)
+    def _process_message(self, message, received=None):
+        if not self.duplicates.add(message['id']):
+            return
+        msg = FsChatMessage(message['from']['name'], message['text'], message['store']['subscriptions'],
+                            received=received)
+        msg.process_smiles(self.smiles)
+        if message['to']:
+            msg.process_pm(message['to'].get('name'), self.channel_name,
+                           self.chat_module.get_config('config', 'show_pm'))
+        self._send_message(msg)
 
     def _process_joined(self):
         self.channel_module.status = CHANNEL_ONLINE
@@ -262,7 +292,7 @@ class FsChat(WebSocketClient):
 
     def _send_message(self, comp):
         self._post_process_multiple_channels(comp)
-        self.queue.put(comp)
+        self.channel_module.put_message(comp)
 
 
 class FsPingThread(threading.Thread):
@@ -276,7 +306,6 @@ class FsPingThread(threading.Thread):
         while not self.ws.terminated:
             self.ws.channel_module.status = CHANNEL_ONLINE
             self.ws.send("2")
-            self.ws.channel_module.get_viewers()
             time.sleep(PING_DELAY)
 
 
@@ -291,7 +320,7 @@ class FsChannel(threading.Thread, Channel):
         self.daemon = "True"
         self.socket = str(socket)
         self.chat_module = kwargs.get('chat_module')
-        self.smiles = []
+        self.smiles = {}
         self.kwargs = kwargs
 
         self.slug = channel_name
@@ -318,54 +347,55 @@ class FsChannel(threading.Thread, Channel):
                     log.critical("Got critical error, halting")
                     break
                 elif self.ws.channel_id and self.smiles:
-                    self.ws.connect()
+                    with supervisor.attempt(self):
+                        self.ws.connect()
                     self.ws.run_forever()
                     break
-                time.sleep(5)
             except Exception as exc:
                 log.error('Exception occured %s', exc)
+            if not supervisor.wait(self):
+                break
 
     def get_channel_name(self):
         user_payload = {'name': self.slug}
-        user_req = requests.post(API_URL.format('/user'), timeout=5, data=user_payload)
+        user_req = client.post(API_URL.format('/user'), data=user_payload)
         if not user_req.ok:
             user_payload = {'slug': self.slug}
-            user_req = requests.post(API_URL.format('/user'), timeout=5, data=user_payload)
+            user_req = client.post(API_URL.format('/user'), data=user_payload)
             if not user_req.ok:
                 raise AttributeError('Unable to find user %s', self.slug)
 
         self.slug = user_req.json()['slug']
-        channel_req = requests.post(API_URL.format('/stream'), timeout=5, data={'slug': user_req.json()['slug']})
+        channel_req = client.post(API_URL.format('/stream'), data={'slug': user_req.json()['slug']})
         if channel_req.ok:
             r_json = channel_req.json()
             return r_json['owner']['name']
 
     def stop(self):
         self._status = CHANNEL_DISABLED
+        supervisor.unregister(self)
+        viewers_scheduler.unregister(self)
         self.ws.send("11")
         self.ws.close(4000, reason="CLOSE_OK")
 
     def get_viewers(self):
+        # Viewers of live channel are received from websocket in _process_channel_list
         status_data = {'slug': self.slug}
         request = ['/chat/channel/list', {'channel': f'stream/{self.ws.channel_id}'}]
-        try:
-            status_request = requests.post(API_URL.format('/stream'), timeout=10, data=status_data)
-            if status_request.ok:
-                if status_request.json()['online']:
-                    self._status = CHANNEL_ONLINE
-                    self.ws.fs_send(request)
-                else:
-                    self._viewers = CHANNEL_NO_VIEWERS
-        except Exception as exc:
-            log.error("Unable to get viewers. Got error: %s", exc)
+        status_request = client.post(API_URL.format('/stream'), data=status_data)
+        if not status_request.ok:
+            raise AttributeError(f'Unable to get stream status, status code: {status_request.status_code}')
+        if not status_request.json()['online']:
+            return CHANNEL_NO_VIEWERS
+        self._status = CHANNEL_ONLINE
+        self.ws.fs_send(request)
 
     def _get_info(self):
         if not self.smiles:
             try:
-                smiles = requests.post(API_URL.format('/smile'), timeout=5)
+                smiles = client.post(API_URL.format('/smile'))
                 if smiles.ok:
-                    for smile in smiles.json():
-                        self.smiles.append(smile)
+                    self.smiles = {smile['code']: smile for smile in smiles.json()}
             except requests.ConnectionError:
                 log.error("Unable to get smiles")
 
@@ -384,7 +414,7 @@ class Sc2tvMessage(object):
                 u'id': ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
             }
         ]
-        self.data = f'42{json.dumps(message)}'
+        self.data = encode_packet(SOCKET_EVENT, message)
 
 
 class SC2TV(ChatModule):
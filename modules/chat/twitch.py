@@ -1,4 +1,6 @@
 # Copyright (C) 2016   CzT/Vladislav Ivanov
+import bisect
+import functools
 import queue
 import logging.config
 import os
@@ -6,17 +8,24 @@ import random
 import re
 import threading
 import time
+from collections import ChainMap
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 import irc.client
-import requests
 
 from modules.gui import MODULE_KEY
+from modules.helper.catalog import Catalog
+from modules.helper.http_client import client
+from modules.helper.ircv3 import parse_line, parse_emotes
 from modules.helper.message import TextMessage, SystemMessage, Badge, RemoveMessageByUsers, DEFAULT_MESSAGE_TYPE, \
-    SUBSCRIBE_MESSAGE_TYPE, HIGHLIGHT_MESSAGE_TYPE
+    SUBSCRIBE_MESSAGE_TYPE, HIGHLIGHT_MESSAGE_TYPE, build_segments, emote_segment, bit_segment
 from modules.helper.module import ChatModule, Channel, CHANNEL_ONLINE, CHANNEL_OFFLINE, CHANNEL_PENDING, \
     CHANNEL_DISABLED
-from modules.helper.system import translate_key, EMOTE_FORMAT, NO_VIEWERS, get_wx_parent, get_secret
-from modules.interface.types import LCStaticBox, LCPanel, LCText, LCBool, LCButton
+from modules.helper.supervisor import supervisor
+from modules.helper.system import translate_key, NO_VIEWERS, get_wx_parent, get_secret
+from modules.helper.viewers import viewers_scheduler
+from modules.interface.types import LCStaticBox, LCPanel, LCText, LCBool, LCButton, LCSpin
 
 logging.getLogger('irc').setLevel(logging.ERROR)
 logging.getLogger('requests').setLevel(logging.ERROR)
@@ -32,12 +41,23 @@ SOURCE = 'tw'
 SOURCE_ICON = 'https://www.twitch.tv/favicon.ico'
 FILE_ICON = os.path.join('img', 'tw.png')
 SYSTEM_USER = 'Twitch.TV'
-BITS_REGEXP = r'(\D+)(\d+)'
 API_URL = 'https://api.twitch.tv/kraken'
 
 BTTV_URL = 'https://cdn.betterttv.net/emote/{id}/1x'
 
 PING_DELAY = 10
+VIEWERS_MIN_INTERVAL = 10
+VIEWERS_LIVE_MAX_INTERVAL = 60
+VIEWERS_MAX_INTERVAL = 120
+VIEWERS_BATCH_SIZE = 100
+
+REQUEST_TIMEOUT = 10
+BOOTSTRAP_WORKERS = 8
+
+# Emote/badge/bits sets shared by all twitch channels
+CATALOG = Catalog('twitch')
+# Channel bootstrap requests share worker threads
+BOOTSTRAP_POOL = ThreadPoolExecutor(max_workers=BOOTSTRAP_WORKERS, thread_name_prefix='TwitchBootstrap')
 
 
 def register_iodc(event):
@@ -59,13 +79,14 @@ CONF_DICT['config']['bttv'] = LCBool(True)
 CONF_DICT['config']['frankerz'] = LCBool(True)
 CONF_DICT['config']['show_channel_names'] = LCBool(False)
 CONF_DICT['config']['show_nickname_colors'] = LCBool(True)
+CONF_DICT['config']['channels_per_connection'] = LCSpin(1, min_v=1, max_v=100)
 CONF_DICT['config']['register_oidc'] = LCButton(register_iodc)
 
 CONF_GUI = {
     'config': {
         'hidden': ['host', 'port'],
     },
-    'non_dynamic': ['config.host', 'config.port', 'config.bttv'],
+    'non_dynamic': ['config.host', 'config.port', 'config.bttv', 'config.channels_per_connection'],
     'ignored_sections': ['config.register_oidc'],
 }
 
@@ -89,19 +110,136 @@ class TwitchAPIError(Exception):
     """Exception of API"""
 
 
+def _process_badge_versions(badge_config):
+    return {
+        version: {
+            'image': v.get('image_url_4x', v.get('image_url_2x', v.get('image_url_1x')))
+        } for version, v in badge_config['versions'].items()
+    }
+
+
+def load_bttv_smiles():
+    # Getting Better Twitch TV smiles
+    request = client.get_cached("https://api.betterttv.net/2/emotes")
+    if not request.ok:
+        raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+    return {
+        smile['code']: {
+            'key': smile['code'],
+            'url': BTTV_URL.format(id=smile['id'])
+        } for smile in request.json()['emotes']
+    }
+
+
+def load_ffz_smiles(channel_id):
+    # Getting FrankerZ smiles
+    request = client.get_cached(f"https://api.frankerfacez.com/v1/room/id/{channel_id}")
+    if not request.ok:
+        raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+    smiles = {}
+    for set_name, s_set in request.json()['sets'].items():
+        for smile in s_set['emoticons']:
+            urls = smile['urls']
+            url = urls.get('4', urls.get('2', urls.get('1')))
+            smiles[smile['name']] = {
+                'key': smile['name'],
+                'url': f'https:{url}'
+            }
+    return smiles
+
+
+def load_global_badges():
+    # Warning, undocumented, can change a LOT
+    # Getting CUSTOM twitch badges
+    request = client.get_cached("https://badges.twitch.tv/v1/badges/global/display")
+    if not request.ok:
+        raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+    return {badge: _process_badge_versions(badge_config)
+            for badge, badge_config in request.json()['badge_sets'].items()}
+
+
+def load_channel_badges(channel_id):
+    # Warning, undocumented, can change a LOT
+    request = client.get_cached(f"https://badges.twitch.tv/v1/badges/channels/{channel_id}/display")
+    if not request.ok:
+        raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+    return {badge: _process_badge_versions(badge_config)
+            for badge, badge_config in request.json()['badge_sets'].items()}
+
+
+def load_viewers(channel_ids):
+    """
+    :return: viewers of live channels by channel id
+    """
+    request = client.get(f'{API_URL}/streams/', params={'channel': ','.join(map(str, channel_ids)),
+                                                       'limit': VIEWERS_BATCH_SIZE},
+                         headers=headers)
+    if request.status_code != 200:
+        raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+    return {str(stream['channel']['_id']): stream.get('viewers', NO_VIEWERS) for stream in request.json()['streams']}
+
+
+def load_bits(channel_id):
+    request = client.get_cached(f"https://api.twitch.tv/kraken/bits/actions/?channel_id={channel_id}",
+                                headers=headers)
+    if request.status_code != 200:
+        raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+    return {item['prefix'].lower(): item for item in request.json()['actions']}
+
+
+class BitsMatcher(object):
+    def __init__(self, bits):
+        """
+            Cheer matcher compiled from bits actions,
+              single regexp for all prefixes and sorted tiers for bisect lookup
+        :param bits: bits actions by lowercase prefix
+        """
+        self.bits = bits
+        self.tiers = {}
+        for prefix, action in bits.items():
+            tiers = sorted(action['tiers'], key=lambda item: int(item['id']))
+            self.tiers[prefix] = ([int(tier['id']) for tier in tiers], tiers)
+
+        prefixes = sorted(self.tiers, key=len, reverse=True)
+        self.regexp = None
+        if prefixes:
+            self.regexp = re.compile(f"({'|'.join(re.escape(prefix) for prefix in prefixes)})(\\d+)", re.IGNORECASE)
+
+    def match(self, word):
+        """
+        :return: prefix, amount, highest tier reached by amount or None if word is not a cheer
+        """
+        if self.regexp is None:
+            return None
+        reg = self.regexp.fullmatch(word)
+        if not reg:
+            return None
+
+        prefix, amount = reg.group(1).lower(), int(reg.group(2))
+        tier_ids, tiers = self.tiers[prefix]
+        index = bisect.bisect_right(tier_ids, amount) - 1
+        if index < 0:
+            return None
+        return prefix, amount, tiers[index]
+
+
 class TwitchMessage(object):
     def __init__(self, msg):
         self.arguments = msg.arguments
         self.source = msg.source
-        self.tags = {tag['key']: tag['value'] for tag in msg.tags if tag['value']}
+        if isinstance(msg.tags, Mapping):
+            self.tags = msg.tags
+        else:
+            self.tags = {tag['key']: tag['value'] for tag in msg.tags if tag['value']}
         self.type = msg.type
+        self.received = getattr(msg, 'received', None)
 
 
 class TwitchTextMessage(TextMessage):
     def __init__(self, msg, me, message_type):
         user = msg.tags['display-name'] if 'display-name' in msg.tags else msg.source.split('!')[0]
         super().__init__(platform_id=SOURCE, icon=SOURCE_ICON, user=user, text=msg.arguments.pop(),
-                         me=me, message_type=message_type)
+                         me=me, message_type=message_type, received=msg.received)
         self.tags = msg.tags
         self.msg_id = self.tags.get('msg-id')
         self.bits = {}
@@ -120,7 +258,8 @@ class TwitchMessageHandler(threading.Thread):
         self.nick = nick
         self.badges = badges
         self.custom_smiles = custom_smiles
-        self.bits = self._reformat_bits(bits)
+        self.bits = bits
+        self._bits_matcher = None
 
         self.chat_module = chat_module
         self.kwargs = kwargs
@@ -162,38 +301,47 @@ class TwitchMessageHandler(threading.Thread):
         for badge in message.tags['badges'].split(','):
             badge_tag, badge_size = badge.split('/')
 
-            if badge_tag in self.badges:
-                badge_info = self.badges.get(badge_tag)[badge_size]
-                url = badge_info.get('image')
-                message.add_badge(badge_tag, url)
+            # Channel badges only override versions they have, the rest comes from global badges
+            for badges in self.badges.maps:
+                versions = badges.get(badge_tag)
+                if versions and badge_size in versions:
+                    message.add_badge(badge_tag, versions[badge_size].get('image'))
+                    break
+
+    def _handle_segments(self, message):
+        added_emotes = set()
 
-    @staticmethod
-    def _handle_emotes(message):
-        conveyor_emotes = []
-        for emote in message.tags['emotes'].split('/'):
-            emote_id, emote_pos_diap = emote.split(':')
-
-            for position in emote_pos_diap.split(','):
-                start, end = position.split('-')
-                conveyor_emotes.append({'emote_id': emote_id,
-                                        'start': int(start),
-                                        'end': int(end)})
-        conveyor_emotes = sorted(conveyor_emotes, key=lambda k: k['start'], reverse=True)
-
-        for emote in conveyor_emotes:
-            message.text = u'{start}{emote}{end}'.format(start=message.text[:emote['start']],
-                                                         end=message.text[emote['end'] + 1:],
-                                                         emote=EMOTE_FORMAT.format(emote['emote_id']))
-            message.add_emote(emote['emote_id'], EMOTE_SMILE_URL.format(id=emote['emote_id']))
-
-    def _handle_custom_emotes(self, message):
-        words = message.text.split()
-        for index, word in enumerate(words):
+        def add_emote(emote_id, url):
+            if emote_id not in added_emotes:
+                added_emotes.add(emote_id)
+                message.add_emote(emote_id, url)
+
+        # Twitch emotes come as positions, everything else is matched word by word
+        def match_word(word):
             if word in self.custom_smiles:
                 custom_smile = self.custom_smiles[word]
-                message.add_emote(custom_smile['key'], custom_smile['url'])
-                words[index] = EMOTE_FORMAT.format(custom_smile['key'])
-        message.text = ' '.join(words)
+                add_emote(custom_smile['key'], custom_smile['url'])
+                return emote_segment(custom_smile['key'])
+            if 'bits' in message.tags:
+                return self._handle_bits(message, word)
+            return None
+
+        text = message.text
+        emotes = parse_emotes(message.tags['emotes'], len(text)) if 'emotes' in message.tags else []
+
+        segments = []
+        position = 0
+        for start, end, emote_id in emotes:
+            if start < position:
+                continue
+            if start > position:
+                segments += build_segments(text[position:start], match_word)
+            segments.append(emote_segment(emote_id))
+            add_emote(emote_id, EMOTE_SMILE_URL.format(id=emote_id))
+            position = end
+        if position < len(text):
+            segments += build_segments(text[position:], match_word)
+        message.segments = segments
 
     def _handle_pm(self, message):
         if re.match(f'^@?{self.nick}[ ,]?', message.text.lower()):
@@ -237,16 +385,12 @@ class TwitchMessageHandler(threading.Thread):
 
         if 'badges' in msg.tags:
             self._handle_badges(message)
-        if 'bits' in msg.tags:
-            self._handle_bits(message)
-        if 'emotes' in msg.tags:
-            self._handle_emotes(message)
         if 'color' in msg.tags:
             self._handle_viewer_color(message)
 
         self._handle_channel_points(message)
 
-        self._handle_custom_emotes(message)
+        self._handle_segments(message)
         self._handle_pm(message)
         self._send_message(message)
 
@@ -254,26 +398,26 @@ class TwitchMessageHandler(threading.Thread):
         if self.chat_module.get_config('config', 'show_nickname_colors'):
             message.nick_colour = message.tags['color']
 
-    def _handle_bits(self, message):
-        for word in message.text.split():
-            reg = re.match(BITS_REGEXP, word)
-            if not reg:
-                continue
-
-            emote, amount = reg.groups()
-            emote = emote.lower()
-            if emote not in self.bits:
-                log.info('key %s not in bits', emote)
-                continue
-            tier = min([tier for tier in self.bits[emote]['tiers'].keys() if tier - int(amount) <= 0],
-                       key=lambda x: (abs(x - int(amount)), x))
-
-            emote_key = f'{emote}-{tier}'
-            if emote_key in message.bits:
-                continue
-
-            message.bits[emote_key] = self.bits[emote]['tiers'][tier]
-            message.text = message.text.replace(emote, EMOTE_FORMAT.format(emote))
+    def _get_bits_matcher(self):
+        # Matcher is rebuilt only when bits set is loaded or refreshed
+        bits = self.bits.maps[0] if isinstance(self.bits, ChainMap) else self.bits
+        bits = getattr(bits, 'data', bits)
+        if self._bits_matcher is None or self._bits_matcher.bits is not bits:
+            self._bits_matcher = BitsMatcher(bits)
+        return self._bits_matcher
+
+    def _handle_bits(self, message, word):
+        if not word[-1].isdigit():
+            return None
+        cheer = self._get_bits_matcher().match(word)
+        if not cheer:
+            return None
+
+        emote, amount, tier = cheer
+        emote_key = f"{emote}-{tier['id']}"
+        if emote_key not in message.bits:
+            message.bits[emote_key] = tier
+        return bit_segment(emote_key, amount)
 
     @staticmethod
     def _handle_sub_message(message):
@@ -290,23 +434,12 @@ class TwitchMessageHandler(threading.Thread):
         if not message.bits:
             return
         for emote_key, bit in message.bits.items():
-            emote = emote_key.split('-')[0]
-            message.add_emote(emote, bit['images'][BITS_THEME][BITS_TYPE][BITS_SCALE])
+            message.add_emote(emote_key, bit['images'][BITS_THEME][BITS_TYPE][BITS_SCALE])
 
     def _post_process_multiple_channels(self, message):
         if self.chat_module.get_config('config', 'show_channel_names'):
             message.channel_name = self.channel_class.display_name
 
-    @staticmethod
-    def _reformat_bits(bits):
-        return {
-            prefix: {
-                'tiers': {int(tier['id']): tier for tier in data['tiers']},
-                'states': data['states'],
-                'scales': data['scales']
-            } for prefix, data in bits.items()
-        }
-
     def _handle_channel_points(self, message):
         if message.msg_id:
             log.info(f'msg_id: {message.msg_id}')
@@ -315,24 +448,38 @@ class TwitchMessageHandler(threading.Thread):
 
 
 class TwitchPingHandler(threading.Thread):
-    def __init__(self, irc_connection, channel_class, irc_class):
+    def __init__(self, irc_connection):
         threading.Thread.__init__(self)
+        self.daemon = True
         self.irc_connection = irc_connection
-        self.channel_class = channel_class
-        self.irc_class = irc_class
 
     def run(self):
         log.info("Ping started")
         while self.irc_connection.connected:
             self.irc_connection.ping("keep-alive")
-            try:
-                self.channel_class.viewers = self.channel_class.get_viewers()
-            except Exception as exc:
-                log.exception(exc)
             time.sleep(PING_DELAY)
 
 
+class TwitchServerConnection(irc.client.ServerConnection):
+    # Lines are kept as bytes, chat lines go through fast IRCv3 parser
+    #  and everything else is decoded and handled by irc library
+    buffer_class = irc.client.buffer.LineBuffer
+
+    def _process_line(self, line):
+        event = parse_line(line)
+        if event is None:
+            super()._process_line(line.decode('utf-8', 'replace'))
+        else:
+            self._handle_event(event)
+
+
+class TwitchReactor(irc.client.Reactor):
+    connection_class = TwitchServerConnection
+
+
 class IRC(irc.client.SimpleIRCClient):
+    reactor_class = TwitchReactor
+
     def __init__(self, channel, channel_class=None, chat_module=None, **kwargs):
         irc.client.SimpleIRCClient.__init__(self)
         # Basic variables, twitch channel are IRC so #channel
@@ -362,10 +509,10 @@ class IRC(irc.client.SimpleIRCClient):
             log.debug("event: %s", event)
             self.channel_class.status = CHANNEL_OFFLINE
             self.channel_class.put_system_message(CONNECTION_DIED.format(self.nick))
-            timer = threading.Timer(5.0, self.reconnect,
-                                    args=[self.channel_class.host, self.channel_class.port,
-                                          self.channel_class.nickname])
-            timer.start()
+            supervisor.disconnected(self.channel_class, 'Connection lost')
+            supervisor.schedule(self.channel_class,
+                                functools.partial(self.reconnect, self.channel_class.host,
+                                                  self.channel_class.port, self.channel_class.nickname))
 
     def reconnect(self, host, port, nickname):
         try_count = 0
@@ -373,15 +520,19 @@ class IRC(irc.client.SimpleIRCClient):
             try_count += 1
             log.info("Reconnecting, try %s", try_count)
             try:
-                self.connect(host, port, nickname)
+                with supervisor.attempt(self.channel_class):
+                    self.connect(host, port, nickname)
                 break
             except Exception as exc:
                 log.exception(exc)
+                if not supervisor.wait(self.channel_class, str(exc)):
+                    break
 
     def on_welcome(self, connection, event):
         log.info("Welcome Received, joining %s channel", self.channel)
         log.debug("event: %s", event)
         self.tw_connection = connection
+        supervisor.connected(self.channel_class)
         self.channel_class.put_system_message(CHANNEL_JOINING.format(self.channel))
         # After we receive IRC Welcome we send request for join and
         #  request for Capabilities (Twitch color, Display Name,
@@ -389,7 +540,7 @@ class IRC(irc.client.SimpleIRCClient):
         connection.join(self.channel)
         connection.cap('REQ', ':twitch.tv/tags')
         connection.cap('REQ', ':twitch.tv/commands')
-        ping_handler = TwitchPingHandler(connection, self.channel_class, self)
+        ping_handler = TwitchPingHandler(connection)
         ping_handler.start()
 
     def on_join(self, connection, event):
@@ -401,11 +552,13 @@ class IRC(irc.client.SimpleIRCClient):
         self.channel_class.put_system_message(msg)
 
     def on_pubmsg(self, connection, event):
+        event.received = time.perf_counter()
         log.debug("connection: %s", connection)
         log.debug("event: %s", event)
         self.twitch_queue.put(event)
 
     def on_action(self, connection, event):
+        event.received = time.perf_counter()
         log.debug("connection: %s", connection)
         log.debug("event: %s", event)
         self.twitch_queue.put(event)
@@ -416,13 +569,205 @@ class IRC(irc.client.SimpleIRCClient):
         self.twitch_queue.put(event)
 
     def on_usernotice(self, connection, event):
+        event.received = time.perf_counter()
         log.debug("connection: %s", connection)
         log.debug("event: %s", event)
         self.twitch_queue.put(event)
 
 
+def anonymous_nickname():
+    # For anonymous log in Twitch wants username in special format:
+    #
+    #        justinfan(14d)
+    #    ex: justinfan54826341875412
+    #
+    return 'justinfan' + ''.join(str(random.randint(0, 9)) for _ in range(14))
+
+
+class PooledIRC(irc.client.SimpleIRCClient):
+    reactor_class = TwitchReactor
+
+    def __init__(self, host, port):
+        """
+            Single IRC connection shared by multiple twitch channels,
+              events are routed to channels by #channel target
+        """
+        irc.client.SimpleIRCClient.__init__(self)
+        self.host = host
+        self.port = port
+        self.nickname = anonymous_nickname()
+        self.channels = {}
+        self.joined = set()
+        self.tw_connection = None
+        self.welcomed = False
+        self.closing = False
+        self.events = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def add_channel(self, channel_class):
+        with self._lock:
+            self.channels[channel_class.irc_channel] = channel_class
+            if self.welcomed:
+                self._join(channel_class.irc_channel, channel_class)
+            start = not self._started
+            self._started = True
+
+        # Connection is started after the first channel is registered, so welcome always sees it
+        if start:
+            threading.Thread(target=self._dispatch, name='TwitchDispatcher', daemon=True).start()
+            threading.Thread(target=self._run, name='TwitchConnection', daemon=True).start()
+
+    def remove_channel(self, channel_class):
+        with self._lock:
+            self.channels.pop(channel_class.irc_channel, None)
+            joined = channel_class.irc_channel in self.joined
+            self.joined.discard(channel_class.irc_channel)
+            if not self.channels:
+                # Pending reconnects of an empty connection are dropped as well
+                self.closing = True
+                supervisor.unregister(self)
+
+        if not self.tw_connection or not self.tw_connection.is_connected():
+            return
+        if self.channels:
+            if joined:
+                self.tw_connection.part(channel_class.irc_channel)
+        else:
+            self.tw_connection.disconnect("CLOSE_OK")
+
+    def _join(self, name, channel_class):
+        """
+            Joins channel once per connection, has to be called with _lock held
+        """
+        if name in self.joined:
+            return
+        self.joined.add(name)
+        supervisor.connected(channel_class)
+        channel_class.put_system_message(CHANNEL_JOINING.format(name))
+        self.tw_connection.join(name)
+
+    def _run(self):
+        self._connect()
+        if self.closing:
+            return
+        try:
+            self.start()
+        except TwitchNormalDisconnect:
+            log.info("Pooled connection closed")
+
+    def _connect(self):
+        try_count = 0
+        while not self.closing:
+            try_count += 1
+            log.info("Connecting pooled connection, try %s", try_count)
+            try:
+                with supervisor.attempt(self):
+                    self.connect(self.host, self.port, self.nickname)
+                return
+            except Exception as exc:
+                log.exception(exc)
+                if not supervisor.wait(self, str(exc)):
+                    return
+
+    def _dispatch(self):
+        while True:
+            channel_class, event = self.events.get()
+            try:
+                channel_class.msg_handler.process_message(event)
+            except Exception as exc:
+                log.exception(exc)
+
+    def _route(self, event):
+        channel_class = self.channels.get(event.target.lower())
+        if channel_class and channel_class.msg_handler:
+            self.events.put((channel_class, event))
+
+    def on_disconnect(self, connection, event):
+        if 'CLOSE_OK' in event.arguments or self.closing:
+            log.info("Pooled connection closed")
+            raise TwitchNormalDisconnect()
+
+        log.info("Pooled connection lost")
+        with self._lock:
+            self.welcomed = False
+            self.joined.clear()
+        for channel_class in list(self.channels.values()):
+            channel_class.status = CHANNEL_OFFLINE
+            channel_class.put_system_message(CONNECTION_DIED.format(channel_class.channel))
+            supervisor.disconnected(channel_class, 'Pooled connection lost')
+        supervisor.schedule(self, self._connect)
+
+    def on_welcome(self, connection, event):
+        self.tw_connection = connection
+        if self.closing:
+            # Every channel was removed while connecting
+            connection.disconnect("CLOSE_OK")
+            return
+        log.info("Welcome Received, joining %s channels", len(self.channels))
+        supervisor.connected(self)
+        connection.cap('REQ', ':twitch.tv/tags')
+        connection.cap('REQ', ':twitch.tv/commands')
+        with self._lock:
+            self.welcomed = True
+            for name, channel_class in list(self.channels.items()):
+                self._join(name, channel_class)
+        TwitchPingHandler(connection).start()
+
+    def on_join(self, connection, event):
+        channel_class = self.channels.get(event.target.lower())
+        if not channel_class:
+            return
+        msg = CHANNEL_JOIN_SUCCESS.format(event.target)
+        channel_class.status = CHANNEL_ONLINE
+        log.info(msg)
+        channel_class.put_system_message(msg)
+
+    def on_pubmsg(self, connection, event):
+        event.received = time.perf_counter()
+        self._route(event)
+
+    def on_action(self, connection, event):
+        event.received = time.perf_counter()
+        self._route(event)
+
+    def on_clearchat(self, connection, event):
+        self._route(event)
+
+    def on_usernotice(self, connection, event):
+        event.received = time.perf_counter()
+        self._route(event)
+
+
+class TwitchConnectionPool(object):
+    def __init__(self, port, channels_per_connection):
+        """
+            Spreads twitch channels over as few IRC connections as possible
+        """
+        self.port = port
+        self.channels_per_connection = channels_per_connection
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def add(self, channel_class):
+        with self._lock:
+            self.connections = [item for item in self.connections if not item.closing]
+            connection = next((item for item in self.connections
+                               if len(item.channels) < self.channels_per_connection), None)
+            if connection is None:
+                connection = PooledIRC(channel_class.host, self.port)
+                self.connections.append(connection)
+            connection.add_channel(channel_class)
+
+    def remove(self, channel_class):
+        with self._lock:
+            for connection in self.connections:
+                if channel_class.irc_channel in connection.channels:
+                    connection.remove_channel(channel_class)
+
+
 class TWChannel(threading.Thread, Channel):
-    def __init__(self, m_queue, host, port, channel, anon=True, chat_module=None, **kwargs):
+    def __init__(self, m_queue, host, port, channel, anon=True, chat_module=None, pool=None, **kwargs):
         threading.Thread.__init__(self)
         Channel.__init__(self, channel, m_queue, icon=SOURCE_ICON, platform_id=SOURCE, system_user=SYSTEM_USER)
 
@@ -433,9 +778,12 @@ class TWChannel(threading.Thread, Channel):
 
         self.host = host
         self.port = port
-        self.custom_smiles = {}
-        self.badges = {}
-        self.bits = {}
+        # Layers are filled by bootstrap when they are loaded,
+        #  smiles: FFZ over BTTV, badges: channel over global
+        self.custom_smiles = ChainMap({}, {})
+        self.badges = ChainMap({}, {})
+        self.bits = ChainMap({})
+        self.catalog_keys = set()
 
         self.bttv = kwargs.get('bttv')
         self.frankerz = kwargs.get('frankerz')
@@ -445,18 +793,15 @@ class TWChannel(threading.Thread, Channel):
         self.display_name = None
         self.channel_id = None
         self.irc = None
+        self.pool = pool  # type: TwitchConnectionPool
+        self.msg_handler = None
 
-        # For anonymous log in Twitch wants username in special format:
-        #
-        #        justinfan(14d)
-        #    ex: justinfan54826341875412
-        #
         if anon:
-            nick_length = 14
-            self.nickname = "justinfan"
+            self.nickname = anonymous_nickname()
 
-            for number in range(0, nick_length):
-                self.nickname += str(random.randint(0, 9))
+    @property
+    def irc_channel(self):
+        return f'#{self.channel.lower()}'
 
     def create_message(self, msg, me, message_type):
         return TwitchTextMessage(msg, me, message_type)
@@ -473,9 +818,13 @@ class TWChannel(threading.Thread, Channel):
                 log.info("Connecting, try %s", try_count)
                 self._status = CHANNEL_PENDING
                 if self.load_config():
+                    if self.pool:
+                        self.join_pool()
+                        break
                     self.irc = IRC(self.channel, channel_class=self, chat_module=self.chat_module,
                                    custom_smiles=self.custom_smiles, badges=self.badges, bits=self.bits, **self.kwargs)
-                    self.irc.connect(self.host, self.port, self.nickname)
+                    with supervisor.attempt(self):
+                        self.irc.connect(self.host, self.port, self.nickname)
                     self._status = CHANNEL_ONLINE
                     self.irc.start()
                     log.info("Connection closed")
@@ -490,10 +839,18 @@ class TWChannel(threading.Thread, Channel):
                 break
             except Exception as exc:
                 log.exception(exc)
-            time.sleep(5)
+            if not supervisor.wait(self):
+                break
+
+    def join_pool(self):
+        # Pooled connection owns the socket, channel only keeps its own message handler
+        self.msg_handler = TwitchMessageHandler(None, nick=self.channel.lower(), channel_class=self,
+                                                chat_module=self.chat_module, custom_smiles=self.custom_smiles,
+                                                badges=self.badges, bits=self.bits, **self.kwargs)
+        self.pool.add(self)
 
     def load_config(self):
-        request = requests.get(f'{API_URL}/users', params={'login': self.channel}, headers=headers)
+        request = client.get(f'{API_URL}/users', params={'login': self.channel}, headers=headers)
         if request.ok:
             data = request.json()
             if len(data['users']) > 1:
@@ -505,130 +862,65 @@ class TWChannel(threading.Thread, Channel):
             log.error('Unable to get channel ID, error: %s\nArgs: %s')
             return False
 
-        try:
-            # Getting random IRC server to connect to
-            request = requests.get(f"http://tmi.twitch.tv/servers?channel={self.channel}", headers=headers)
-            if request.ok:
-                self.host = random.choice(request.json()['servers']).split(':')[0]
-            else:
-                raise Exception(f"Not successful status code: {request.status_code}")
-        except Exception as exc:
-            log.error(f"Unable to get server list, error: {exc}\nArgs: {exc.args}")
-            return False
+        # IRC connection only needs user id, everything else is loaded in parallel
+        #  and attached to the handler when it arrives
+        server = BOOTSTRAP_POOL.submit(self.load_server)
+        if self.frankerz:
+            self.attach_layer(self.custom_smiles, 0, f'ffz:{self.channel_id}',
+                              functools.partial(load_ffz_smiles, self.channel_id))
+        if self.bttv:
+            self.attach_layer(self.custom_smiles, 1, 'bttv', load_bttv_smiles)
+        self.attach_layer(self.badges, 0, f'badges:{self.channel_id}',
+                          functools.partial(load_channel_badges, self.channel_id))
+        self.attach_layer(self.badges, 1, 'badges', load_global_badges)
+        self.attach_layer(self.bits, 0, f'bits:{self.channel_id}', functools.partial(load_bits, self.channel_id))
 
         try:
-            # Getting Better Twitch TV smiles
-            if self.bttv:
-                request = requests.get("https://api.betterttv.net/2/emotes", timeout=10)
-                if request.ok:
-                    for smile in request.json()['emotes']:
-                        self.custom_smiles[smile['code']] = {
-                            'key': smile['code'],
-                            'url': BTTV_URL.format(id=smile['id'])
-                        }
-                else:
-                    raise Exception(f"Not successful status code: {request.status_code}")
+            self.host = server.result(timeout=REQUEST_TIMEOUT)
         except Exception as exc:
-            log.warning(f"Unable to get BTTV smiles, error {exc}\nArgs: {exc.args}")
+            log.warning(f"Unable to get server list, using {self.host}, error: {exc}")
+        return True
 
-        try:
-            # Getting FrankerZ smiles
-            if self.frankerz:
-                request = requests.get(f"https://api.frankerfacez.com/v1/room/id/{self.channel_id}", timeout=10)
-                if request.ok:
-                    req_json = request.json()
-                    for set_name, s_set in req_json['sets'].items():
-                        for smile in s_set['emoticons']:
-                            urls = smile['urls']
-                            url = urls.get('4', urls.get('2', urls.get('1')))
-                            self.custom_smiles[smile['name']] = {
-                                'key': smile['name'],
-                                'url': f'https:{url}'
-                            }
-                else:
-                    raise Exception(f"Not successful status code: {request.status_code}")
-        except Exception as exc:
-            log.warning(f"Unable to get FrankerZ smiles, error {exc}\nArgs: {exc.args}")
+    def load_server(self):
+        # Getting random IRC server to connect to
+        request = client.get(f"http://tmi.twitch.tv/servers?channel={self.channel}", headers=headers)
+        if not request.ok:
+            raise TwitchAPIError(f"Not successful status code: {request.status_code}")
+        return random.choice(request.json()['servers']).split(':')[0]
 
-        try:
-            # Warning, undocumented, can change a LOT
-            # Getting CUSTOM twitch badges
-            request = requests.get("https://badges.twitch.tv/v1/badges/global/display")
-            if request.ok:
-                for badge, badge_config in request.json()['badge_sets'].items():
-                    self.badges[badge] = {
-                        version: {
-                            'image': v.get('image_url_4x', v.get('image_url_2x', v.get('image_url_1x')))
-                        } for version, v in badge_config['versions'].items()
-                    }
-            else:
-                raise Exception(f"Not successful status code: {request.status_code}")
-        except Exception as exc:
-            log.warning(f"Unable to get twitch undocumented api badges, error {exc}\nArgs: {exc.args}")
+    def attach_layer(self, chain, index, key, loader):
+        self.catalog_keys.add(key)
 
-        try:
-            # Warning, undocumented, can change a LOT
-            # Getting CUSTOM twitch badges
-            badges_url = "https://badges.twitch.tv/v1/badges/channels/{0}/display"
-            request = requests.get(badges_url.format(self.channel_id))
-            if request.ok:
-                for badge, badge_config in request.json()['badge_sets'].items():
-                    processed_badge = {
-                        version: {
-                            'image': v.get('image_url_4x', v.get('image_url_2x', v.get('image_url_1x')))
-                        } for version, v in badge_config['versions'].items()
-                    }
-
-                    if badge in self.badges:
-                        self.badges[badge].update(processed_badge)
-                    else:
-                        self.badges[badge] = processed_badge
-            else:
-                raise Exception(f"Not successful status code: {request.status_code}")
-        except Exception as exc:
-            log.warning(f"Unable to get twitch undocumented api badges, error {exc}\nArgs: {exc.args}")
-
-        try:
-            bits_url = f"https://api.twitch.tv/kraken/bits/actions/?channel_id={self.channel_id}"
-            request = requests.get(bits_url, headers=headers)
-            if request.status_code == 200:
-                data = request.json()['actions']
-                self.bits = {item['prefix'].lower(): item for item in data}
-            else:
-                raise Exception("Not successful status code: %s", request.status_code)
-        except Exception as exc:
-            log.warning(f"Unable to get twitch undocumented api badges, error {exc}\nArgs: {exc.args}")
-
-        return True
+        def attach():
+            if self._status == CHANNEL_DISABLED:
+                return
+            try:
+                chain.maps[index] = CATALOG.register(key, loader, owner=self)
+            except Exception as exc:
+                log.exception(exc)
+        BOOTSTRAP_POOL.submit(attach)
 
     def stop(self):
         try:
             self._status = CHANNEL_DISABLED
-            self.irc.tw_connection.disconnect("CLOSE_OK")
+            supervisor.unregister(self)
+            viewers_scheduler.unregister(self)
+            for key in self.catalog_keys:
+                CATALOG.unregister(key, owner=self)
+            if self.pool:
+                self.pool.remove(self)
+            else:
+                self.irc.tw_connection.disconnect("CLOSE_OK")
         except TwitchNormalDisconnect:
             pass
 
-    def get_viewers(self):
-        streams_url = f'https://api.twitch.tv/kraken/streams/{self.channel_id}'
-        try:
-            request = requests.get(streams_url, headers=headers)
-            if request.status_code == 200:
-                json_data = request.json()
-                if json_data['stream']:
-                    return request.json()['stream'].get('viewers', NO_VIEWERS)
-                return NO_VIEWERS
-            else:
-                raise Exception(f"Not successful status code: {request.status_code}")
-        except Exception as exc:
-            log.warning(f"Unable to get user count, error {exc}\nArgs: {exc.args}")
-
 
 class Twitch(ChatModule):
     def __init__(self, *args, **kwargs):
         log.info("Initializing twitch chat")
         ChatModule.__init__(self, config=CONF_DICT, gui=CONF_GUI, *args, **kwargs)
 
-        self.host = CONF_DICT['config']['host']
+        self.host = str(CONF_DICT['config']['host'])
         self.port = int(CONF_DICT['config']['port'])
         self.bttv = CONF_DICT['config']['bttv']
         self.frankerz = CONF_DICT['config']['frankerz']
@@ -636,12 +928,31 @@ class Twitch(ChatModule):
         if self.access_code:
             headers['Authorization'] = f'OAuth {self.access_code}'
 
+        self.pool = None
+        channels_per_connection = self.get_config('config', 'channels_per_connection').simple()
+        if channels_per_connection > 1:
+            self.pool = TwitchConnectionPool(self.port, channels_per_connection)
+
         self.rest_add('GET', 'oidc', self.parse_oidc_request)
         self.rest_add('POST', 'oidc', self.oidc_code)
 
+    def load_module(self, *args, **kwargs):
+        ChatModule.load_module(self, *args, **kwargs)
+        viewers_scheduler.register(self, self.load_viewers, platform=SOURCE, min_interval=VIEWERS_MIN_INTERVAL,
+                                   max_interval=VIEWERS_MAX_INTERVAL, live_max_interval=VIEWERS_LIVE_MAX_INTERVAL)
+
+    def load_viewers(self):
+        # All channels are updated with one streams request per batch
+        channels = [channel for channel in list(self.channels.values()) if channel.channel_id]
+        viewers = {}
+        for index in range(0, len(channels), VIEWERS_BATCH_SIZE):
+            viewers.update(load_viewers([channel.channel_id for channel in
+                                         channels[index:index + VIEWERS_BATCH_SIZE]]))
+        return {channel: viewers.get(str(channel.channel_id), NO_VIEWERS) for channel in channels}
+
     def _add_channel(self, chat):
         self.channels[chat] = TWChannel(self.queue, self.host, self.port, chat, bttv=self.bttv, frankerz=self.frankerz,
-                                        settings=self._conf_params['settings'], chat_module=self)
+                                        settings=self._conf_params['settings'], chat_module=self, pool=self.pool)
         self.channels[chat].start()
 
     def parse_oidc_request(self, req):
@@ -672,7 +983,7 @@ class Twitch(ChatModule):
         return 'Access Code saved'
 
     def api_call(self, key):
-        req = requests.get(f'{API_URL}/{key}', headers=headers)
+        req = client.get(f'{API_URL}/{key}', headers=headers)
         if req.ok:
             return req.json()
         raise TwitchAPIError(f'Unable to get {key}')
@@ -684,7 +995,7 @@ class Twitch(ChatModule):
               f'&redirect_uri=http://localhost:{port}/rest/twitch/oidc' \
               f'&response_type=token' \
               f'&scope=channel_editor channel_read'
-        request = requests.get(url)
+        request = client.get(url)
 
         if request.ok:
             parent_window.create_browser(request.url)
@@ -4,8 +4,7 @@ import sys
 
 import threading
 
-import requests
-
+from modules.helper.http_client import client
 from modules.helper.updater import UPDATE_FOLDER, do_update, UPDATE_FILE, prepare_update
 from modules.interface.controls import MainMenuToolBar, AboutWindow
 
@@ -160,7 +159,7 @@ class ChatGui(wx.Frame):
 
     def download_update(self, url, filename, dialog):
         # NOTE the stream=True parameter
-        r = requests.get(url, stream=True)
+        r = client.get(url, stream=True)
         size = r.headers.get('content-length')
 
         wx.CallAfter(dialog.gauge.SetRange, int(size))
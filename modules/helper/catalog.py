@@ -0,0 +1,170 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from modules.helper.system import CACHE_FOLDER
+
+log = logging.getLogger('catalog')
+
+DEFAULT_TTL = 3600
+REFRESH_CHECK_INTERVAL = 60
+EMPTY_SET = {}
+
+
+class CatalogView(Mapping):
+    def __init__(self, catalog, key):
+        """
+            Read only view of a single catalog set,
+              always points to the latest loaded version of the set
+        """
+        self._catalog = catalog
+        self._key = key
+
+    @property
+    def data(self):
+        """
+            Currently loaded set, replaced by a new object on every refresh
+        """
+        return self._catalog.get(self._key)
+
+    def __getitem__(self, item):
+        return self._catalog.get(self._key)[item]
+
+    def __contains__(self, item):
+        return item in self._catalog.get(self._key)
+
+    def __iter__(self):
+        return iter(self._catalog.get(self._key))
+
+    def __len__(self):
+        return len(self._catalog.get(self._key))
+
+
+class Catalog(object):
+    def __init__(self, name, ttl=DEFAULT_TTL):
+        """
+            Process wide storage of emote/badge sets shared between channels,
+              every set is downloaded once, refreshed in background when it gets older than ttl
+              and saved to disk so chat can start without network
+        :param name: catalog name, used as snapshot folder name
+        :param ttl: seconds after which set is downloaded again
+        """
+        self.name = name
+        self.ttl = ttl
+        self.folder = os.path.join(CACHE_FOLDER, 'catalog', name)
+
+        self._lock = threading.Lock()
+        self._sets = {}
+        self._loaders = {}
+        self._loaded_at = {}
+        self._owners = {}
+        self._key_locks = {}
+        self._refresher = None
+
+    def register(self, key, loader, owner=None):
+        """
+            Registers set loader and loads the set if it's not loaded yet
+        :param key: set name, channel specific sets should include channel id
+        :param loader: function without arguments returning json serializable set,
+          should raise an exception if set can't be downloaded
+        :param owner: channel using the set, set is refreshed until all owners unregister it
+        :return: CatalogView of the set
+        """
+        with self._lock:
+            self._loaders[key] = loader
+            self._owners.setdefault(key, set()).add(owner)
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name=f'Catalog-{self.name}',
+                                                   daemon=True)
+                self._refresher.start()
+
+        with key_lock:
+            if key not in self._sets:
+                self._load(key, startup=True)
+        return CatalogView(self, key)
+
+    def unregister(self, key, owner=None):
+        """
+            Owner doesn't use the set anymore, set without owners is dropped
+              and no longer refreshed, its snapshot stays on disk
+        """
+        with self._lock:
+            owners = self._owners.get(key)
+            if owners is None:
+                return
+            owners.discard(owner)
+            if owners:
+                return
+            del self._owners[key]
+            self._loaders.pop(key, None)
+            self._loaded_at.pop(key, None)
+            self._sets.pop(key, None)
+
+    def get(self, key):
+        return self._sets.get(key, EMPTY_SET)
+
+    def _snapshot_path(self, key):
+        file_name = ''.join(char if char.isalnum() or char in '-_' else '_' for char in key)
+        return os.path.join(self.folder, f'{file_name}.json')
+
+    def _read_snapshot(self, key):
+        path = self._snapshot_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            return snapshot['data'], snapshot['saved_at']
+        except (ValueError, KeyError, OSError) as exc:
+            log.warning('Unable to read %s snapshot of %s: %s', key, self.name, exc)
+        return None
+
+    def _write_snapshot(self, key, data, saved_at):
+        path = self._snapshot_path(key)
+        try:
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            with open(f'{path}.tmp', 'w') as snapshot_file:
+                json.dump({'saved_at': saved_at, 'data': data}, snapshot_file)
+            os.replace(f'{path}.tmp', path)
+        except (TypeError, OSError) as exc:
+            log.warning('Unable to save %s snapshot of %s: %s', key, self.name, exc)
+
+    def _load(self, key, startup=False):
+        snapshot = self._read_snapshot(key) if startup else None
+        if snapshot and time.time() - snapshot[1] < self.ttl:
+            self._sets[key], self._loaded_at[key] = snapshot
+            return
+
+        try:
+            data = self._loaders[key]()
+        except Exception as exc:
+            log.warning('Unable to load %s of %s: %s', key, self.name, exc)
+            if snapshot:
+                log.info('Using saved %s of %s', key, self.name)
+                self._sets[key] = snapshot[0]
+            # Stale or missing set will be retried by refresher
+            self._loaded_at[key] = time.time() - self.ttl + REFRESH_CHECK_INTERVAL
+            return
+
+        loaded_at = time.time()
+        self._sets[key] = data
+        self._loaded_at[key] = loaded_at
+        self._write_snapshot(key, data, loaded_at)
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(REFRESH_CHECK_INTERVAL)
+            for key, loaded_at in list(self._loaded_at.items()):
+                if time.time() - loaded_at < self.ttl:
+                    continue
+                with self._key_locks[key]:
+                    if key in self._loaders:
+                        self._load(key)
+                    else:
+                        self._loaded_at.pop(key, None)
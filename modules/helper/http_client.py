@@ -0,0 +1,120 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger('http_client')
+
+DEFAULT_TIMEOUT = 10
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+# Amount of hosts keeping their own pool and connections kept alive per host
+POOL_HOSTS = 20
+POOL_SIZE = 10
+
+
+class HostStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def json(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'not_modified': self.not_modified,
+            'seconds': self.seconds,
+            'bytes': self.bytes
+        }
+
+
+class HttpClient(object):
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=RETRIES):
+        """
+            Keep-alive HTTP session shared by all chat modules,
+              idempotent requests are retried on connection errors and 5xx responses
+        :param timeout: timeout used when request doesn't set its own
+        :param retries: retries of a single request
+        """
+        self.timeout = timeout
+
+        retry = Retry(total=retries, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._conditional = {}
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).hostname or ''
+        with self._lock:
+            stats = self._stats.setdefault(host, HostStats())
+
+        start_time = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            stats.errors += 1
+            raise
+        finally:
+            stats.requests += 1
+            stats.seconds += time.perf_counter() - start_time
+
+        if response.status_code >= 400:
+            stats.errors += 1
+        if not kwargs.get('stream'):
+            stats.bytes += len(response.content)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_cached(self, url, params=None, headers=None, **kwargs):
+        """
+            GET for rarely changing data (smiles, badges, emotes),
+              sends ETag/Last-Modified of the previous response
+              and returns the previous response if server answers 304 Not Modified
+        """
+        key = requests.Request('GET', url, params=params).prepare().url
+        headers = dict(headers or {})
+        cached = self._conditional.get(key)
+        if cached:
+            if cached.headers.get('ETag'):
+                headers['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+        response = self.get(url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and cached:
+            self._stats[urlparse(url).hostname or ''].not_modified += 1
+            return cached
+        if response.ok and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self._conditional[key] = response
+        return response
+
+    def metrics(self):
+        """
+        :return: request statistics by host
+        """
+        with self._lock:
+            return {host: stats.json() for host, stats in self._stats.items()}
+
+
+client = HttpClient()
@@ -0,0 +1,242 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+
+from modules.helper.http_client import client
+
+log = logging.getLogger('image_cache')
+
+CACHE_ROUTE = '/img-cache'
+DOWNLOAD_TIMEOUT = 10
+PREFETCH_THREADS = 2
+PREFETCH_QUEUE_SIZE = 500
+# Larger responses are not images of emotes/badges and would push everything else out of cache
+MAX_IMAGE_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK = 64 * 1024
+
+# Only emote/badge CDNs can be proxied, so cache can't be used as an open proxy
+ALLOWED_HOSTS = ('static-cdn.jtvnw.net', 'd3aqoihi2n8ty8.cloudfront.net', 'cdn.betterttv.net',
+                 'cdn.frankerfacez.com', 'goodgame.ru', 'sc2tv.ru', 'peka2.tv', 'funstream.tv')
+
+IMAGE_SIGNATURES = [
+    (b'\x89PNG', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'RIFF', 'image/webp'),
+    (b'<svg', 'image/svg+xml'),
+    (b'<?xml', 'image/svg+xml'),
+]
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+
+class ImageCacheError(Exception):
+    pass
+
+
+def sniff_content_type(data):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return DEFAULT_CONTENT_TYPE
+
+
+def encode_key(url):
+    return base64.urlsafe_b64encode(url.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_key(key):
+    try:
+        url = base64.urlsafe_b64decode(key + '=' * (-len(key) % 4)).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError):
+        raise ImageCacheError(f'Invalid key {key}')
+
+    parsed = urlparse(url)
+    host = parsed.hostname or ''
+    if parsed.scheme not in ('http', 'https') or host not in ALLOWED_HOSTS:
+        raise ImageCacheError(f'Host is not allowed: {host}')
+    return url
+
+
+class ImageCache(object):
+    def __init__(self):
+        """
+            Size bounded LRU disk cache for emotes/badges,
+              concurrent requests of the same image are coalesced into one download
+        """
+        self.enabled = False
+        self.folder = None
+        self.max_size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._size = 0
+        self._pending = {}
+        self._prefetch_queue = queue.Queue(PREFETCH_QUEUE_SIZE)
+        self._workers = []
+
+    def configure(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Restoring LRU order from previous runs
+        files = [entry for entry in os.scandir(folder) if entry.is_file() and not entry.name.endswith('.tmp')]
+        with self._lock:
+            self._index = OrderedDict()
+            self._size = 0
+            for entry in sorted(files, key=lambda item: item.stat().st_mtime):
+                self._index[entry.name] = entry.stat().st_size
+                self._size += entry.stat().st_size
+            self._evict()
+
+        for _ in range(PREFETCH_THREADS - len(self._workers)):
+            worker = threading.Thread(target=self._prefetch_worker, name='ImageCachePrefetch', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        self.enabled = True
+
+    def url(self, url):
+        """
+            Rewrites remote image url to local cache route
+              and schedules download of the image if it's not cached yet
+        """
+        if not self.enabled or not url or not url.startswith(('http://', 'https://')):
+            return url
+
+        key = encode_key(url)
+        try:
+            decode_key(key)
+        except ImageCacheError:
+            return url
+
+        file_name = self._file_name(url)
+        if file_name not in self._index and file_name not in self._pending:
+            try:
+                self._prefetch_queue.put_nowait(url)
+            except queue.Full:
+                pass
+        return f'{CACHE_ROUTE}/{key}'
+
+    def get(self, key):
+        """
+        :return: path to the cached file and its content type
+        """
+        url = decode_key(key)
+        if not self.enabled:
+            raise ImageCacheError(f'Image cache is disabled, unable to serve {url}')
+        file_name = self._file_name(url)
+        path = os.path.join(self.folder, file_name)
+
+        with self._lock:
+            cached = file_name in self._index
+            if cached:
+                self._index.move_to_end(file_name)
+        if cached:
+            try:
+                os.utime(path)
+                content_type = self._content_type(path)
+                self.hits += 1
+                return path, content_type
+            except OSError:
+                # Evicted between index lookup and file access
+                pass
+
+        self.misses += 1
+        self._download(url, file_name)
+        try:
+            return path, self._content_type(path)
+        except OSError as exc:
+            raise ImageCacheError(f'Cached image of {url} is not available: {exc}')
+
+    @property
+    def size(self):
+        return self._size
+
+    @staticmethod
+    def _file_name(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _content_type(path):
+        with open(path, 'rb') as image:
+            return sniff_content_type(image.read(16))
+
+    def _download(self, url, file_name):
+        with self._lock:
+            event = self._pending.get(file_name)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self._pending[file_name] = event
+
+        if not owner:
+            event.wait(DOWNLOAD_TIMEOUT)
+            if file_name not in self._index:
+                raise ImageCacheError(f'Unable to download {url}')
+            return
+
+        path = os.path.join(self.folder, file_name)
+        tmp_path = f'{path}.tmp'
+        try:
+            with client.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as request:
+                if not request.ok:
+                    raise ImageCacheError(f'Unable to download {url}, status code: {request.status_code}')
+                if int(request.headers.get('Content-Length') or 0) > MAX_IMAGE_SIZE:
+                    raise ImageCacheError(f'Image {url} is too large')
+
+                size = 0
+                with open(tmp_path, 'wb') as image:
+                    for chunk in request.iter_content(DOWNLOAD_CHUNK):
+                        size += len(chunk)
+                        if size > MAX_IMAGE_SIZE:
+                            raise ImageCacheError(f'Image {url} is too large')
+                        image.write(chunk)
+            os.replace(tmp_path, path)
+
+            with self._lock:
+                self._size += size - self._index.pop(file_name, 0)
+                self._index[file_name] = size
+                self._evict()
+        except (requests.RequestException, OSError) as exc:
+            raise ImageCacheError(f'Unable to download {url}: {exc}')
+        finally:
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._pending.pop(file_name, None)
+            event.set()
+
+    def _evict(self):
+        while self._size > self.max_size and len(self._index) > 1:
+            file_name, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.folder, file_name))
+            except OSError as exc:
+                log.debug('Unable to remove cached image %s: %s', file_name, exc)
+
+    def _prefetch_worker(self):
+        while True:
+            url = self._prefetch_queue.get()
+            file_name = self._file_name(url)
+            if file_name in self._index:
+                continue
+            try:
+                self._download(url, file_name)
+            except ImageCacheError as exc:
+                log.debug(exc)
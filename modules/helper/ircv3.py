@@ -0,0 +1,142 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import re
+from collections.abc import Mapping
+
+TAG_UNESCAPE_REGEXP = re.compile(r'\\(.?)')
+TAG_UNESCAPE_MAP = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+ACTION_PREFIX = '\x01ACTION '
+CTCP_DELIMITER = '\x01'
+
+
+def unescape_tag(value):
+    return TAG_UNESCAPE_REGEXP.sub(lambda char: TAG_UNESCAPE_MAP.get(char.group(1), char.group(1)), value)
+
+
+class Tags(Mapping):
+    __slots__ = ('_raw', '_decoded')
+
+    def __init__(self, raw):
+        """
+            IRCv3 message tags backed by raw bytes of the tag section,
+              value is searched, decoded and unescaped only when it's accessed
+              tags without value are treated as missing
+        :param raw: tag section of the line without leading @
+        """
+        self._raw = raw
+        self._decoded = {}
+
+    def _find(self, key):
+        needle = key.encode('utf-8') + b'='
+        raw = self._raw
+        if raw.startswith(needle):
+            start = len(needle)
+        else:
+            position = raw.find(b';' + needle)
+            if position < 0:
+                return None
+            start = position + len(needle) + 1
+        end = raw.find(b';', start)
+        return raw[start:end] if end >= 0 else raw[start:]
+
+    def __getitem__(self, key):
+        if key in self._decoded:
+            return self._decoded[key]
+        value = self._find(key)
+        if not value:
+            raise KeyError(key)
+        value = value.decode('utf-8', 'replace')
+        if '\\' in value:
+            value = unescape_tag(value)
+        self._decoded[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key in self._decoded or bool(self._find(key))
+
+    def __iter__(self):
+        for item in self._raw.split(b';'):
+            key, _, value = item.partition(b'=')
+            if value:
+                yield key.decode('utf-8', 'replace')
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Tags({self._raw!r})'
+
+
+def parse_emotes(emotes_tag, text_length):
+    """
+        Parses twitch emotes tag (id:start-end,start-end/id:start-end)
+          Twitch positions are in code points, same as python str indexes
+    :return: list of (start, end, emote_id) sorted by start, end is exclusive
+    """
+    ranges = []
+    for emote in emotes_tag.split('/'):
+        emote_id, _, positions = emote.partition(':')
+        for position in positions.split(','):
+            start, _, end = position.partition('-')
+            if not start.isdigit() or not end.isdigit():
+                continue
+            start, end = int(start), int(end) + 1
+            if start < end <= text_length:
+                ranges.append((start, end, emote_id))
+    ranges.sort()
+    return ranges
+
+
+class ParsedEvent(object):
+    __slots__ = ('type', 'source', 'target', 'arguments', 'tags', 'received')
+
+    def __init__(self, event_type, source, target, arguments, tags):
+        """
+            Same interface as irc.client.Event, used for lines parsed by parse_line
+        """
+        self.type = event_type
+        self.source = source
+        self.target = target
+        self.arguments = arguments
+        self.tags = tags
+        self.received = None
+
+    def __repr__(self):
+        return f'type: {self.type}, source: {self.source}, target: {self.target}, ' \
+               f'arguments: {self.arguments}, tags: {self.tags}'
+
+
+def parse_line(line):
+    """
+        Parses raw PRIVMSG, USERNOTICE and CLEARCHAT lines to channels
+    :param line: raw line without line ending (bytes)
+    :return: ParsedEvent or None if line should be processed by generic IRC parser
+    """
+    raw_tags = b''
+    if line.startswith(b'@'):
+        raw_tags, _, line = line[1:].partition(b' ')
+    prefix = b''
+    if line.startswith(b':'):
+        prefix, _, line = line[1:].partition(b' ')
+    command, _, line = line.partition(b' ')
+    if command not in (b'PRIVMSG', b'USERNOTICE', b'CLEARCHAT'):
+        return None
+
+    target, _, trailing = line.partition(b' ')
+    if not target.startswith(b'#'):
+        return None
+    if trailing.startswith(b':'):
+        trailing = trailing[1:]
+    text = trailing.decode('utf-8', 'replace')
+
+    event_type = command.decode('ascii').lower()
+    if command == b'PRIVMSG':
+        event_type = 'pubmsg'
+        if text.startswith(CTCP_DELIMITER):
+            if not text.startswith(ACTION_PREFIX):
+                return None
+            event_type = 'action'
+            text = text[len(ACTION_PREFIX):].rstrip(CTCP_DELIMITER)
+
+    arguments = [text] if trailing or event_type in ('pubmsg', 'action') else []
+    return ParsedEvent(event_type, prefix.decode('utf-8', 'replace'), target.decode('utf-8', 'replace'),
+                       arguments, Tags(raw_tags))
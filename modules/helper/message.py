@@ -1,8 +1,10 @@
+import re
 import uuid
 import logging
 import datetime
 import time
-from modules.helper.system import SOURCE, SOURCE_ICON, SOURCE_USER
+from modules.helper.system import SOURCE, SOURCE_ICON, SOURCE_USER, EMOTE_FORMAT
+from modules.helper.tracing import STAGE_RECEIVE
 
 log = logging.getLogger('helper.message')
 
@@ -13,6 +15,16 @@ DEFAULT_MESSAGE_TYPE = 'message'
 SUBSCRIBE_MESSAGE_TYPE = 'message_sub'
 HIGHLIGHT_MESSAGE_TYPE = 'message_highlight'
 
+SEGMENT_TEXT = 'text'
+SEGMENT_EMOTE = 'emote'
+SEGMENT_BIT = 'bit'
+SEGMENT_MENTION = 'mention'
+SEGMENT_LINK = 'link'
+
+WORD_SPLIT_REGEXP = re.compile(r'(\s+)')
+LINK_REGEXP = re.compile(r'^(?:https?://|www\.)\S+$', re.IGNORECASE)
+MENTION_REGEXP = re.compile(r'^@(\w+)')
+
 
 def _validate_command(command):
     """
@@ -30,6 +42,80 @@ def get_system_message_types():
     return AVAILABLE_SYSTEM_MESSAGES
 
 
+def text_segment(text):
+    return {'type': SEGMENT_TEXT, 'text': text}
+
+
+def emote_segment(emote_id):
+    return {'type': SEGMENT_EMOTE, 'id': emote_id}
+
+
+def bit_segment(emote_id, amount):
+    return {'type': SEGMENT_BIT, 'id': emote_id, 'amount': amount}
+
+
+def mention_segment(user, text):
+    return {'type': SEGMENT_MENTION, 'user': user, 'text': text}
+
+
+def link_segment(url):
+    return {'type': SEGMENT_LINK, 'url': url, 'text': url}
+
+
+def word_segment(word):
+    """
+        Default word matcher, finds mentions and links
+    :return: segment or None if word is a plain text
+    """
+    if LINK_REGEXP.match(word):
+        return link_segment(word)
+    mention = MENTION_REGEXP.match(word)
+    if mention:
+        return mention_segment(mention.group(1), word)
+    return None
+
+
+def build_segments(text, match_word=None):
+    """
+        Splits text into segments in one pass, whitespace is kept in text segments
+    :param text: text to split
+    :param match_word: function that returns a segment for a word
+      or None if the word is not special for the platform (emotes/bits etc.)
+    :return: list of segments
+    """
+    segments = []
+    plain = []
+    for token in WORD_SPLIT_REGEXP.split(text):
+        segment = None
+        if token and not token.isspace():
+            segment = (match_word and match_word(token)) or word_segment(token)
+        if segment is None:
+            plain.append(token)
+            continue
+        if plain:
+            segments.append(text_segment(''.join(plain)))
+            plain = []
+        segments.append(segment)
+    if ''.join(plain):
+        segments.append(text_segment(''.join(plain)))
+    return segments
+
+
+def segments_text(segments):
+    """
+        Compatibility view of segments, emotes are replaced with EMOTE_FORMAT placeholders
+    """
+    text = []
+    for segment in segments:
+        if segment['type'] == SEGMENT_EMOTE:
+            text.append(EMOTE_FORMAT.format(segment['id']))
+        elif segment['type'] == SEGMENT_BIT:
+            text.append(f"{EMOTE_FORMAT.format(segment['id'])}{segment['amount']}")
+        else:
+            text.append(segment['text'])
+    return ''.join(text)
+
+
 def process_text_messages(func):
     def validate_class(self_class, message, **kwargs):
         if message:
@@ -52,14 +138,18 @@ class NonExistentCommand(Exception):
 
 
 class Message(object):
-    def __init__(self, only_gui=False):
+    def __init__(self, only_gui=False, received=None):
         """
             Basic Message class
+        :param received: time.perf_counter() value of the moment
+          connector received the message
         """
         self._jsonable = []
         self._timestamp = datetime.datetime.now()
         self._only_gui = only_gui
         self._type = 'message'
+        self._channel = None
+        self._trace = {STAGE_RECEIVE: received if received is not None else time.perf_counter()}
 
     def json(self):
         return {'type': self._type,
@@ -78,6 +168,31 @@ class Message(object):
     def timestamp(self):
         return self._timestamp
 
+    @property
+    def trace(self):
+        """
+            time.perf_counter() values of message passing delivery stages
+        :rtype: dict
+        """
+        return self._trace
+
+    def mark(self, stage):
+        if stage not in self._trace:
+            self._trace[stage] = time.perf_counter()
+            return True
+        return False
+
+    @property
+    def channel(self):
+        """
+            Channel the message was received from, set by chat Channel
+        """
+        return self._channel
+
+    @channel.setter
+    def channel(self, value):
+        self._channel = value
+
     @property
     def unixtime(self):
         return time.mktime(self._timestamp.timetuple())
@@ -170,10 +285,11 @@ class TextMessage(Message):
         self._channel_name = channel_name
         self._id = str(mid) if mid else str(uuid.uuid1())
         self._message_type = message_type
+        self._segments = None
 
         self._jsonable += ['user', 'text', 'emotes', 'badges',
                            'id', 'platform', 'pm', 'nick_colour',
-                           'channel_name', 'me', 'message_type']
+                           'channel_name', 'me', 'message_type', 'segments']
 
     @property
     def message_type(self):
@@ -204,8 +320,26 @@ class TextMessage(Message):
 
     @text.setter
     def text(self, value):
+        # Segments are no longer valid if text is rewritten by anyone
+        if value != self._text:
+            self._segments = None
         self._text = value
 
+    @property
+    def segments(self):
+        """
+            Ordered list of text/emote/bit/mention/link segments,
+              None if message only has placeholder text
+        :rtype: list
+        """
+        return self._segments
+
+    @segments.setter
+    def segments(self, value):
+        self._segments = value
+        if value is not None:
+            self._text = segments_text(value)
+
     @property
     def emotes(self):
         return self._emotes
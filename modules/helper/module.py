@@ -6,6 +6,8 @@ import os
 from modules.helper import parser
 from modules.helper.message import TextMessage, Message, SystemMessage
 from modules.helper.parser import save_settings, load_from_config_file
+from modules.helper.supervisor import supervisor
+from modules.helper.viewers import viewers_scheduler
 from modules.helper.system import RestApiException, CONF_FOLDER
 from modules.interface.types import LCPanel, LCStaticBox, LCBool, LCList, deep_get
 
@@ -270,7 +272,6 @@ class ChatModule(DefaultModule):
 class Channel(object):
     def __init__(self, channel, queue, icon, platform_id, system_user):
         # TODO: Do A lot of shit with this. Systemmessage passthrough, message passthrough
-        self._viewers = None
         self._status = CHANNEL_OFFLINE
         self._channel = channel
         self._queue = queue
@@ -288,11 +289,11 @@ class Channel(object):
 
     @property
     def viewers(self):
-        return self._viewers
+        return viewers_scheduler.get(self)
 
     @viewers.setter
     def viewers(self, value):
-        self._viewers = value
+        viewers_scheduler.set(self, value)
 
     @property
     def status(self):
@@ -305,6 +306,17 @@ class Channel(object):
         else:
             raise TypeError('Invalid channel status: {}', value)
 
+    @property
+    def reconnect_history(self):
+        return supervisor.history(self)
+
+    @property
+    def status_note(self):
+        """
+        :return: (text, warning) shown by status frame next to the channel, None if there is nothing to show
+        """
+        return None
+
     def put_system_message(self, text, category='system.chat', **kwargs):
         self._put_message(
             SystemMessage(text, category=category, icon=self._icon, platform_id=self._platform_id,
@@ -317,4 +329,5 @@ class Channel(object):
         self._put_message(message)
 
     def _put_message(self, message):
+        message.channel = self._channel
         self._queue.put(message)
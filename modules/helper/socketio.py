@@ -0,0 +1,99 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import json
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Engine.IO v3 packet types
+ENGINE_OPEN = 0
+ENGINE_CLOSE = 1
+ENGINE_PING = 2
+ENGINE_PONG = 3
+ENGINE_MESSAGE = 4
+ENGINE_UPGRADE = 5
+ENGINE_NOOP = 6
+
+# Socket.IO v2 packet types, carried by ENGINE_MESSAGE
+SOCKET_CONNECT = 0
+SOCKET_DISCONNECT = 1
+SOCKET_EVENT = 2
+SOCKET_ACK = 3
+SOCKET_ERROR = 4
+SOCKET_BINARY_EVENT = 5
+SOCKET_BINARY_ACK = 6
+
+DIGIT_ZERO = ord('0')
+DIGIT_NINE = ord('9')
+NAMESPACE_START = ord('/')
+NAMESPACE_END = ord(',')
+
+
+class SocketIOError(Exception):
+    pass
+
+
+class Packet(object):
+    __slots__ = ('engine_type', 'type', 'namespace', 'ack_id', 'data')
+
+    def __init__(self, engine_type, packet_type=None, namespace=None, ack_id=None, data=None):
+        self.engine_type = engine_type
+        self.type = packet_type
+        self.namespace = namespace
+        self.ack_id = ack_id
+        self.data = data
+
+    def __repr__(self):
+        return f'engine_type: {self.engine_type}, type: {self.type}, namespace: {self.namespace}, ' \
+               f'ack_id: {self.ack_id}, data: {self.data}'
+
+
+def decode_frame(frame, loads=json_loads):
+    """
+        Splits websocket frame into Engine.IO/Socket.IO packet fields,
+          works on bytes directly so only JSON body is decoded
+    :param frame: frame payload (bytes or str)
+    :param loads: JSON decoder used for packet body
+    :rtype: Packet
+    """
+    if isinstance(frame, str):
+        frame = frame.encode('utf-8')
+    if not frame or not DIGIT_ZERO <= frame[0] <= DIGIT_NINE:
+        raise SocketIOError(f'Invalid frame {frame[:20]!r}')
+
+    engine_type = frame[0] - DIGIT_ZERO
+    if engine_type != ENGINE_MESSAGE:
+        return Packet(engine_type, data=loads(frame[1:]) if len(frame) > 1 and engine_type == ENGINE_OPEN else None)
+    if len(frame) < 2 or not DIGIT_ZERO <= frame[1] <= DIGIT_NINE:
+        raise SocketIOError(f'Invalid message frame {frame[:20]!r}')
+
+    packet_type = frame[1] - DIGIT_ZERO
+    position = 2
+    length = len(frame)
+
+    namespace = None
+    if position < length and frame[position] == NAMESPACE_START:
+        end = frame.find(b',', position)
+        if end < 0:
+            end = length
+        namespace = frame[position:end].decode('utf-8')
+        position = end + 1
+
+    ack_id = None
+    start = position
+    while position < length and DIGIT_ZERO <= frame[position] <= DIGIT_NINE:
+        position += 1
+    if position > start:
+        ack_id = int(frame[start:position])
+
+    data = loads(frame[position:]) if position < length else None
+    return Packet(ENGINE_MESSAGE, packet_type, namespace, ack_id, data)
+
+
+def encode_packet(packet_type, data, ack_id=None, dumps=json.dumps):
+    """
+    :return: Socket.IO packet ready to be sent as websocket text frame
+    """
+    return f'{ENGINE_MESSAGE}{packet_type}{"" if ack_id is None else ack_id}{dumps(data)}'
@@ -0,0 +1,159 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger('supervisor')
+
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+# Connection has to stay up that long before backoff starts from the beginning again
+STABLE_CONNECTION = 60
+MAX_CONCURRENT_ATTEMPTS = 4
+HISTORY_SIZE = 20
+
+EVENT_CONNECTED = 'connected'
+EVENT_DISCONNECTED = 'disconnected'
+EVENT_RETRY = 'retry'
+EVENT_ATTEMPT = 'attempt'
+
+
+class ReconnectState(object):
+    def __init__(self):
+        self.failures = 0
+        self.connected_at = None
+        self.scheduled = False
+        self.cancelled = threading.Event()
+        self.history = deque(maxlen=HISTORY_SIZE)
+
+
+def channel_name(channel):
+    return getattr(channel, 'channel', None) or channel.__class__.__name__
+
+
+class ConnectionSupervisor(object):
+    def __init__(self, base=BACKOFF_BASE, max_delay=BACKOFF_MAX, max_attempts=MAX_CONCURRENT_ATTEMPTS):
+        """
+            Single place deciding when chat channels reconnect,
+              delays grow exponentially with jitter per channel
+              and only max_attempts connections are being established at once
+        :param base: delay of the first retry
+        :param max_delay: longest delay between retries
+        :param max_attempts: connection attempts allowed at the same time
+        """
+        self.base = base
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._states = {}
+        self._attempts = threading.BoundedSemaphore(max_attempts)
+        self._timers = []
+        self._counter = itertools.count()
+        self._scheduler = None
+
+    def _state(self, channel):
+        with self._lock:
+            if channel not in self._states:
+                self._states[channel] = ReconnectState()
+            return self._states[channel]
+
+    def _record(self, state, event, reason=None, delay=None):
+        state.history.append({'time': time.time(), 'event': event, 'reason': reason, 'delay': delay})
+
+    def _next_delay(self, state):
+        if state.connected_at and time.time() - state.connected_at > STABLE_CONNECTION:
+            state.failures = 0
+        state.connected_at = None
+
+        delay = min(self.max_delay, self.base * 2 ** state.failures)
+        state.failures += 1
+        # Equal jitter, channels dropped together won't come back at the same moment
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def unregister(self, channel):
+        """
+            Channel is stopped, pending waits return immediately and scheduled reconnects are dropped
+        """
+        with self._lock:
+            state = self._states.pop(channel, None)
+        if state:
+            state.cancelled.set()
+
+    def connected(self, channel):
+        state = self._state(channel)
+        state.connected_at = time.time()
+        self._record(state, EVENT_CONNECTED)
+
+    def disconnected(self, channel, reason=None):
+        self._record(self._state(channel), EVENT_DISCONNECTED, reason)
+
+    def history(self, channel):
+        """
+        :return: latest connection events of the channel, oldest first
+        """
+        state = self._states.get(channel)
+        return list(state.history) if state else []
+
+    @contextmanager
+    def attempt(self, channel):
+        """
+            Guards connection handshake, blocks while too many channels are connecting,
+              the attempt is recorded in channel history with time it waited for its turn
+        """
+        state = self._state(channel)
+        queued_at = time.time()
+        with self._attempts:
+            queued = time.time() - queued_at
+            self._record(state, EVENT_ATTEMPT, f'queued {queued:.1f}s' if queued >= 1 else None)
+            yield
+
+    def wait(self, channel, reason=None):
+        """
+            Blocks retry loop of the channel until the next attempt
+        :return: False if channel was stopped while waiting
+        """
+        state = self._state(channel)
+        delay = self._next_delay(state)
+        self._record(state, EVENT_RETRY, reason, delay)
+        log.info('Reconnecting %s in %.1fs', channel_name(channel), delay)
+        return not state.cancelled.wait(delay)
+
+    def schedule(self, channel, callback, reason=None):
+        """
+            Runs callback in a new thread after backoff delay,
+              ignored if reconnect of the channel is already scheduled
+        """
+        state = self._state(channel)
+        with self._lock:
+            if state.scheduled:
+                return
+            state.scheduled = True
+            delay = self._next_delay(state)
+            heapq.heappush(self._timers, (time.time() + delay, next(self._counter), channel, state, callback))
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target=self._schedule_loop, name='ConnectionSupervisor',
+                                                   daemon=True)
+                self._scheduler.start()
+            self._wakeup.notify()
+        self._record(state, EVENT_RETRY, reason, delay)
+        log.info('Reconnecting %s in %.1fs', channel_name(channel), delay)
+
+    def _schedule_loop(self):
+        while True:
+            with self._lock:
+                while not self._timers or self._timers[0][0] > time.time():
+                    self._wakeup.wait(self._timers[0][0] - time.time() if self._timers else None)
+                _, _, channel, state, callback = heapq.heappop(self._timers)
+                state.scheduled = False
+            if state.cancelled.is_set():
+                continue
+            threading.Thread(target=callback, name=f'Reconnect-{channel_name(channel)}', daemon=True).start()
+
+
+supervisor = ConnectionSupervisor()
@@ -10,10 +10,11 @@ import re
 import os
 import string
 import sys
-import requests
 import semantic_version
 import yaml
 
+from modules.helper.http_client import client
+
 if hasattr(sys, 'frozen'):
     PYTHON_FOLDER = os.path.dirname(sys.executable)
 else:
@@ -23,6 +24,7 @@ CONF_FOLDER = os.path.join(PYTHON_FOLDER, "conf")
 MODULE_FOLDER = os.path.join(PYTHON_FOLDER, "modules")
 MAIN_CONF_FILE = os.path.join(CONF_FOLDER, "config.cfg")
 HTTP_FOLDER = os.path.join(PYTHON_FOLDER, "http")
+CACHE_FOLDER = os.path.join(PYTHON_FOLDER, "cache")
 
 VERSION = '0.4.0'
 SOURCE_REPO_URL = 'https://github.com/DeForce/LalkaChat'
@@ -152,7 +154,7 @@ def random_string(length):
 def get_update(sem_version):
     github_url = "https://api.github.com/repos/DeForce/LalkaChat/releases"
     try:
-        update_json = requests.get(github_url, timeout=1)
+        update_json = client.get(github_url, timeout=1)
         if update_json.status_code == 200:
             update = False
             update_url = None
@@ -0,0 +1,88 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import bisect
+import logging
+import random
+import threading
+
+log = logging.getLogger('latency')
+
+STAGE_RECEIVE = 'receive'
+STAGE_PIPELINE_IN = 'pipeline_in'
+STAGE_PIPELINE_OUT = 'pipeline_out'
+STAGE_DEQUEUE = 'dequeue'
+STAGE_SEND = 'send'
+
+# Latency name: (from stage, to stage)
+LATENCIES = {
+    'ingest': (STAGE_RECEIVE, STAGE_PIPELINE_IN),
+    'pipeline': (STAGE_PIPELINE_IN, STAGE_PIPELINE_OUT),
+    'webchat_queue': (STAGE_PIPELINE_OUT, STAGE_DEQUEUE),
+    'delivery': (STAGE_DEQUEUE, STAGE_SEND),
+    'total': (STAGE_RECEIVE, STAGE_SEND),
+}
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def json(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class LatencyTracker(object):
+    def __init__(self):
+        """
+            Keeps per platform, per stage latency histograms of delivered messages
+              and optionally logs traces of sampled or slow messages
+        """
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self.sample_rate = 0.0
+        self.spike_threshold = 0.0
+
+    def observe(self, message):
+        trace = message.trace
+        platform = getattr(message, 'platform', None)
+        platform_id = platform.id if platform else 'none'
+
+        latencies = {name: trace[end] - trace[start] for name, (start, end) in LATENCIES.items()
+                     if start in trace and end in trace}
+        with self._lock:
+            for name, value in latencies.items():
+                key = (platform_id, name)
+                if key not in self._histograms:
+                    self._histograms[key] = LatencyHistogram()
+                self._histograms[key].observe(value)
+
+        total = latencies.get('total', 0.0)
+        if (self.spike_threshold and total >= self.spike_threshold) or \
+                (self.sample_rate and random.random() < self.sample_rate):
+            log.info('Trace %s [%s]: %s', getattr(message, 'id', None), platform_id,
+                     ', '.join(f'{name}={value * 1000:.2f}ms' for name, value in latencies.items()))
+
+    def json(self):
+        with self._lock:
+            histograms = list(self._histograms.items())
+
+        data = {}
+        for (platform_id, name), histogram in histograms:
+            data.setdefault(platform_id, {})[name] = histogram.json()
+        return data
+
+
+TRACKER = LatencyTracker()
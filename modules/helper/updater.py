@@ -6,8 +6,7 @@ import shutil
 import subprocess
 import zipfile
 
-import requests
-
+from modules.helper.http_client import client
 from modules.helper.system import PYTHON_FOLDER, HTTP_FOLDER
 
 CREATE_NEW_PROCESS_GROUP = 0x00000200
@@ -21,7 +20,7 @@ UPDATE_FILE = 'dl.zip'
 
 
 def get_available_versions():
-    req = requests.get(UPDATE_URL, timeout=1)
+    req = client.get(UPDATE_URL, timeout=1)
     if req.ok:
         return req.json()
     else:
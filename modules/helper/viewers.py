@@ -0,0 +1,155 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.helper.system import NO_VIEWERS
+
+log = logging.getLogger('viewers')
+
+WORKERS = 4
+MIN_INTERVAL = 15
+MAX_INTERVAL = 120
+JITTER = 0.1
+# Minimal seconds between two viewer requests to the same platform
+DEFAULT_PLATFORM_GAP = 1
+
+
+class ViewersJob(object):
+    def __init__(self, key, fetch, platform, min_interval, max_interval, live_max_interval):
+        self.key = key
+        self.fetch = fetch
+        self.platform = platform
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.live_max_interval = live_max_interval or max_interval
+        self.interval = min_interval
+        self.running = False
+        self.due = 0
+
+
+class ViewersScheduler(object):
+    def __init__(self, workers=WORKERS):
+        """
+            Polls viewer counts of all chat channels on one worker pool and keeps the latest values,
+              polling of a job slows down while its counts don't change
+        """
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._jobs = {}
+        self._cache = {}
+        self._timers = []
+        self._counter = itertools.count()
+        self._platform_gap = {}
+        self._platform_next = {}
+        self._workers = workers
+        self._pool = None
+        self._scheduler = None
+
+    def set_platform_gap(self, platform, seconds):
+        self._platform_gap[platform] = seconds
+
+    def register(self, key, fetch, platform, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 live_max_interval=None):
+        """
+        :param key: channel or any other owner of the job, registering the same key replaces the job
+        :param fetch: function without arguments returning viewers of the key channel,
+          mapping of channel to viewers for batched requests
+          or None if viewers are set asynchronously with set()
+        :param platform: requests of the same platform are rate limited together
+        :param live_max_interval: longest interval while any of the channels is live
+        """
+        job = ViewersJob(key, fetch, platform, min_interval, max_interval, live_max_interval)
+        with self._lock:
+            self._jobs[key] = job
+            if self._scheduler is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='Viewers')
+                self._scheduler = threading.Thread(target=self._schedule_loop, name='ViewersScheduler', daemon=True)
+                self._scheduler.start()
+            self._push(job, 0)
+
+    def unregister(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+            self._cache.pop(key, None)
+
+    def refresh(self, key):
+        """
+            Polls the job as soon as platform limit allows, ignored if the job is already running
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job and not job.running:
+                job.interval = job.min_interval
+                self._push(job, 0)
+
+    def get(self, channel, default=None):
+        return self._cache.get(channel, default)
+
+    def set(self, channel, value):
+        """
+        :return: True if viewers of the channel changed
+        """
+        with self._lock:
+            if self._cache.get(channel) == value:
+                return False
+            self._cache[channel] = value
+            job = self._jobs.get(channel)
+            if job:
+                job.interval = job.min_interval
+        return True
+
+    def _push(self, job, delay):
+        job.due = time.time() + delay
+        heapq.heappush(self._timers, (job.due, next(self._counter), job))
+        self._wakeup.notify()
+
+    def _schedule_loop(self):
+        while True:
+            with self._lock:
+                while not self._timers or self._timers[0][0] > time.time():
+                    self._wakeup.wait(self._timers[0][0] - time.time() if self._timers else None)
+                due, _, job = heapq.heappop(self._timers)
+                # Outdated entries of rescheduled or removed jobs
+                if job.due != due or self._jobs.get(job.key) is not job or job.running:
+                    continue
+
+                platform_next = self._platform_next.get(job.platform, 0)
+                if platform_next > time.time():
+                    self._push(job, platform_next - time.time())
+                    continue
+                self._platform_next[job.platform] = \
+                    time.time() + self._platform_gap.get(job.platform, DEFAULT_PLATFORM_GAP)
+                job.running = True
+            self._pool.submit(self._run, job)
+
+    def _run(self, job):
+        changed = False
+        live = False
+        try:
+            result = job.fetch()
+            if result is not None:
+                values = result if isinstance(result, Mapping) else {job.key: result}
+                for channel, value in values.items():
+                    changed = self.set(channel, value) or changed
+                    live = live or value not in (None, NO_VIEWERS)
+        except Exception as exc:
+            log.warning(f"Unable to get viewers of {job.platform}, error {exc}")
+
+        with self._lock:
+            job.running = False
+            if self._jobs.get(job.key) is not job:
+                return
+            if changed:
+                job.interval = job.min_interval
+            else:
+                job.interval = min(job.interval * 2, job.live_max_interval if live else job.max_interval)
+            self._push(job, job.interval * random.uniform(1 - JITTER, 1 + JITTER))
+
+
+viewers_scheduler = ViewersScheduler()
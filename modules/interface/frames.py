@@ -21,6 +21,7 @@ CHANNEL_STATUS_COLORS = {
     CHANNEL_OFFLINE: wx.Colour(255, 0, 0),
     CHANNEL_PENDING: wx.Colour(200, 200, 0)
 }
+NOTE_WARNING_COLOR = wx.Colour(255, 128, 0)
 
 
 class OAuthBrowser(wx.Frame):
@@ -45,6 +46,8 @@ class ChannelStatus(object):
         self.name = name
         self.status = status
         self.viewers = NO_VIEWERS
+        self.history = []
+        self.note = None
 
         self.sizer = sizer
         self.viewers_wx = viewers
@@ -113,6 +116,8 @@ class StatusFrame(wx.Panel):
 
                     changes.append(self.set_channel_status(chat_name, channel_name, channel_settings.status))
                     changes.append(self.set_viewers(chat_name, channel_name, channel_settings.viewers))
+                    self.set_reconnect_history(chat_name, channel_name, channel_settings.reconnect_history)
+                    self.set_status_note(chat_name, channel_name, channel_settings.status_note)
 
                 difference = [item for item in self.chats.get(chat_name, {})
                               if item.lower() not in [channel_settings.lower()
@@ -272,6 +277,53 @@ class StatusFrame(wx.Panel):
         wx.CallAfter(self._update_viewers, status, viewers)
         return True
 
+    @staticmethod
+    def _update_tooltip(element):
+        lines = [element.note[0]] if element.note else []
+        for item in element.history:
+            line = f"{time.strftime('%H:%M:%S', time.localtime(item['time']))} {item['event']}"
+            if item['delay'] is not None:
+                line += f" in {item['delay']:.0f}s"
+            if item['reason']:
+                line += f" ({item['reason']})"
+            lines.append(line)
+        element.status_panel.SetToolTip('\n'.join(lines))
+
+    def _update_history(self, element, history):
+        element.history = history
+        self._update_tooltip(element)
+
+    def _update_note(self, element, note):
+        element.note = note
+        warning = note and note[1]
+        element.viewers_wx.SetForegroundColour(NOTE_WARNING_COLOR if warning else wx.NullColour)
+        element.viewers_wx.Refresh()
+        self._update_tooltip(element)
+
+    def set_reconnect_history(self, module_name, channel, history):
+        if module_name not in self.chats:
+            return
+        if channel.lower() not in self.chats[module_name]:
+            return
+
+        status = self.chats[module_name][channel.lower()]
+        if status.history == history:
+            return
+
+        wx.CallAfter(self._update_history, status, history)
+
+    def set_status_note(self, module_name, channel, note):
+        if module_name not in self.chats:
+            return
+        if channel.lower() not in self.chats[module_name]:
+            return
+
+        status = self.chats[module_name][channel.lower()]
+        if status.note == note:
+            return
+
+        wx.CallAfter(self._update_note, status, note)
+
     def is_shown(self, value):
         self.Show(value)
         self.parent.Layout()
@@ -270,7 +270,14 @@ def main(root_logger):
     )
     loaded_modules['chat'] = chat_init_module
 
-    for chat_module_name in chat_conf_dict['chats'].list:
+    # Relay edge only serves messages received from ingest instance
+    webchat = loaded_modules.get('webchat')
+    chat_list = chat_conf_dict['chats'].list
+    if webchat and webchat.relay_edge:
+        log.info("Webchat is relay edge, chat modules are not loaded")
+        chat_list = []
+
+    for chat_module_name in chat_list:
         log.info("Loading chat module: %s", chat_module_name)
         module_location = os.path.join(chat_location, chat_module_name + ".py")
         if os.path.isfile(module_location):
@@ -12,6 +12,7 @@ from collections import OrderedDict
 from modules.helper.functions import get_class_from_iname, get_modules_in_folder
 from modules.helper.module import MessagingModule, ConfigModule
 from modules.helper.system import ModuleLoadException, THREADS, CONF_FOLDER
+from modules.helper.tracing import STAGE_PIPELINE_IN
 from modules.helper.parser import load_from_config_file
 from modules.interface.types import LCPanel, LCChooseMultiple
 
@@ -108,6 +109,7 @@ class Message(threading.Thread):
         # When we receive message we pass it via all loaded modules
         # All modules should return the message with modified/not modified
         #  content so it can be passed to new module, or to pass to CLI
+        message.mark(STAGE_PIPELINE_IN)
         for m_module in self.modules:
             log.debug('%s', m_module)
             if message:
@@ -134,6 +134,7 @@ class Levels(MessagingModule):
                 level_data['exp'] = level_exp
                 if not level_data['url'].startswith('/'):
                     level_data['url'] = f'/{level_data.get("url", "")}'
+                level_data['level'] = len(self.levels)
 
                 self.levels.append(level_data)
         self.experience_set = [(level['exp'], level) for level in self.levels]
@@ -8,6 +8,9 @@ import jinja2
 import os
 import socket
 import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
 
 import cherrypy
 from cherrypy.lib.static import serve_file
@@ -19,12 +22,15 @@ from ws4py.websocket import WebSocket
 
 from modules.helper.functions import get_themes
 from modules.helper.html_template import HTML_TEMPLATE
+from modules.helper.http_client import client as http_client
+from modules.helper.image_cache import ImageCache, ImageCacheError, CACHE_ROUTE, decode_key
 from modules.helper.message import TextMessage, CommandMessage, SystemMessage, RemoveMessageByIDs, \
-    get_system_message_types, RemoveMessageByUsers
+    get_system_message_types, RemoveMessageByUsers, SEGMENT_EMOTE, SEGMENT_BIT
 from modules.helper.module import MessagingModule
 from modules.helper.parser import save_settings, convert_to_dict, update
-from modules.helper.system import THREADS, CONF_FOLDER, EMOTE_FORMAT, HTTP_FOLDER, TRANSLATIONS, TRANSLATION_FILETYPE, \
-    SPLIT_TRANSLATION
+from modules.helper.tracing import TRACKER, STAGE_PIPELINE_OUT, STAGE_DEQUEUE, STAGE_SEND
+from modules.helper.system import THREADS, CONF_FOLDER, CACHE_FOLDER, EMOTE_FORMAT, HTTP_FOLDER, TRANSLATIONS, TRANSLATION_FILETYPE, \
+    SPLIT_TRANSLATION, translate_key
 from modules.interface.types import *
 
 GUI_CHAT = 'gui_chat'
@@ -35,7 +41,12 @@ logging.getLogger('ws4py').setLevel(logging.ERROR)
 DEFAULT_STYLE = 'default'
 DEFAULT_GUI_STYLE = 'default'
 HISTORY_SIZE = 50
+URL_DICTIONARY_SIZE = 5000
+ENCODE_EWMA_WEIGHT = 0.1
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
 s_queue = queue.Queue()
+image_cache = ImageCache()
+IMAGE_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'img')
 log = logging.getLogger('webchat')
 REMOVED_TRIGGER = '%%REMOVED%%'
 
@@ -45,10 +56,36 @@ SETTINGS_FORMAT_FILE = 'settings_format.json'
 
 WS_THREADS = THREADS + 3
 
+RELAY_DISABLED = 'disabled'
+RELAY_INGEST = 'ingest'
+RELAY_EDGE = 'edge'
+RELAY_RETRY_DELAY = 5
+RELAY_SEND_TIMEOUT = 5
+# Envelopes waiting for a single edge, edge is dropped if it can't keep up
+RELAY_EDGE_QUEUE = 500
+RELAY_ACCEPT_RETRY_DELAY = 1
+
+MESSAGE_KIND_TEXT = 'text'
+MESSAGE_KIND_SYSTEM = 'system'
+MESSAGE_KIND_COMMAND = 'command'
+
 CONF_DICT = LCPanel()
 CONF_DICT['server'] = LCStaticBox()
 CONF_DICT['server']['host'] = LCDropdown('127.0.0.1', ['127.0.0.1', '0.0.0.0'])
 CONF_DICT['server']['port'] = LCText('8080')
+CONF_DICT['rate_limit'] = LCStaticBox()
+CONF_DICT['rate_limit']['messages_per_second'] = LCSpin(0, max_v=1000)
+CONF_DICT['rate_limit']['summary_interval'] = LCSpin(5, min_v=1, max_v=60)
+CONF_DICT['rate_limit']['limit_gui'] = LCBool(False)
+CONF_DICT['relay'] = LCStaticBox()
+CONF_DICT['relay']['mode'] = LCDropdown(RELAY_DISABLED, [RELAY_DISABLED, RELAY_INGEST, RELAY_EDGE])
+CONF_DICT['relay']['address'] = LCText('127.0.0.1:8091')
+CONF_DICT['image_cache'] = LCStaticBox()
+CONF_DICT['image_cache']['enabled'] = LCBool(True)
+CONF_DICT['image_cache']['size_mb'] = LCSpin(200, min_v=10, max_v=10000)
+CONF_DICT['tracing'] = LCStaticBox()
+CONF_DICT['tracing']['sample_percent'] = LCSpin(0, max_v=100)
+CONF_DICT['tracing']['spike_ms'] = LCSpin(0, max_v=60000)
 
 for g_ui_type in CHAT_TYPES:
     CONF_DICT[g_ui_type] = LCPanel()
@@ -60,6 +97,10 @@ for g_ui_type in CHAT_TYPES:
 
 MANDATORY_KEYS = ['show_system_msg', 'show_history']
 
+SKIPPED_MESSAGES = translate_key(MODULE_KEY.join(['webchat', 'rate_limit', 'skipped']))
+
+FILTER_KEYS = ['platform', 'channel', 'type', 'category', 'min_level']
+
 TYPE_DICT = {
     TextMessage: 'message',
     CommandMessage: 'command'
@@ -75,15 +116,28 @@ def merge_lc_dicts(dst, src):
 
 
 def process_emotes(emotes):
-    return [{'id': EMOTE_FORMAT.format(emote.id), 'url': emote.url} for emote in emotes]
+    return [{'id': EMOTE_FORMAT.format(emote.id), 'url': image_cache.url(emote.url)} for emote in emotes]
 
 
 def process_badges(badges):
-    return [{'badge': badge.id, 'url': badge.url} for badge in badges]
+    return [{'badge': badge.id, 'url': image_cache.url(badge.url)} for badge in badges]
+
+
+def process_segments(segments):
+    processed = []
+    for segment in segments:
+        segment = dict(segment)
+        if segment['type'] in (SEGMENT_EMOTE, SEGMENT_BIT):
+            segment['id'] = EMOTE_FORMAT.format(segment['id'])
+        for key in ('text', 'user', 'url'):
+            if key in segment:
+                segment[key] = html.escape(segment[key])
+        processed.append(segment)
+    return processed
 
 
 def process_platform(platform):
-    return {'id': platform.id, 'icon': platform.icon}
+    return {'id': platform.id, 'icon': image_cache.url(platform.icon)}
 
 
 def prepare_message(message, style_settings):
@@ -109,10 +163,288 @@ def prepare_message(message, style_settings):
     payload['badges'] = process_badges(payload.get('badges', {}))
     payload['platform'] = process_platform(payload.get('platform', {}))
 
+    if payload.get('segments') is not None:
+        payload['segments'] = process_segments(payload['segments'])
+
     payload['text'] = html.escape(payload['text'])
     return json_message
 
 
+class UrlDictionary(object):
+    def __init__(self, size=URL_DICTIONARY_SIZE):
+        """
+            Process wide url -> id registry, keeps at most size least recently used urls.
+              Ids are never reused, so id known by client either means its url or nothing;
+              generation changes on every eviction so clients can drop their definitions
+        """
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()
+        self._next_id = 0
+        self.size = size
+        self.generation = 0
+
+    def id(self, url):
+        with self._lock:
+            url_id = self._ids.get(url)
+            if url_id is None:
+                url_id = self._next_id
+                self._next_id += 1
+                self._ids[url] = url_id
+                if len(self._ids) > self.size:
+                    self._ids.popitem(last=False)
+                    self.generation += 1
+            else:
+                self._ids.move_to_end(url)
+        return url_id
+
+    def __len__(self):
+        return len(self._ids)
+
+
+url_dictionary = UrlDictionary()
+
+
+def compact_message(json_message):
+    """
+        Replaces emote, badge and platform icon urls of prepared message with url dictionary ids
+    :return: compacted message copy, dict of used url ids to urls
+    """
+    payload = json_message['payload']
+    if json_message['type'] == 'command' or not any(key in payload for key in ('emotes', 'badges', 'platform')):
+        return json_message, {}
+
+    urls = {}
+
+    def compact(url):
+        url_id = url_dictionary.id(url)
+        urls[url_id] = url
+        return url_id
+
+    payload = dict(payload)
+    if payload.get('emotes'):
+        payload['emotes'] = [dict(emote, url=compact(emote['url'])) for emote in payload['emotes']]
+    if payload.get('badges'):
+        payload['badges'] = [dict(badge, url=compact(badge['url'])) for badge in payload['badges']]
+    if payload.get('platform', {}).get('icon'):
+        payload['platform'] = dict(payload['platform'], icon=compact(payload['platform']['icon']))
+    return dict(json_message, payload=payload), urls
+
+
+def _split_values(values):
+    if isinstance(values, str):
+        values = [values]
+    return frozenset(item.strip().lower() for value in values for item in str(value).split(',') if item.strip())
+
+
+class ClientFilter(object):
+    def __init__(self, platform=None, channel=None, type=None, category=None, min_level=None):
+        """
+            Subscription filter of a single websocket client,
+              predicates are compiled once so broadcasting only runs the needed checks
+        :param platform: platform ids (tw/gg/fs/yt/sy)
+        :param channel: channel names
+        :param type: message types (message/message_sub/message_highlight)
+        :param category: system message categories
+        :param min_level: minimum level index from levels module
+        """
+        self._predicates = []
+
+        platforms = _split_values(platform or ())
+        if platforms:
+            self._predicates.append(lambda meta: meta['platform'] in platforms)
+
+        channels = _split_values(channel or ())
+        if channels:
+            self._predicates.append(lambda meta: str(meta['channel']).lower() in channels)
+
+        types = _split_values(type or ())
+        if types:
+            self._predicates.append(lambda meta: meta['type'] in types)
+
+        categories = _split_values(category or ())
+        if categories:
+            self._predicates.append(
+                lambda meta: meta['kind'] != MESSAGE_KIND_SYSTEM or meta['category'] in categories)
+
+        if isinstance(min_level, (list, tuple)):
+            min_level = min_level[-1] if min_level else None
+        if min_level:
+            level = int(min_level)
+            self._predicates.append(
+                lambda meta: meta['kind'] == MESSAGE_KIND_SYSTEM or meta['level'] >= level)
+
+    def __bool__(self):
+        return bool(self._predicates)
+
+    @classmethod
+    def from_query(cls, query_string):
+        query = parse_qs(query_string or '')
+        return cls(**{key: value for key, value in query.items() if key in FILTER_KEYS})
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{key: value for key, value in data.items() if key in FILTER_KEYS})
+
+    def match(self, meta):
+        """
+        :param meta: message information from message_meta
+        """
+        # Commands (remove/reload) have to reach every client
+        if meta['kind'] == MESSAGE_KIND_COMMAND:
+            return True
+        for predicate in self._predicates:
+            if not predicate(meta):
+                return False
+        return True
+
+
+def message_meta(message):
+    """
+        Delivery information about the message, used by client filters
+          and sent along with encoded frames to relay edges
+    :rtype: dict
+    """
+    if isinstance(message, RelayedMessage):
+        return message.meta
+    if isinstance(message, CommandMessage):
+        return {
+            'kind': MESSAGE_KIND_COMMAND,
+            'unixtime': message.unixtime,
+            'command': message.command,
+            'messages': getattr(message, 'messages', []),
+            'users': getattr(message, 'users', [])
+        }
+    return {
+        'kind': MESSAGE_KIND_SYSTEM if isinstance(message, SystemMessage) else MESSAGE_KIND_TEXT,
+        'unixtime': message.unixtime,
+        'id': message.id,
+        'user': message.user,
+        'platform': message.platform.id,
+        'channel': message.channel,
+        'type': message.message_type,
+        'category': getattr(message, 'category', None),
+        'level': getattr(message, 'levels', {}).get('level', 0)
+    }
+
+
+class RelayedMessage(object):
+    def __init__(self, meta, frames):
+        """
+            Message received by relay edge, already prepared and encoded by ingest instance
+        :param meta: message_meta of original message
+        :param frames: encoded frames by chat type
+        """
+        self.meta = meta
+        self.frames = frames
+        self._timestamp = datetime.datetime.fromtimestamp(meta['unixtime'])
+
+    @property
+    def id(self):
+        return self.meta.get('id')
+
+    @property
+    def user(self):
+        return self.meta.get('user')
+
+    @property
+    def command(self):
+        return self.meta.get('command')
+
+    @property
+    def messages(self):
+        return self.meta.get('messages', [])
+
+    @property
+    def users(self):
+        return self.meta.get('users', [])
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+
+def _openmetrics_label(value):
+    """
+        Escapes label value as OpenMetrics requires: backslash, double quote and line feed
+    """
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _openmetrics_client_labels(client):
+    return f'chat_type="{_openmetrics_label(client["chat_type"])}",address="{_openmetrics_label(client["address"])}"'
+
+
+def _openmetrics_histogram(platform_id, stage, histogram):
+    labels = f'platform="{_openmetrics_label(platform_id)}",stage="{_openmetrics_label(stage)}"'
+    for bound, count in histogram['buckets'].items():
+        yield f'webchat_latency_seconds_bucket{{{labels},le="{"+Inf" if bound == "inf" else bound}"}} {count}'
+    yield f'webchat_latency_seconds_count{{{labels}}} {histogram["count"]}'
+    yield f'webchat_latency_seconds_sum{{{labels}}} {histogram["sum"]}'
+
+
+def render_openmetrics(metrics):
+    lines = [
+        '# TYPE webchat_clients gauge',
+        *[f'webchat_clients{{chat_type="{_openmetrics_label(chat_type)}"}} {count}'
+          for chat_type, count in metrics['clients'].items()],
+        '# TYPE webchat_queue_depth gauge',
+        f"webchat_queue_depth {metrics['queue_depth']}",
+        '# TYPE webchat_history_size gauge',
+        f"webchat_history_size {metrics['history_size']}",
+        '# TYPE webchat_messages counter',
+        f"webchat_messages_total {metrics['messages_sent']}",
+        '# TYPE webchat_bytes counter',
+        f"webchat_bytes_total {metrics['bytes_sent']}",
+        '# TYPE webchat_send_errors counter',
+        f"webchat_send_errors_total {metrics['send_errors']}",
+        '# TYPE webchat_scss_cache_hits counter',
+        f"webchat_scss_cache_hits_total {metrics['scss_cache']['hits']}",
+        '# TYPE webchat_scss_cache_misses counter',
+        f"webchat_scss_cache_misses_total {metrics['scss_cache']['misses']}",
+        '# TYPE webchat_image_cache_hits counter',
+        f"webchat_image_cache_hits_total {metrics['image_cache']['hits']}",
+        '# TYPE webchat_image_cache_misses counter',
+        f"webchat_image_cache_misses_total {metrics['image_cache']['misses']}",
+        '# TYPE webchat_image_cache_size_bytes gauge',
+        '# UNIT webchat_image_cache_size_bytes bytes',
+        f"webchat_image_cache_size_bytes {metrics['image_cache']['size_bytes']}",
+        '# TYPE webchat_encode_seconds gauge',
+        '# UNIT webchat_encode_seconds seconds',
+        f"webchat_encode_seconds {metrics['encoding']['current_seconds']}",
+        '# TYPE webchat_latency_seconds histogram',
+        '# UNIT webchat_latency_seconds seconds',
+        *[line for platform_id, stages in metrics['latency'].items() for stage, histogram in stages.items()
+          for line in _openmetrics_histogram(platform_id, stage, histogram)],
+        '# TYPE webchat_client_messages counter',
+        *[f'webchat_client_messages_total{{{_openmetrics_client_labels(client)}}} {client["messages_sent"]}'
+          for client in metrics['per_client']],
+        '# TYPE webchat_client_bytes counter',
+        *[f'webchat_client_bytes_total{{{_openmetrics_client_labels(client)}}} {client["bytes_sent"]}'
+          for client in metrics['per_client']],
+        '# TYPE webchat_client_send_errors counter',
+        *[f'webchat_client_send_errors_total{{{_openmetrics_client_labels(client)}}} {client["send_errors"]}'
+          for client in metrics['per_client']],
+        '# TYPE webchat_http_requests counter',
+        *[f'webchat_http_requests_total{{host="{_openmetrics_label(host)}"}} {stats["requests"]}'
+          for host, stats in metrics['http'].items()],
+        '# TYPE webchat_http_errors counter',
+        *[f'webchat_http_errors_total{{host="{_openmetrics_label(host)}"}} {stats["errors"]}'
+          for host, stats in metrics['http'].items()],
+        '# TYPE webchat_http_not_modified counter',
+        *[f'webchat_http_not_modified_total{{host="{_openmetrics_label(host)}"}} {stats["not_modified"]}'
+          for host, stats in metrics['http'].items()],
+        '# TYPE webchat_http_seconds counter',
+        '# UNIT webchat_http_seconds seconds',
+        *[f'webchat_http_seconds_total{{host="{_openmetrics_label(host)}"}} {stats["seconds"]}'
+          for host, stats in metrics['http'].items()],
+        '# TYPE webchat_http_bytes counter',
+        *[f'webchat_http_bytes_total{{host="{_openmetrics_label(host)}"}} {stats["bytes"]}'
+          for host, stats in metrics['http'].items()],
+        '# EOF'
+    ]
+    return '\n'.join(lines) + '\n'
+
+
 def add_to_history(message):
     cherrypy.engine.publish('add-history', message)
 
@@ -121,11 +453,105 @@ def process_command(message):
     cherrypy.engine.publish('process-command', message.command, message)
 
 
+class DisplayRateLimiter(object):
+    def __init__(self):
+        """
+            Caps amount of text messages rendered per second for every chat type,
+              messages above the cap are only counted and later summarized
+        """
+        self._lock = threading.Lock()
+        self._limit = 0
+        self._limit_gui = False
+        self._summary_interval = 5
+        self._windows = {chat_type: [0.0, 0] for chat_type in CHAT_TYPES}
+        self._skipped = dict.fromkeys(CHAT_TYPES, 0)
+        self._last_summary = time.monotonic()
+
+    @property
+    def summary_interval(self):
+        return self._summary_interval
+
+    def update_settings(self, limit, summary_interval, limit_gui):
+        with self._lock:
+            self._limit = limit
+            self._summary_interval = summary_interval
+            self._limit_gui = limit_gui
+
+    def allow(self, message, chat_type):
+        if self._limit <= 0 or not isinstance(message, TextMessage) or isinstance(message, SystemMessage):
+            return True
+        if chat_type == GUI_CHAT and not self._limit_gui:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            window = self._windows[chat_type]
+            if now - window[0] >= 1:
+                window[0] = now
+                window[1] = 0
+            if window[1] < self._limit:
+                window[1] += 1
+                return True
+            self._skipped[chat_type] += 1
+            return False
+
+    def pop_summaries(self):
+        """
+            Returns amount of skipped messages per chat type
+              once in summary_interval, resetting the counters
+        :rtype: dict
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_summary < self._summary_interval:
+                return {}
+            self._last_summary = now
+            summaries = {chat_type: count for chat_type, count in self._skipped.items() if count}
+            self._skipped = dict.fromkeys(CHAT_TYPES, 0)
+            return summaries
+
+
+class DeliveryStats(object):
+    def __init__(self):
+        """
+            Delivery counters of a single MessagingThread.
+              Only owning thread writes into them, so delivery path doesn't need locks,
+              readers are working with copies
+        """
+        self.messages = {}
+        self.bytes = {}
+        self.errors = {}
+        self.encoded = 0
+        self.encode_time = 0.0
+        self.encode_ewma = 0.0
+
+    def sent(self, ws, size):
+        self.messages[ws] = self.messages.get(ws, 0) + 1
+        self.bytes[ws] = self.bytes.get(ws, 0) + size
+
+    def error(self, ws):
+        self.errors[ws] = self.errors.get(ws, 0) + 1
+
+    def encode(self, duration):
+        self.encoded += 1
+        self.encode_time += duration
+        self.encode_ewma += (duration - self.encode_ewma) * ENCODE_EWMA_WEIGHT
+
+    def prune(self):
+        for ws in [ws for ws in self.messages.copy() if ws.terminated]:
+            self.messages.pop(ws, None)
+            self.bytes.pop(ws, None)
+            self.errors.pop(ws, None)
+
+
 class MessagingThread(threading.Thread):
-    def __init__(self, settings):
+    def __init__(self, settings, rate_limiter, relay=None):
         super(self.__class__, self).__init__()
         self.daemon = True
         self.settings = settings
+        self.rate_limiter = rate_limiter
+        self.relay = relay  # type: RelayPublisher
+        self.stats = DeliveryStats()
         self.running = True
 
     def system_message_types(self, chat_type):
@@ -133,41 +559,89 @@ class MessagingThread(threading.Thread):
 
     def run(self):
         while self.running:
-            message = s_queue.get()
-
+            self.send_summaries()
+            self.stats.prune()
+            try:
+                message = s_queue.get(timeout=self.rate_limiter.summary_interval)
+            except queue.Empty:
+                continue
             if isinstance(message, dict):
                 raise Exception(f"Got dict message {message}")
+            message.mark(STAGE_DEQUEUE)
 
-            if isinstance(message, TextMessage):
+            # With relay history is stored by publisher, in order with envelopes sent to edges
+            if isinstance(message, TextMessage) and not self.relay:
                 add_to_history(message)
 
             if isinstance(message, CommandMessage):
                 process_command(message)
 
-            if not message.only_gui:
-                self.send_message(message, BROWSER_CHAT)
-            self.send_message(message, GUI_CHAT)
+            meta = message_meta(message)
+            frames = {}
+            if not message.only_gui and self.rate_limiter.allow(message, BROWSER_CHAT):
+                frames[BROWSER_CHAT] = self.send_message(message, BROWSER_CHAT, meta)
+            if self.rate_limiter.allow(message, GUI_CHAT):
+                frames[GUI_CHAT] = self.send_message(message, GUI_CHAT, meta)
+
+            if self.relay:
+                self.relay.publish(meta, frames, store=isinstance(message, TextMessage), message=message)
         log.info("Messaging thread stopping")
 
     def stop(self):
         self.running = False
 
-    def send_message(self, message, chat_type):
+    def send_summaries(self):
+        for chat_type, count in self.rate_limiter.pop_summaries().items():
+            summary = SystemMessage(SKIPPED_MESSAGES.format(count), category='system.module')
+            meta = message_meta(summary)
+            frame = self.send_message(summary, chat_type, meta)
+            if self.relay:
+                self.relay.publish(meta, {chat_type: frame}, store=False)
+
+    def send_message(self, message, chat_type, meta):
+        """
+            Sends message to all clients of chat_type
+        :return: encoded frame, None if message was not encoded
+        """
         if isinstance(message, SystemMessage) and message.category not in self.system_message_types(chat_type):
-            return
+            return None
 
-        send_message = prepare_message(message, self.settings[chat_type])
         c_req = cherrypy.engine.publish('get-clients', chat_type)
-        if not c_req:
-            return
-
-        ws_list = c_req[0]
+        ws_list = [ws for ws in c_req[0] if ws.accepts(meta)] if c_req else []
+        # Relay edges need encoded frame even if there are no local clients
+        if not ws_list and not self.relay:
+            return None
+
+        encode_start = time.perf_counter()
+        json_message = prepare_message(message, self.settings[chat_type])
+        send_message = None
+        if self.relay or not all(ws.dictionary for ws in ws_list):
+            send_message = json.dumps(json_message)
+        compact_frame, urls = None, {}
+        if any(ws.dictionary for ws in ws_list):
+            compact_json, urls = compact_message(json_message)
+            compact_frame = json.dumps(compact_json)
+        self.stats.encode(time.perf_counter() - encode_start)
+
+        sizes = {frame: len(frame.encode('utf-8')) for frame in (send_message, compact_frame) if frame}
         for ws in ws_list:
             try:
-                ws.send(json.dumps(send_message))
+                if ws.dictionary:
+                    definitions = ws.send_with_definitions(compact_frame, urls)
+                    size = sizes[compact_frame]
+                    if definitions:
+                        size += len(definitions.encode('utf-8'))
+                    self.stats.sent(ws, size)
+                else:
+                    ws.send(send_message)
+                    self.stats.sent(ws, sizes[send_message])
+                if message.mark(STAGE_SEND):
+                    TRACKER.observe(message)
             except Exception as exc:
+                self.stats.error(ws)
                 log.exception(exc)
-                log.info(send_message)
+                log.info(send_message or compact_frame)
+        return send_message
 
 
 class FireFirstMessages(threading.Thread):
@@ -184,23 +658,89 @@ class FireFirstMessages(threading.Thread):
             for item in self.history:
                 if isinstance(item, SystemMessage) and item.category not in show_system_msg:
                     continue
+                if not self.ws.accepts(message_meta(item)):
+                    continue
                 timedelta = datetime.datetime.now() - item.timestamp
                 timer = self.settings['keys'].get('clear_timer', LCSpin(-1)).simple()
                 if timer > 0:
                     if timedelta > datetime.timedelta(seconds=timer):
                         continue
 
-                message = prepare_message(item, self.settings)
-                self.ws.send(json.dumps(message))
+                if isinstance(item, RelayedMessage):
+                    if self.ws.type in item.frames:
+                        self.ws.send(item.frames[self.ws.type])
+                    continue
+                self.ws.send_prepared(prepare_message(item, self.settings))
 
 
 class WebChatSocketServer(WebSocket):
     def __init__(self, sock, protocols=None, extensions=None, environ=None, heartbeat_freq=None):
-        WebSocket.__init__(self, sock)
+        WebSocket.__init__(self, sock, environ=environ)
         self.daemon = True
         self.clients = []
         self.settings = cherrypy.engine.publish('get-settings', 'server_chat')[0]
         self.type = 'server_chat'
+        self.filter = self.load_filter(environ)
+        self.dictionary = self.load_dictionary(environ)
+        self.known_urls = set()
+        self.generation = url_dictionary.generation
+        self._send_lock = threading.Lock()
+
+    @staticmethod
+    def load_filter(environ):
+        try:
+            return ClientFilter.from_query((environ or {}).get('QUERY_STRING'))
+        except ValueError as exc:
+            log.warning('Unable to parse client filters: %s', exc)
+        return ClientFilter()
+
+    @staticmethod
+    def load_dictionary(environ):
+        query = parse_qs((environ or {}).get('QUERY_STRING') or '')
+        return query.get('dictionary', ['0'])[-1].lower() in ('1', 'true')
+
+    def accepts(self, meta):
+        return self.filter.match(meta)
+
+    def send_with_definitions(self, frame, urls):
+        """
+            Sends url definitions which client doesn't know yet followed by the frame,
+              after url dictionary eviction client is told to drop everything it knows
+        :return: definitions frame, None if client knows every url
+        """
+        with self._send_lock:
+            payload = {}
+            if self.generation != url_dictionary.generation:
+                self.generation = url_dictionary.generation
+                if self.known_urls:
+                    self.known_urls = set()
+                    payload['reset'] = True
+            missing = urls.keys() - self.known_urls
+            definitions = None
+            if missing or payload:
+                payload['urls'] = {url_id: urls[url_id] for url_id in missing}
+                definitions = json.dumps({'type': 'dictionary', 'payload': payload})
+                self.send(definitions)
+                self.known_urls |= missing
+            self.send(frame)
+        return definitions
+
+    def send_prepared(self, message):
+        if not self.dictionary:
+            self.send(json.dumps(message))
+            return
+        message, urls = compact_message(message)
+        self.send_with_definitions(json.dumps(message), urls)
+
+    def received_message(self, message):
+        try:
+            data = json.loads(str(message))
+            if isinstance(data, dict) and isinstance(data.get('dictionary'), bool):
+                self.dictionary = data['dictionary']
+            if isinstance(data, dict) and isinstance(data.get('filters'), dict):
+                self.filter = ClientFilter.from_dict(data['filters'])
+        except ValueError as exc:
+            log.warning('Unable to parse client frame: %s', exc)
 
     def opened(self):
         cherrypy.engine.publish('add-client', self.peer_address, self)
@@ -219,10 +759,15 @@ class WebChatSocketServer(WebSocket):
 
 class WebChatGUISocketServer(WebChatSocketServer):
     def __init__(self, sock, protocols=None, extensions=None, environ=None, heartbeat_freq=None):
-        WebSocket.__init__(self, sock)
+        WebSocket.__init__(self, sock, environ=environ)
         self.clients = []
         self.settings = cherrypy.engine.publish('get-settings', 'gui_chat')[0]
         self.type = 'gui_chat'
+        self.filter = self.load_filter(environ)
+        self.dictionary = self.load_dictionary(environ)
+        self.known_urls = set()
+        self.generation = url_dictionary.generation
+        self._send_lock = threading.Lock()
 
 
 class WebChatPlugin(WebSocketPlugin):
@@ -240,9 +785,11 @@ class WebChatPlugin(WebSocketPlugin):
         self.bus.subscribe('add-client', self.add_client)
         self.bus.subscribe('del-client', self.del_client)
         self.bus.subscribe('get-clients', self.get_clients)
+        self.bus.subscribe('get-clients-info', self.get_clients_info)
         self.bus.subscribe('add-history', self.add_history)
         self.bus.subscribe('get-history', self.get_history)
         self.bus.subscribe('del-history', self.del_history)
+        self.bus.subscribe('reset-history', self.reset_history)
         self.bus.subscribe('process-command', self.process_command)
 
     def stop(self):
@@ -251,8 +798,10 @@ class WebChatPlugin(WebSocketPlugin):
         self.bus.unsubscribe('add-client', self.add_client)
         self.bus.unsubscribe('del-client', self.del_client)
         self.bus.unsubscribe('get-clients', self.get_clients)
+        self.bus.unsubscribe('get-clients-info', self.get_clients_info)
         self.bus.unsubscribe('add-history', self.add_history)
         self.bus.unsubscribe('get-history', self.get_history)
+        self.bus.unsubscribe('reset-history', self.reset_history)
         self.bus.unsubscribe('process-command', self.process_command)
 
     def add_client(self, addr, websocket):
@@ -273,6 +822,9 @@ class WebChatPlugin(WebSocketPlugin):
                 ws_list.append(client['websocket'])
         return ws_list
 
+    def get_clients_info(self):
+        return list(self.clients)
+
     def add_history(self, message):
         self.history.append(message)
         if len(self.history) > self.history_size:
@@ -286,6 +838,9 @@ class WebChatPlugin(WebSocketPlugin):
             if str(item.id) == msg_id[0]:
                 self.history.pop(index)
 
+    def reset_history(self):
+        self.history = []
+
     def get_settings(self, style_type):
         return self.style_settings[style_type]
 
@@ -385,6 +940,9 @@ class CssRoot(object):
             'scss': self.style_scss
         }
         self.settings = settings
+        self.scss_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     @cherrypy.expose
     def default(self, *args, **kwargs):
@@ -409,6 +967,24 @@ class CssRoot(object):
 
     def style_scss(self, *path):
         self.apply_headers()
+        cherrypy.response.headers['Content-Type'] = 'text/css'
+
+        # Compiled css is valid until file or style settings are changed
+        file_path = os.path.join(self.settings['location'], *path)
+        stamp = (os.path.getmtime(file_path),
+                 tuple((key, repr(value.value)) for key, value in self.settings['keys'].items()))
+        cached_stamp, cached_css = self.scss_cache.get(file_path, (None, None))
+        if cached_stamp == stamp:
+            self.cache_hits += 1
+            return cached_css
+        self.cache_misses += 1
+
+        css = self.compile_scss(file_path)
+        if css is not None:
+            self.scss_cache[file_path] = (stamp, css)
+        return css
+
+    def compile_scss(self, file_path):
         css_namespace = Namespace()
         for key, value in self.settings['keys'].items():
             s_value = value.value
@@ -428,8 +1004,7 @@ class CssRoot(object):
                 raise ValueError("Unable to find comparable values")
             css_namespace.set_variable(f'${key}', css_value)
 
-        cherrypy.response.headers['Content-Type'] = 'text/css'
-        with open(os.path.join(self.settings['location'], *path), 'r', encoding='utf-8') as css:
+        with open(file_path, 'r', encoding='utf-8') as css:
             css_content = css.read()
             compiler = Compiler(namespace=css_namespace)
             # Something wrong with PyScss,
@@ -446,6 +1021,27 @@ class CssRoot(object):
                         log.info(exc)
 
 
+class ImageCacheRoot(object):
+    @cherrypy.expose
+    def default(self, key, *args, **kwargs):
+        if not image_cache.enabled:
+            # Urls rewritten by relay ingest reach edges with disabled cache
+            try:
+                url = decode_key(key)
+            except ImageCacheError as exc:
+                log.debug(exc)
+                raise cherrypy.NotFound()
+            raise cherrypy.HTTPRedirect(url)
+        try:
+            path, content_type = image_cache.get(key)
+        except ImageCacheError as exc:
+            log.debug(exc)
+            raise cherrypy.NotFound()
+        # Cache key is the original url, so image behind it never changes
+        cherrypy.response.headers['Cache-Control'] = 'public, max-age=604800, immutable'
+        return serve_file(path, content_type)
+
+
 class HttpRoot(object):
     def __init__(self, style_settings):
         self.settings = style_settings
@@ -479,6 +1075,7 @@ class SocketThread(threading.Thread):
         self.css_config = None
         self.gui_root_config = None
         self.gui_css_config = None
+        self.css_roots = {}
 
         self.rest_config = None
 
@@ -548,13 +1145,215 @@ class SocketThread(threading.Thread):
             log.error('Unable to start webchat: %s', exc)
 
     def mount_dirs(self):
-        cherrypy.tree.mount(CssRoot(self.style_settings[GUI_CHAT]), '/gui/css', self.gui_css_config)
-        cherrypy.tree.mount(CssRoot(self.style_settings[BROWSER_CHAT]), '/css', self.css_config)
+        self.css_roots = {chat_type: CssRoot(self.style_settings[chat_type]) for chat_type in CHAT_TYPES}
+        cherrypy.tree.mount(self.css_roots[GUI_CHAT], '/gui/css', self.gui_css_config)
+        cherrypy.tree.mount(self.css_roots[BROWSER_CHAT], '/css', self.css_config)
 
         cherrypy.tree.mount(HttpRoot(self.style_settings[GUI_CHAT]), '/gui', self.gui_root_config)
         cherrypy.tree.mount(HttpRoot(self.style_settings[BROWSER_CHAT]), '', self.root_config)
 
         cherrypy.tree.mount(RestRoot(self.style_settings, self.modules), '/rest', self.rest_config)
+        cherrypy.tree.mount(ImageCacheRoot(), CACHE_ROUTE, {'/': {}})
+
+
+def relay_address(address):
+    """
+        Parses relay address, either host:port or unix:/path/to/socket
+    :return: socket family, socket address
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def relay_envelope(meta, frames, store=True, sync=False):
+    envelope = json.dumps({'meta': meta, 'frames': frames, 'store': store, 'sync': sync})
+    return f'{envelope}\n'.encode('utf-8')
+
+
+class RelayEdge(threading.Thread):
+    def __init__(self, connection, address, publisher, history):
+        """
+            Writer of a single connected edge, sends history first
+              and then envelopes queued by publisher
+        """
+        super(self.__class__, self).__init__()
+        self.daemon = True
+        self.connection = connection
+        self.address = address
+        self.publisher = publisher
+        self.history = history
+        self.queue = queue.Queue(maxsize=RELAY_EDGE_QUEUE)
+
+    def run(self):
+        try:
+            self.publisher.sync_history(self.connection, self.history)
+            self.history = None
+            while True:
+                envelope = self.queue.get()
+                if envelope is None:
+                    break
+                self.connection.sendall(envelope)
+        except OSError as exc:
+            log.info('Relay edge %s disconnected: %s', self.address, exc)
+        self.publisher.remove_edge(self)
+
+    def put(self, envelope):
+        """
+        :return: False if edge queue is full
+        """
+        try:
+            self.queue.put_nowait(envelope)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class RelayPublisher(threading.Thread):
+    def __init__(self, address, settings):
+        """
+            Ingest side of relay mode, publishes prepared and encoded messages
+              to connected webchat edge processes
+        :param address: relay address to listen on
+        :param settings: webchat style settings, used for history sync
+        """
+        super(self.__class__, self).__init__()
+        self.daemon = True
+        self.family, self.address = relay_address(address)
+        self.settings = settings
+        self.edges = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        server = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+        else:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind(self.address)
+            server.listen()
+        except OSError as exc:
+            log.error('Unable to start relay at %s: %s', self.address, exc)
+            return
+
+        log.info('Relay is listening at %s', self.address)
+        while True:
+            try:
+                connection, edge_address = server.accept()
+                connection.settimeout(RELAY_SEND_TIMEOUT)
+            except OSError as exc:
+                log.warning('Unable to accept relay edge: %s', exc)
+                time.sleep(RELAY_ACCEPT_RETRY_DELAY)
+                continue
+            log.info('Relay edge connected %s', edge_address)
+            # History is taken together with registration so edge doesn't miss messages in between
+            with self._lock:
+                history = cherrypy.engine.publish('get-history')
+                edge = RelayEdge(connection, edge_address, self, list(history[0]) if history else [])
+                self.edges.append(edge)
+            edge.start()
+
+    def remove_edge(self, edge):
+        with self._lock:
+            if edge in self.edges:
+                self.edges.remove(edge)
+        edge.close()
+
+    def sync_history(self, edge, history):
+        for item in history:
+            frames = {}
+            for chat_type in CHAT_TYPES:
+                if chat_type == BROWSER_CHAT and item.only_gui:
+                    continue
+                show_system_msg = self.settings[chat_type]['keys'].get('show_system_msg', get_system_message_types())
+                if isinstance(item, SystemMessage) and item.category not in show_system_msg:
+                    continue
+                frames[chat_type] = json.dumps(prepare_message(item, self.settings[chat_type]))
+            edge.sendall(relay_envelope(message_meta(item), frames, sync=True))
+
+    def publish(self, meta, frames, store=True, message=None):
+        """
+        :param message: message added to history together with sending,
+          so edge connecting at the same time gets it either in history or live, never both
+        """
+        frames = {chat_type: frame for chat_type, frame in frames.items() if frame is not None}
+        if not frames and meta['kind'] != MESSAGE_KIND_COMMAND:
+            if store and message is not None:
+                add_to_history(message)
+            return
+
+        envelope = relay_envelope(meta, frames, store=store)
+        with self._lock:
+            if store and message is not None:
+                add_to_history(message)
+            dropped = [edge for edge in self.edges if not edge.put(envelope)]
+        for edge in dropped:
+            log.warning('Relay edge %s is too slow, dropping it', edge.address)
+            self.remove_edge(edge)
+
+
+class RelaySubscriber(threading.Thread):
+    def __init__(self, address):
+        """
+            Edge side of relay mode, receives encoded messages from ingest instance
+              and serves them to local webchat clients
+        :param address: relay address of ingest instance
+        """
+        super(self.__class__, self).__init__()
+        self.daemon = True
+        self.family, self.address = relay_address(address)
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                with socket.socket(self.family, socket.SOCK_STREAM) as relay:
+                    relay.connect(self.address)
+                    log.info('Connected to relay at %s', self.address)
+                    # Ingest sends its history after connect
+                    cherrypy.engine.publish('reset-history')
+                    with relay.makefile('r', encoding='utf-8') as stream:
+                        for line in stream:
+                            self.process_envelope(json.loads(line))
+                log.info('Relay connection closed')
+            except (OSError, ValueError) as exc:
+                log.warning('Relay connection to %s failed: %s', self.address, exc)
+            time.sleep(RELAY_RETRY_DELAY)
+
+    def stop(self):
+        self.running = False
+
+    @staticmethod
+    def process_envelope(envelope):
+        message = RelayedMessage(envelope['meta'], envelope['frames'])
+        if envelope['store']:
+            add_to_history(message)
+        if message.meta['kind'] == MESSAGE_KIND_COMMAND:
+            process_command(message)
+        if envelope['sync']:
+            return
+
+        for chat_type, frame in message.frames.items():
+            c_req = cherrypy.engine.publish('get-clients', chat_type)
+            for ws in c_req[0] if c_req else []:
+                if not ws.accepts(message.meta):
+                    continue
+                try:
+                    ws.send(frame)
+                except Exception as exc:
+                    log.exception(exc)
 
 
 def socket_open(host, port):
@@ -580,12 +1379,17 @@ class Webchat(MessagingModule):
         self.socket_thread = None
         self.queue = kwargs.get('queue')
         self.message_threads = []
+        self.relay = None
+        self.rate_limiter = DisplayRateLimiter()
+        self.update_rate_limiter()
+        self.update_tracing()
 
         # Rest Api Settings
         self.rest_add('GET', 'style', self.rest_get_style_settings)
         self.rest_add('GET', 'style_gui', self.rest_get_style_settings)
         self.rest_add('GET', 'history', self.rest_get_history)
         self.rest_add('DELETE', 'chat', self.rest_delete_history)
+        self.rest_add('GET', 'metrics', self.rest_get_metrics)
 
     def load_module(self, *args, **kwargs):
         MessagingModule.load_module(self, *args, **kwargs)
@@ -601,8 +1405,22 @@ class Webchat(MessagingModule):
             except:
                 log.error('Unable to bind at %s:%s', self.host, self.port)
 
+            if self.get_config('image_cache', 'enabled').simple():
+                image_cache.configure(IMAGE_CACHE_FOLDER, self.get_config('image_cache', 'size_mb').simple() * 1024 * 1024)
+
+            relay_mode = self.get_config('relay', 'mode').simple()
+            address = self.get_config('relay', 'address').simple()
+            publisher = None
+            if relay_mode == RELAY_INGEST:
+                publisher = RelayPublisher(address, self.style_settings)
+                self.relay = publisher
+            elif relay_mode == RELAY_EDGE:
+                self.relay = RelaySubscriber(address)
+            if self.relay:
+                self.relay.start()
+
             for thread in range(WS_THREADS):
-                self.message_threads.append(MessagingThread(self.style_settings))
+                self.message_threads.append(MessagingThread(self.style_settings, self.rate_limiter, relay=publisher))
                 self.message_threads[thread].start()
         else:
             log.error("Port is already used, please change webchat port")
@@ -622,6 +1440,15 @@ class Webchat(MessagingModule):
     def reload_chat(self):
         self.queue.put(CommandMessage('reload'))
 
+    def update_tracing(self):
+        TRACKER.sample_rate = self.get_config('tracing', 'sample_percent').simple() / 100.0
+        TRACKER.spike_threshold = self.get_config('tracing', 'spike_ms').simple() / 1000.0
+
+    def update_rate_limiter(self):
+        self.rate_limiter.update_settings(self.get_config('rate_limit', 'messages_per_second').simple(),
+                                          self.get_config('rate_limit', 'summary_interval').simple(),
+                                          self.get_config('rate_limit', 'limit_gui').simple())
+
     def apply_settings(self, **kwargs):
         save_settings(self.conf_params, ignored_sections=self.conf_params['gui'].get('ignored_sections', ()))
         html_template = jinja2.Template(HTML_TEMPLATE)
@@ -630,6 +1457,8 @@ class Webchat(MessagingModule):
         if 'system_exit' in kwargs:
             return
 
+        self.update_rate_limiter()
+        self.update_tracing()
         changes = [item.split(MODULE_KEY)[1] for item in kwargs.get('changes').keys()]
         changed_chat_type = [item for item in changes if item in self.style_settings]
         for chat in changed_chat_type:
@@ -650,6 +1479,8 @@ class Webchat(MessagingModule):
 
     def _process_message(self, message, **kwargs):
         if not hasattr(message, 'hidden'):
+            # Webchat is the last module, message leaves the pipeline here
+            message.mark(STAGE_PIPELINE_OUT)
             s_queue.put(message)
         return message
 
@@ -662,11 +1493,78 @@ class Webchat(MessagingModule):
 
         return json.dumps(convert_to_dict(self.style_settings[chat_type]['keys']))
 
+    @property
+    def relay_edge(self):
+        return self.get_config('relay', 'mode').simple() == RELAY_EDGE
+
     def rest_get_history(self, *args, **kwargs):
-        return json.dumps([
-            prepare_message(message, self.style_settings['chat'])
-            for message in cherrypy.engine.publish('get-history')[0]
-        ])
+        history = []
+        for message in cherrypy.engine.publish('get-history')[0]:
+            if isinstance(message, RelayedMessage):
+                # Edge history holds frames already prepared by ingest
+                if BROWSER_CHAT in message.frames:
+                    history.append(json.loads(message.frames[BROWSER_CHAT]))
+                continue
+            history.append(prepare_message(message, self.style_settings[BROWSER_CHAT]))
+        return json.dumps(history)
+
+    def get_metrics(self):
+        clients = cherrypy.engine.publish('get-clients-info')
+        clients = clients[0] if clients else []
+        history = cherrypy.engine.publish('get-history')
+        stats = [thread.stats for thread in self.message_threads]
+
+        clients_info = []
+        for client in clients:
+            ws = client['websocket']
+            clients_info.append({
+                'chat_type': ws.type,
+                'address': f"{client['ip']}:{client['port']}",
+                'messages_sent': sum(stat.messages.get(ws, 0) for stat in stats),
+                'bytes_sent': sum(stat.bytes.get(ws, 0) for stat in stats),
+                'send_errors': sum(stat.errors.get(ws, 0) for stat in stats),
+            })
+
+        css_roots = self.socket_thread.css_roots.values() if self.socket_thread else []
+        cache_hits = sum(root.cache_hits for root in css_roots)
+        cache_misses = sum(root.cache_misses for root in css_roots)
+
+        encoded = sum(stat.encoded for stat in stats)
+        encoding_threads = [stat.encode_ewma for stat in stats if stat.encoded]
+        return {
+            'clients': {chat_type: len([client for client in clients_info if client['chat_type'] == chat_type])
+                        for chat_type in CHAT_TYPES},
+            'queue_depth': s_queue.qsize(),
+            'history_size': len(history[0]) if history else 0,
+            'messages_sent': sum(sum(stat.messages.copy().values()) for stat in stats),
+            'bytes_sent': sum(sum(stat.bytes.copy().values()) for stat in stats),
+            'send_errors': sum(sum(stat.errors.copy().values()) for stat in stats),
+            'scss_cache': {
+                'hits': cache_hits,
+                'misses': cache_misses,
+                'hit_rate': cache_hits / (cache_hits + cache_misses) if cache_hits + cache_misses else 0.0
+            },
+            'image_cache': {
+                'hits': image_cache.hits,
+                'misses': image_cache.misses,
+                'size_bytes': image_cache.size
+            },
+            'encoding': {
+                'messages': encoded,
+                'average_seconds': sum(stat.encode_time for stat in stats) / encoded if encoded else 0.0,
+                'current_seconds': sum(encoding_threads) / len(encoding_threads) if encoding_threads else 0.0
+            },
+            'per_client': clients_info,
+            'http': http_client.metrics(),
+            'latency': TRACKER.json()
+        }
+
+    def rest_get_metrics(self, path, **kwargs):
+        metrics = self.get_metrics()
+        if (path and path[0] == 'openmetrics') or kwargs.get('format') == 'openmetrics':
+            cherrypy.response.headers['Content-Type'] = OPENMETRICS_CONTENT_TYPE
+            return render_openmetrics(metrics)
+        return json.dumps(metrics)
 
     @staticmethod
     def rest_delete_history(path, **kwargs):
@@ -747,7 +1645,7 @@ class Webchat(MessagingModule):
             } for ui_type in CHAT_TYPES
         }
         redraw.update({
-            'non_dynamic': ['server.*'],
+            'non_dynamic': ['server.*', 'relay.*', 'image_cache.*'],
             'system': {'hidden': ['enabled']},
             'ignored_sections': ['gui_chat.style_settings', 'server_chat.style_settings']
         })
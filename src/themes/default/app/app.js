@@ -7,12 +7,14 @@ var twemoji = require('twemoji');
     new Vue({
         el: '#chat-container',
         data: function () {
-            var wsUrl = 'ws://' + window.location.host + window.location.pathname + 'ws';
+            var wsUrl = 'ws://' + window.location.host + window.location.pathname + 'ws' +
+                (window.location.search ? window.location.search + '&' : '?') + 'dictionary=1';
             var messages = [];
             var socket = new WebSocket(wsUrl);
 
             return {
                 messages: messages,
+                urls: {},
                 url: wsUrl,
                 socket: socket,
                 attempts: 0,
@@ -87,7 +89,9 @@ var twemoji = require('twemoji');
                 }
             },
             sanitize: function (message) {
-                var clean = this.replaceEmotions(message.text, message.emotes);
+                var clean = message.segments ?
+                    this.renderSegments(message.segments, message.emotes) :
+                    this.replaceEmotions(message.text, message.emotes);
                 if (!clean) this.remove(message);
                 return clean;
             },
@@ -99,6 +103,35 @@ var twemoji = require('twemoji');
                     },
                     tw_message);
             },
+            renderSegments: function (segments, emotes) {
+                var urls = {};
+                emotes.forEach(function (emote) {
+                    urls[emote.id] = emote.url;
+                });
+                return segments.map(function (segment) {
+                    switch (segment.type) {
+                        case 'emote':
+                            return '<img class="smile" src="' + urls[segment.id] + '"  alt=""/>';
+                        case 'bit':
+                            return '<img class="smile" src="' + urls[segment.id] + '"  alt=""/>' + segment.amount;
+                        case 'mention':
+                            return '<span class="mention">' + segment.text + '</span>';
+                        case 'link':
+                            return '<span class="link">' + segment.text + '</span>';
+                        default:
+                            return twemoji.parse(segment.text);
+                    }
+                }).join('');
+            },
+            resolveUrls: function (message) {
+                var urls = this.urls;
+                (message.emotes || []).concat(message.badges || []).forEach(function (item) {
+                    if (typeof item.url === 'number') item.url = urls[item.url];
+                });
+                if (message.platform && typeof message.platform.icon === 'number') {
+                    message.platform.icon = urls[message.platform.icon];
+                }
+            },
             removeByIds: function (ids) {
                 this.messages = this.messages.filter(function (message) {
                     return ids.indexOf(message.id) < 0;
@@ -125,6 +158,7 @@ var twemoji = require('twemoji');
 
                     if (index >= 0) {
                         message.text = text;
+                        message.segments = null;
                         message.emotes = [];
                     }
 
@@ -137,6 +171,7 @@ var twemoji = require('twemoji');
 
                     if (index >= 0) {
                         message.text = text;
+                        message.segments = null;
                         message.emotes = [];
                         message.pm = false;
                     }
@@ -173,7 +208,13 @@ var twemoji = require('twemoji');
                     case 'command':
                         this.run(message.payload);
                         break;
+                    case 'dictionary':
+                        if (message.payload.reset)
+                            this.urls = {};
+                        Object.assign(this.urls, message.payload.urls);
+                        break;
                     default:
+                        this.resolveUrls(message.payload);
                         message.payload.time = new Date();
                         message.payload.deleteButton = false;
                         message.payload.old = false;
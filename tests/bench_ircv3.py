@@ -0,0 +1,65 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+"""
+    Microbenchmark of twitch chat line parsing,
+      compares lazy parse_line/Tags with eager tag parsing of irc library
+
+    python -m tests.bench_ircv3
+"""
+import timeit
+
+import irc.client
+from irc.message import Tag, Arguments
+
+from modules.helper.ircv3 import parse_line
+from tests.test_ircv3 import PRIVMSG
+
+NUMBER = 20000
+REPEAT = 5
+# Tags read by TwitchMessageHandler for a regular message
+ACCESSED_TAGS = ('display-name', 'badges', 'emotes', 'color', 'msg-id', 'bits')
+
+LINES = [
+    PRIVMSG,
+    b'@badge-info=subscriber/14;badges=subscriber/12,bits/1000;bits=100;color=#1E90FF;display-name=Cheerer;'
+    b'emotes=;first-msg=0;flags=;id=6c1b3a4e-6a51-4f0a-a9a4-4c1bd4a2b1f5;mod=0;returning-chatter=0;'
+    b'room-id=1337;subscriber=1;tmi-sent-ts=1507246572675;turbo=0;user-id=42;user-type= '
+    b':cheerer!cheerer@cheerer.tmi.twitch.tv PRIVMSG #ronni :cheer100 nice stream',
+    rb'@badge-info=;badges=;color=;display-name=Sub;emotes=;flags=;id=1;login=sub;mod=0;msg-id=resub;'
+    rb'msg-param-cumulative-months=6;msg-param-sub-plan=1000;room-id=1337;subscriber=1;'
+    rb'system-msg=Sub\ssubscribed\sat\sTier\s1.\sThey\'ve\ssubscribed\sfor\s6\smonths!;'
+    rb'tmi-sent-ts=1507246572675;user-id=43;user-type= :tmi.twitch.tv USERNOTICE #ronni :still here',
+]
+
+
+def read_tags(tags):
+    return [tags[key] if key in tags else None for key in ACCESSED_TAGS]
+
+
+def eager_parse(line):
+    match = irc.client._rfc_1459_command_regexp.match(line.decode('utf-8', 'replace'))
+    tags = {tag['key']: tag['value'] for tag in Tag.from_group(match.group('tags')) or [] if tag['value']}
+    # First argument is the channel, parse_line keeps it in target
+    arguments = Arguments.from_group(match.group('argument'))[1:]
+    return read_tags(tags), arguments
+
+
+def lazy_parse(line):
+    event = parse_line(line)
+    return read_tags(event.tags), event.arguments
+
+
+def bench(name, function):
+    best = min(timeit.repeat(lambda: [function(line) for line in LINES], number=NUMBER, repeat=REPEAT))
+    print(f'{name:>6}: {best / NUMBER / len(LINES) * 1e6:.2f}us per line')
+
+
+def main():
+    for line in LINES:
+        assert eager_parse(line) == lazy_parse(line), line
+    print(f'{len(LINES)} lines, best of {REPEAT} runs of {NUMBER}')
+    bench('eager', eager_parse)
+    bench('lazy', lazy_parse)
+
+
+if __name__ == '__main__':
+    main()
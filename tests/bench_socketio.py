@@ -0,0 +1,40 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+"""
+    Microbenchmark of socket.io frame decoding on recorded sc2tv frames,
+      compares decode_frame with regex based parsing it replaced
+
+    python -m tests.bench_socketio
+"""
+import json
+import re
+import timeit
+
+from modules.helper.socketio import decode_frame
+from tests.test_socketio import recorded_frames
+
+NUMBER = 20000
+REPEAT = 5
+FRAME_REGEXP = re.compile(r'(\d+)(.*)')
+
+
+def regex_decode(frame):
+    packet_id, body = FRAME_REGEXP.match(frame).groups()
+    return packet_id, json.loads(body) if body else None
+
+
+def bench(name, function, frames):
+    best = min(timeit.repeat(lambda: [function(frame) for frame in frames], number=NUMBER, repeat=REPEAT))
+    print(f'{name:>14}: {best / NUMBER / len(frames) * 1e6:.2f}us per frame')
+
+
+def main():
+    frames = recorded_frames()
+    frames_bytes = [frame.encode('utf-8') for frame in frames]
+    print(f'{len(frames)} recorded frames, best of {REPEAT} runs of {NUMBER}')
+    bench('regex', regex_decode, frames)
+    bench('decode_frame', decode_frame, frames)
+    bench('decode (bytes)', decode_frame, frames_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+"""
+    Microbenchmark of twitch emotes tag parsing,
+      compares parse_emotes with dict based parsing it replaced
+
+    python -m tests.bench_twitch_emotes
+"""
+import timeit
+
+from modules.helper.ircv3 import parse_emotes
+
+NUMBER = 2000
+REPEAT = 5
+EMOTE_IDS = ['25', '1902', '354', 'emotesv2_a1b2c3_HF']
+
+
+def emote_message(count):
+    """
+    :return: message text with count emotes and its emotes tag
+    """
+    words = [f'word{index}' if index % 2 else ['Kappa', 'Keepo', 'Jebaited', 'KappaHD'][index // 2 % 4]
+             for index in range(count * 2)]
+    positions = {}
+    offset = 0
+    for index, word in enumerate(words):
+        if not index % 2:
+            emote_id = EMOTE_IDS[index // 2 % len(EMOTE_IDS)]
+            positions.setdefault(emote_id, []).append(f'{offset}-{offset + len(word) - 1}')
+        offset += len(word) + 1
+    tag = '/'.join(f"{emote_id}:{','.join(ranges)}" for emote_id, ranges in positions.items())
+    return ' '.join(words), tag
+
+
+def dict_parse(emotes_tag, text_length):
+    conveyor_emotes = []
+    for emote in emotes_tag.split('/'):
+        emote_id, emote_pos_diap = emote.split(':')
+        for position in emote_pos_diap.split(','):
+            start, end = position.split('-')
+            conveyor_emotes.append({'emote_id': emote_id, 'start': int(start), 'end': int(end)})
+    return sorted(conveyor_emotes, key=lambda k: k['start'])
+
+
+def bench(name, function, text, tag):
+    text_length = len(text)
+    best = min(timeit.repeat(lambda: function(tag, text_length), number=NUMBER, repeat=REPEAT))
+    print(f'{name:>12}: {best / NUMBER * 1e6:.2f}us per message')
+
+
+def main():
+    for count in (1, 10, 200):
+        text, tag = emote_message(count)
+        print(f'{count} emotes, best of {REPEAT} runs of {NUMBER}')
+        bench('dict', dict_parse, text, tag)
+        bench('parse_emotes', parse_emotes, text, tag)
+
+
+if __name__ == '__main__':
+    main()
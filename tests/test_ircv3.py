@@ -0,0 +1,111 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import unittest
+
+from modules.helper.ircv3 import Tags, parse_line, unescape_tag
+
+PRIVMSG = b'@badge-info=;badges=broadcaster/1;color=#0D4200;display-name=Ronni;emotes=25:0-4,12-16/1902:6-10;' \
+          b'id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;mod=0;room-id=1337;subscriber=0;tmi-sent-ts=1507246572675;' \
+          b'turbo=1;user-id=1337;user-type=global_mod :ronni!ronni@ronni.tmi.twitch.tv PRIVMSG #ronni :Kappa Keepo Kappa'
+
+
+class UnescapeTagTest(unittest.TestCase):
+    def test_escapes(self):
+        self.assertEqual(unescape_tag(r'a\sb\:c\\d\re\nf'), 'a b;c\\d\re\nf')
+
+    def test_unknown_and_trailing(self):
+        self.assertEqual(unescape_tag(r'\b'), 'b')
+        self.assertEqual(unescape_tag('end\\'), 'end')
+
+
+class TagsTest(unittest.TestCase):
+    def test_lookup(self):
+        tags = Tags(b'color=#0D4200;display-name=Ronni;emotes=25:0-4')
+        self.assertEqual(tags['color'], '#0D4200')
+        self.assertEqual(tags['display-name'], 'Ronni')
+        self.assertEqual(tags['emotes'], '25:0-4')
+
+    def test_key_is_not_matched_inside_other_key(self):
+        tags = Tags(b'msg-id=sub;id=abc')
+        self.assertEqual(tags['id'], 'abc')
+        self.assertEqual(Tags(b'msg-id=sub')['msg-id'], 'sub')
+        self.assertNotIn('id', Tags(b'msg-id=sub'))
+
+    def test_empty_value_is_missing(self):
+        tags = Tags(b'badge-info=;badges=broadcaster/1;emotes=')
+        self.assertNotIn('badge-info', tags)
+        self.assertNotIn('emotes', tags)
+        self.assertIn('badges', tags)
+        with self.assertRaises(KeyError):
+            tags['emotes']
+        self.assertEqual(tags.get('emotes'), None)
+
+    def test_escaped_value(self):
+        tags = Tags(r'system-msg=5\sraiders\sfrom\sTestChannel\:\shello'.encode('utf-8'))
+        self.assertEqual(tags['system-msg'], '5 raiders from TestChannel; hello')
+
+    def test_unicode(self):
+        self.assertEqual(Tags('display-name=Тест'.encode('utf-8'))['display-name'], 'Тест')
+
+    def test_mapping(self):
+        tags = Tags(b'a=1;b=;c=3')
+        self.assertEqual(list(tags), ['a', 'c'])
+        self.assertEqual(len(tags), 2)
+        self.assertEqual(dict(tags), {'a': '1', 'c': '3'})
+
+
+class ParseLineTest(unittest.TestCase):
+    def test_privmsg(self):
+        event = parse_line(PRIVMSG)
+        self.assertEqual(event.type, 'pubmsg')
+        self.assertEqual(event.source, 'ronni!ronni@ronni.tmi.twitch.tv')
+        self.assertEqual(event.target, '#ronni')
+        self.assertEqual(event.arguments, ['Kappa Keepo Kappa'])
+        self.assertEqual(event.tags['emotes'], '25:0-4,12-16/1902:6-10')
+        self.assertNotIn('badge-info', event.tags)
+
+    def test_action(self):
+        event = parse_line(b'@color=#FF0000 :nick!nick@nick.tmi.twitch.tv PRIVMSG #chan :\x01ACTION waves\x01')
+        self.assertEqual(event.type, 'action')
+        self.assertEqual(event.arguments, ['waves'])
+
+    def test_other_ctcp(self):
+        self.assertIsNone(parse_line(b':nick!nick@nick.tmi.twitch.tv PRIVMSG #chan :\x01VERSION\x01'))
+
+    def test_without_tags(self):
+        event = parse_line(b':nick!nick@nick.tmi.twitch.tv PRIVMSG #chan :hello world')
+        self.assertEqual(event.arguments, ['hello world'])
+        self.assertEqual(len(event.tags), 0)
+
+    def test_usernotice_without_text(self):
+        event = parse_line(rb'@msg-id=raid;system-msg=raid\sincoming :tmi.twitch.tv USERNOTICE #chan')
+        self.assertEqual(event.type, 'usernotice')
+        self.assertEqual(event.arguments, [])
+        self.assertEqual(event.tags['system-msg'], 'raid incoming')
+
+    def test_usernotice_with_text(self):
+        event = parse_line(b'@msg-id=resub :tmi.twitch.tv USERNOTICE #chan :still here')
+        self.assertEqual(event.arguments, ['still here'])
+
+    def test_clearchat(self):
+        event = parse_line(b'@ban-duration=600 :tmi.twitch.tv CLEARCHAT #chan :baduser')
+        self.assertEqual(event.type, 'clearchat')
+        self.assertEqual(event.arguments, ['baduser'])
+
+        event = parse_line(b':tmi.twitch.tv CLEARCHAT #chan')
+        self.assertEqual(event.arguments, [])
+
+    def test_unicode_text(self):
+        event = parse_line(':nick!nick@nick.tmi.twitch.tv PRIVMSG #chan :привет 👋'.encode('utf-8'))
+        self.assertEqual(event.arguments, ['привет 👋'])
+
+    def test_generic_lines(self):
+        for line in (b'PING :tmi.twitch.tv',
+                     b':tmi.twitch.tv 001 justinfan123 :Welcome, GLHF!',
+                     b':nick!nick@nick.tmi.twitch.tv JOIN #chan',
+                     b'@msg-id=host_on :tmi.twitch.tv NOTICE #chan :Now hosting',
+                     b':nick!nick@nick.tmi.twitch.tv PRIVMSG justinfan123 :private'):
+            self.assertIsNone(parse_line(line), line)
+
+
+if __name__ == '__main__':
+    unittest.main()
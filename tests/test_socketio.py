@@ -0,0 +1,106 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import json
+import os
+import unittest
+
+from modules.helper.socketio import decode_frame, encode_packet, SocketIOError, ENGINE_OPEN, ENGINE_PONG, \
+    ENGINE_MESSAGE, SOCKET_CONNECT, SOCKET_EVENT, SOCKET_ACK
+
+FRAMES_FILE = os.path.join(os.path.dirname(__file__), 'frames', 'sc2tv.txt')
+
+
+def recorded_frames():
+    with open(FRAMES_FILE, 'r', encoding='utf-8') as frames_file:
+        return [line.rstrip('\n') for line in frames_file if line.strip()]
+
+
+class DecodeFrameTest(unittest.TestCase):
+    def test_open(self):
+        packet = decode_frame('0{"sid":"abc","pingInterval":25000}')
+        self.assertEqual(packet.engine_type, ENGINE_OPEN)
+        self.assertIsNone(packet.type)
+        self.assertEqual(packet.data['sid'], 'abc')
+
+    def test_pong(self):
+        packet = decode_frame('3')
+        self.assertEqual(packet.engine_type, ENGINE_PONG)
+        self.assertIsNone(packet.data)
+
+    def test_connect(self):
+        packet = decode_frame('40')
+        self.assertEqual((packet.engine_type, packet.type), (ENGINE_MESSAGE, SOCKET_CONNECT))
+        self.assertIsNone(packet.data)
+
+    def test_bare_event(self):
+        packet = decode_frame('42')
+        self.assertEqual(packet.type, SOCKET_EVENT)
+        self.assertIsNone(packet.ack_id)
+        self.assertIsNone(packet.data)
+
+    def test_event(self):
+        packet = decode_frame('42["/chat/message",{"text":"привет"}]')
+        self.assertEqual(packet.type, SOCKET_EVENT)
+        self.assertIsNone(packet.namespace)
+        self.assertIsNone(packet.ack_id)
+        self.assertEqual(packet.data, ['/chat/message', {'text': 'привет'}])
+
+    def test_ack(self):
+        packet = decode_frame('430[{"status":"ok"}]')
+        self.assertEqual(packet.type, SOCKET_ACK)
+        self.assertEqual(packet.ack_id, 0)
+        self.assertEqual(packet.data, [{'status': 'ok'}])
+
+        self.assertEqual(decode_frame('43125[1]').ack_id, 125)
+
+    def test_namespace(self):
+        packet = decode_frame('42/chat,7["event",{}]')
+        self.assertEqual(packet.namespace, '/chat')
+        self.assertEqual(packet.ack_id, 7)
+        self.assertEqual(packet.data, ['event', {}])
+
+        packet = decode_frame('40/chat')
+        self.assertEqual(packet.namespace, '/chat')
+        self.assertIsNone(packet.data)
+
+    def test_bytes_and_str(self):
+        frame = '42["/chat/message",{"text":"привет :peka:"}]'
+        self.assertEqual(decode_frame(frame).data, decode_frame(frame.encode('utf-8')).data)
+
+    def test_invalid(self):
+        for frame in ('', b'', 'x', '4', '4x', 'a42[]'):
+            with self.assertRaises(SocketIOError, msg=frame):
+                decode_frame(frame)
+        with self.assertRaises(ValueError):
+            decode_frame('42[broken')
+
+    def test_custom_loads(self):
+        packet = decode_frame('42["a"]', loads=lambda data: ('loaded', bytes(data)))
+        self.assertEqual(packet.data, ('loaded', b'["a"]'))
+
+    def test_recorded_frames(self):
+        for frame in recorded_frames():
+            packet = decode_frame(frame)
+            self.assertIn(packet.engine_type, (ENGINE_OPEN, ENGINE_PONG, ENGINE_MESSAGE), frame)
+            if packet.type in (SOCKET_EVENT, SOCKET_ACK):
+                self.assertIsInstance(packet.data, list, frame)
+            if packet.type == SOCKET_EVENT:
+                self.assertTrue(packet.data[0].startswith('/chat/'), frame)
+
+
+class EncodePacketTest(unittest.TestCase):
+    def test_event(self):
+        payload = ['/chat/join', {'channel': 'stream/134581'}]
+        self.assertEqual(encode_packet(SOCKET_EVENT, payload), '42' + json.dumps(payload))
+
+    def test_ack_id(self):
+        self.assertTrue(encode_packet(SOCKET_EVENT, ['a'], ack_id=0).startswith('420['))
+        self.assertTrue(encode_packet(SOCKET_EVENT, ['a'], ack_id=15).startswith('4215['))
+
+    def test_round_trip(self):
+        payload = ['/chat/publish', {'channel': 'stream/1', 'text': 'текст 42 "quoted"'}]
+        packet = decode_frame(encode_packet(SOCKET_EVENT, payload, ack_id=31))
+        self.assertEqual((packet.type, packet.ack_id, packet.data), (SOCKET_EVENT, 31, payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# Copyright (C) 2016   CzT/Vladislav Ivanov
+import unittest
+
+from modules.helper.ircv3 import parse_emotes
+
+
+class ParseEmotesTest(unittest.TestCase):
+    def parse(self, emotes_tag, text):
+        return parse_emotes(emotes_tag, len(text))
+
+    def test_single(self):
+        self.assertEqual(self.parse('25:0-4', 'Kappa'), [(0, 5, '25')])
+
+    def test_sorted_by_position(self):
+        text = 'Kappa Keepo Kappa'
+        ranges = self.parse('25:0-4,12-16/1902:6-10', text)
+        self.assertEqual(ranges, [(0, 5, '25'), (6, 11, '1902'), (12, 17, '25')])
+        self.assertEqual([text[start:end] for start, end, _ in ranges], ['Kappa', 'Keepo', 'Kappa'])
+
+    def test_code_point_positions(self):
+        text = '👋 привет Kappa'
+        ranges = self.parse('25:9-13', text)
+        self.assertEqual([text[start:end] for start, end, _ in ranges], ['Kappa'])
+
+    def test_modified_emote_id(self):
+        self.assertEqual(self.parse('emotesv2_a1b2c3_HF:0-4', 'Kappa'), [(0, 5, 'emotesv2_a1b2c3_HF')])
+
+    def test_out_of_text(self):
+        self.assertEqual(self.parse('25:0-4,6-10', 'Kappa'), [(0, 5, '25')])
+
+    def test_malformed(self):
+        for emotes_tag in ('', '25', '25:', '25:a-b', '25:4-0', '25:-4', '25:0-'):
+            self.assertEqual(self.parse(emotes_tag, 'Kappa'), [], emotes_tag)
+        self.assertEqual(self.parse('/25:0-4', 'Kappa'), [(0, 5, '25')])
+
+
+if __name__ == '__main__':
+    unittest.main()